@@ -3,6 +3,7 @@ from threedigrid.admin.constants import NO_DATA_VALUE
 from ThreeDiToolbox.datasource.base import BaseDataSource
 from ThreeDiToolbox.datasource.result_constants import LAYER_OBJECT_TYPE_MAPPING
 from ThreeDiToolbox.datasource.result_constants import SUBGRID_MAP_VARIABLES
+from ThreeDiToolbox.utils.line_adjacency import LineAdjacency
 from ThreeDiToolbox.utils.patched_threedigrid import GridH5Admin
 from ThreeDiToolbox.utils.patched_threedigrid import GridH5AggregateResultAdmin
 from ThreeDiToolbox.utils.patched_threedigrid import GridH5ResultAdmin
@@ -270,7 +271,9 @@ class ThreediResult(BaseDataSource):
             filtered_data = values[timestamp_idx, 1:]
         else:
             # node_ids should never be 0 thus the trash element gets filtered out.
-            filtered_data = values[timestamp_idx][:, node_ids]
+            # np.ix_ selects the timesteps and nodes at once, without copying
+            # all nodes of the timesteps first.
+            filtered_data = values[np.ix_(timestamp_idx, node_ids)]
 
         if len(timestamp_idx) == 1:
             # if only one timestamp is specified, an 1d array is returned
@@ -319,6 +322,11 @@ class ThreediResult(BaseDataSource):
         h5 = find_h5_file(self.file_path)
         return GridH5Admin(h5)
 
+    @cached_property
+    def line_adjacency(self):
+        """The lines connected to each node, see :py:class:`LineAdjacency`"""
+        return LineAdjacency.from_gridadmin(self.gridadmin)
+
     @cached_property
     def result_admin(self):
         h5 = find_h5_file(self.file_path)
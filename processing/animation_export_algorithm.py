@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+from qgis.core import QgsCoordinateReferenceSystem
+from qgis.core import QgsCoordinateTransform
+from qgis.core import QgsMapRendererParallelJob
+from qgis.core import QgsMapSettings
+from qgis.core import QgsProcessing
+from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingParameterExtent
+from qgis.core import QgsProcessingParameterFile
+from qgis.core import QgsProcessingParameterFileDestination
+from qgis.core import QgsProcessingParameterFolderDestination
+from qgis.core import QgsProcessingParameterMultipleLayers
+from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterString
+from qgis.core import QgsRectangle
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtCore import QSize
+from qgis.PyQt.QtCore import Qt
+from qgis.PyQt.QtGui import QColor
+from qgis.PyQt.QtGui import QFont
+from qgis.PyQt.QtGui import QPainter
+from ThreeDiToolbox.datasource.threedi_results import ThreediResult
+from ThreeDiToolbox.tool_animation.map_animator import create_animation_layers
+from ThreeDiToolbox.tool_animation.map_animator import DiffReference
+from ThreeDiToolbox.tool_animation.map_animator import get_frame_values
+from ThreeDiToolbox.tool_animation.map_animator import get_value_index
+from ThreeDiToolbox.tool_animation.map_animator import write_values
+
+import logging
+import numpy as np
+import os
+import shutil
+import subprocess
+
+
+logger = logging.getLogger(__name__)
+
+FRAME_NAME = "frame_%05d.png"
+
+# Every frame rendered in parallel needs its own copy of the animation layers.
+# QgsMapRendererParallelJob already renders the layers of one frame in
+# parallel, so a few frames at the same time is enough to keep the cpus busy.
+DEFAULT_PARALLEL_FRAMES = min(2, os.cpu_count() or 1)
+# Upper bound of the number of features of all animation layer copies
+MAX_PARALLEL_FEATURES = 2000000
+
+
+def get_frame_timesteps(timestamps, interval):
+    """Return the timestep indexes of the frames
+
+    :param interval: seconds between the frames, the nearest timestep is
+        used. With 0 every timestep is a frame.
+    """
+    timestamps = np.asarray(timestamps, dtype=float)
+    if interval <= 0:
+        return list(range(len(timestamps)))
+    wanted = np.arange(timestamps[0], timestamps[-1] + interval / 2, interval)
+    after = np.clip(np.searchsorted(timestamps, wanted), 1, len(timestamps) - 1)
+    before = after - 1
+    nearest = np.where(
+        wanted - timestamps[before] <= timestamps[after] - wanted, before, after
+    )
+    return np.unique(nearest).tolist()
+
+
+def format_timestamp(seconds):
+    days, seconds = divmod(int(seconds), 24 * 60 * 60)
+    hours, seconds = divmod(seconds, 60 * 60)
+    minutes = seconds // 60
+    return "{:d} {:02d}:{:02d}".format(days, hours, minutes)
+
+
+class FrameRenderer(object):
+    """Own set of animation layers to render one frame at a time
+
+    Every renderer has its own layers, so multiple frames can be rendered at
+    the same time. The values are written into the ``result`` attribute
+    (instead of read through an expression, see
+    :py:mod:`ThreeDiToolbox.tool_animation.expressions`) so the rendering
+    doesn't need python and runs in parallel.
+    """
+
+    def __init__(self, threedi_result, map_settings, background_layers):
+        layers = create_animation_layers(threedi_result, expression_rendering=False)
+        self.line_layers = layers[0:2]
+        self.node_layers = layers[2:4]
+        self.value_indexes = {layer.id(): get_value_index(layer) for layer in layers}
+        self.map_settings = QgsMapSettings(map_settings)
+        # nodes on top of the lines on top of the background
+        self.map_settings.setLayers(
+            list(self.node_layers) + list(self.line_layers) + background_layers
+        )
+        self.job = None
+        self.label = None
+
+    def feature_count(self):
+        """Return the number of features of the animation layers"""
+        return sum(
+            layer.featureCount() for layer in self.line_layers + self.node_layers
+        )
+
+    def start(self, node_values, line_values, label):
+        for layers, values in (
+            (self.node_layers, node_values),
+            (self.line_layers, line_values),
+        ):
+            for layer in layers:
+                write_values(layer, self.value_indexes[layer.id()], values)
+        self.label = label
+        self.job = QgsMapRendererParallelJob(self.map_settings)
+        self.job.start()
+
+    def finish(self, path):
+        self.job.waitForFinished()
+        image = self.job.renderedImage()
+        painter = QPainter(image)
+        painter.setPen(QColor(Qt.black))
+        painter.setFont(QFont("Sans", max(10, image.height() // 40)))
+        painter.drawText(
+            image.rect().adjusted(10, 10, -10, -10),
+            Qt.AlignLeft | Qt.AlignTop,
+            self.label,
+        )
+        painter.end()
+        image.save(path, "PNG")
+        self.job = None
+
+
+class ThreediAnimationExport(QgsProcessingAlgorithm):
+    """
+    Renders an animation of 3Di results to PNG frames and optionally a MP4
+    """
+
+    RESULTS_3DI_INPUT = "RESULTS_3DI_INPUT"
+    NODE_VARIABLE_INPUT = "NODE_VARIABLE_INPUT"
+    LINE_VARIABLE_INPUT = "LINE_VARIABLE_INPUT"
+    INTERVAL_INPUT = "INTERVAL_INPUT"
+    EXTENT_INPUT = "EXTENT_INPUT"
+    BACKGROUND_LAYERS_INPUT = "BACKGROUND_LAYERS_INPUT"
+    WIDTH_INPUT = "WIDTH_INPUT"
+    HEIGHT_INPUT = "HEIGHT_INPUT"
+    PARALLEL_FRAMES_INPUT = "PARALLEL_FRAMES_INPUT"
+    FPS_INPUT = "FPS_INPUT"
+    FRAMES_OUTPUT = "FRAMES_OUTPUT"
+    VIDEO_OUTPUT = "VIDEO_OUTPUT"
+
+    def tr(self, string):
+        """
+        Returns a translatable string with the self.tr() function.
+        """
+        return QCoreApplication.translate("Processing", string)
+
+    def createInstance(self):
+        return ThreediAnimationExport()
+
+    def name(self):
+        """Returns the algorithm name, used for identifying the algorithm"""
+        return "threedianimationexport"
+
+    def displayName(self):
+        """
+        Returns the translated algorithm name, which should be used for any
+        user-visible display of the algorithm name.
+        """
+        return self.tr("Animation frames and video")
+
+    def group(self):
+        """Returns the name of the group this algorithm belongs to"""
+        return self.tr("Post-process results")
+
+    def groupId(self):
+        """Returns the unique ID of the group this algorithm belongs to"""
+        return "postprocessing"
+
+    def shortHelpString(self):
+        """Returns a localised short helper string for the algorithm"""
+        return self.tr(
+            "Render the animation of node and flowline results to a PNG per "
+            "frame, like the animation toolbar does. Optionally the frames are "
+            "encoded to a MP4 video, which requires ffmpeg."
+        )
+
+    def flags(self):
+        # Rendering jobs are started and awaited from the algorithm itself
+        return super().flags() | QgsProcessingAlgorithm.FlagNoThreading
+
+    def initAlgorithm(self, config=None):
+        """Here we define the inputs and output of the algorithm"""
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.RESULTS_3DI_INPUT,
+                self.tr("Results_3di.nc file"),
+                extension="nc",
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.NODE_VARIABLE_INPUT,
+                self.tr("Node variable (difference with the first timestep)"),
+                defaultValue="s1",
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.LINE_VARIABLE_INPUT,
+                self.tr("Flowline variable"),
+                defaultValue="q",
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INTERVAL_INPUT,
+                self.tr("Time between frames in seconds (0: every timestep)"),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0,
+                minValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterExtent(
+                self.EXTENT_INPUT, self.tr("Extent"), optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterMultipleLayers(
+                self.BACKGROUND_LAYERS_INPUT,
+                self.tr("Background layers"),
+                layerType=QgsProcessing.TypeMapLayer,
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WIDTH_INPUT,
+                self.tr("Width (pixels)"),
+                defaultValue=1920,
+                minValue=1,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.HEIGHT_INPUT,
+                self.tr("Height (pixels)"),
+                defaultValue=1080,
+                minValue=1,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PARALLEL_FRAMES_INPUT,
+                self.tr("Number of frames rendered in parallel"),
+                defaultValue=DEFAULT_PARALLEL_FRAMES,
+                minValue=1,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.FPS_INPUT,
+                self.tr("Frames per second of the video"),
+                defaultValue=10,
+                minValue=1,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFolderDestination(
+                self.FRAMES_OUTPUT, self.tr("Frames folder")
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.VIDEO_OUTPUT,
+                self.tr("Video"),
+                fileFilter="MP4 files (*.mp4)",
+                optional=True,
+                createByDefault=False,
+            )
+        )
+
+    def _get_map_settings(self, parameters, context, threedi_result):
+        map_settings = QgsMapSettings()
+        crs = context.project().crs() if context.project() else None
+        if crs is None or not crs.isValid():
+            crs = QgsCoordinateReferenceSystem("EPSG:4326")
+        map_settings.setDestinationCrs(crs)
+        if parameters.get(self.EXTENT_INPUT):
+            extent = self.parameterAsExtent(parameters, self.EXTENT_INPUT, context, crs)
+        else:
+            # the extent of all nodes (skipping the trash element), in WGS84
+            nodes = threedi_result.gridadmin.nodes.slice(slice(1, None))
+            x, y = nodes.reproject_to("4326").coordinates
+            valid = np.isfinite(x) & np.isfinite(y)
+            extent = QgsRectangle(
+                x[valid].min(), y[valid].min(), x[valid].max(), y[valid].max()
+            )
+            transform = QgsCoordinateTransform(
+                QgsCoordinateReferenceSystem("EPSG:4326"), crs, context.project()
+            )
+            extent = transform.transformBoundingBox(extent)
+        map_settings.setExtent(extent)
+        map_settings.setOutputSize(
+            QSize(
+                self.parameterAsInt(parameters, self.WIDTH_INPUT, context),
+                self.parameterAsInt(parameters, self.HEIGHT_INPUT, context),
+            )
+        )
+        map_settings.setBackgroundColor(QColor(Qt.white))
+        map_settings.setFlag(QgsMapSettings.Antialiasing, True)
+        map_settings.setTransformContext(context.transformContext())
+        return map_settings
+
+    def processAlgorithm(self, parameters, context, feedback):
+        """
+        Render the frames and encode the video
+        """
+        threedi_result = ThreediResult(
+            self.parameterAsFile(parameters, self.RESULTS_3DI_INPUT, context)
+        )
+        node_variable = self.parameterAsString(
+            parameters, self.NODE_VARIABLE_INPUT, context
+        )
+        line_variable = self.parameterAsString(
+            parameters, self.LINE_VARIABLE_INPUT, context
+        )
+        for variable in (node_variable, line_variable):
+            if variable not in threedi_result.available_subgrid_map_vars:
+                raise QgsProcessingException(
+                    self.tr("Variable %s is not available in the results") % variable
+                )
+        frames_folder = self.parameterAsString(parameters, self.FRAMES_OUTPUT, context)
+        os.makedirs(frames_folder, exist_ok=True)
+
+        map_settings = self._get_map_settings(parameters, context, threedi_result)
+        background_layers = self.parameterAsLayerList(
+            parameters, self.BACKGROUND_LAYERS_INPUT, context
+        )
+
+        timestamps = threedi_result.get_timestamps()
+        if len(timestamps) == 0:
+            raise QgsProcessingException(self.tr("The results have no timesteps"))
+        interval = self.parameterAsDouble(parameters, self.INTERVAL_INPUT, context)
+        timesteps = get_frame_timesteps(timestamps, interval)
+        nr_parallel = min(
+            self.parameterAsInt(parameters, self.PARALLEL_FRAMES_INPUT, context),
+            len(timesteps),
+        )
+        feedback.pushInfo(self.tr("Creating the animation layers"))
+        renderers = [FrameRenderer(threedi_result, map_settings, background_layers)]
+        nr_features = renderers[0].feature_count()
+        max_parallel = max(1, MAX_PARALLEL_FEATURES // max(1, nr_features))
+        if nr_parallel > max_parallel:
+            feedback.pushInfo(
+                self.tr("Rendering %d frames in parallel to limit the memory usage")
+                % max_parallel
+            )
+            nr_parallel = max_parallel
+        renderers += [
+            FrameRenderer(threedi_result, map_settings, background_layers)
+            for _ in range(nr_parallel - 1)
+        ]
+
+        # Render the frames in batches of one frame per renderer
+        diff_reference = DiffReference()
+        frames = list(enumerate(timesteps))
+        for batch_start in range(0, len(frames), nr_parallel):
+            if feedback.isCanceled():
+                break
+            batch = frames[batch_start:batch_start + nr_parallel]
+            for renderer, (_, timestep_nr) in zip(renderers, batch):
+                renderer.start(
+                    get_frame_values(
+                        threedi_result,
+                        node_variable,
+                        "diff",
+                        timestep_nr,
+                        diff_reference,
+                    ),
+                    get_frame_values(threedi_result, line_variable, "act", timestep_nr),
+                    format_timestamp(timestamps[timestep_nr]),
+                )
+            for renderer, (frame_nr, _) in zip(renderers, batch):
+                renderer.finish(os.path.join(frames_folder, FRAME_NAME % frame_nr))
+            feedback.setProgress(100 * (batch_start + len(batch)) / len(frames))
+
+        video = self.parameterAsFileOutput(parameters, self.VIDEO_OUTPUT, context)
+        if video and not feedback.isCanceled():
+            self._encode_video(
+                frames_folder,
+                video,
+                self.parameterAsInt(parameters, self.FPS_INPUT, context),
+                feedback,
+            )
+        else:
+            video = None
+
+        return {self.FRAMES_OUTPUT: frames_folder, self.VIDEO_OUTPUT: video}
+
+    def _encode_video(self, frames_folder, video, fps, feedback):
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            raise QgsProcessingException(
+                self.tr("ffmpeg is not found, only the frames have been rendered")
+            )
+        feedback.pushInfo(self.tr("Encoding %s") % video)
+        command = [
+            ffmpeg,
+            "-y",
+            "-framerate",
+            str(fps),
+            "-i",
+            os.path.join(frames_folder, FRAME_NAME),
+            "-c:v",
+            "libx264",
+            "-pix_fmt",
+            "yuv420p",
+            # libx264 requires an even width and height
+            "-vf",
+            "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            video,
+        ]
+        process = subprocess.run(
+            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        if process.returncode != 0:
+            logger.error(process.stdout.decode(errors="replace"))
+            raise QgsProcessingException(self.tr("Encoding the video failed"))
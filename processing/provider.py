@@ -2,7 +2,16 @@
 from qgis.core import QgsProcessingProvider
 from qgis.PyQt.QtGui import QIcon
 
+from ThreeDiToolbox.processing.animation_export_algorithm import (
+    ThreediAnimationExport,
+)
 from ThreeDiToolbox.processing.threedidepth_algorithm import ThreediDepth
+from ThreeDiToolbox.processing.water_balance_algorithm import (
+    ThreediWaterBalanceBatch,
+)
+from ThreeDiToolbox.processing.water_balance_algorithm import (
+    ThreediWaterBalanceExport,
+)
 
 
 class ThreediProvider(QgsProcessingProvider):
@@ -10,6 +19,9 @@ class ThreediProvider(QgsProcessingProvider):
 
     def loadAlgorithms(self, *args, **kwargs):
         self.addAlgorithm(ThreediDepth())
+        self.addAlgorithm(ThreediAnimationExport())
+        self.addAlgorithm(ThreediWaterBalanceBatch())
+        self.addAlgorithm(ThreediWaterBalanceExport())
         # add additional algorithms here
         # self.addAlgorithm(MyOtherAlgorithm())
 
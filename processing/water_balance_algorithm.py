@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+from qgis.core import QgsCoordinateReferenceSystem
+from qgis.core import QgsCoordinateTransform
+from qgis.core import QgsFeature
+from qgis.core import QgsFeatureSink
+from qgis.core import QgsField
+from qgis.core import QgsFields
+from qgis.core import QgsGeometry
+from qgis.core import QgsProcessing
+from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterFeatureSink
+from qgis.core import QgsProcessingParameterFeatureSource
+from qgis.core import QgsProcessingParameterField
+from qgis.core import QgsProcessingParameterFile
+from qgis.core import QgsProcessingParameterFileDestination
+from qgis.core import QgsProcessingParameterNumber
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtCore import QVariant
+from ThreeDiToolbox.datasource.threedi_results import ThreediResult
+from ThreeDiToolbox.tool_water_balance.tools.batch import calculate_water_balances
+from ThreeDiToolbox.tool_water_balance.tools.batch import get_area_closure_error
+from ThreeDiToolbox.tool_water_balance.tools.batch import get_area_volumes
+from ThreeDiToolbox.tool_water_balance.tools.export import write_csv
+from ThreeDiToolbox.tool_water_balance.tools.export import write_netcdf
+from ThreeDiToolbox.tool_water_balance.tools.waterbalance import (
+    WaterBalanceCalculation,
+)
+from ThreeDiToolbox.tool_water_balance.views.waterbalance_widget import (
+    get_model_part_series,
+)
+from ThreeDiToolbox.tool_water_balance.views.waterbalance_widget import (
+    MODEL_PART_SERIES_PARTS,
+)
+
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+MODEL_PARTS = list(MODEL_PART_SERIES_PARTS)
+
+
+class AreaWaterBalanceAlgorithm(QgsProcessingAlgorithm):
+    """
+    Base of the algorithms calculating the water balance of every polygon of
+    a layer on a 3Di result
+    """
+
+    RESULTS_3DI_INPUT = "RESULTS_3DI_INPUT"
+    POLYGONS_INPUT = "POLYGONS_INPUT"
+    MODEL_PART_INPUT = "MODEL_PART_INPUT"
+    PARALLEL_AREAS_INPUT = "PARALLEL_AREAS_INPUT"
+    OUTPUT = "OUTPUT"
+
+    def tr(self, string):
+        """
+        Returns a translatable string with the self.tr() function.
+        """
+        return QCoreApplication.translate("Processing", string)
+
+    def group(self):
+        """Returns the name of the group this algorithm belongs to"""
+        return self.tr("Post-process results")
+
+    def groupId(self):
+        """Returns the unique ID of the group this algorithm belongs to"""
+        return "postprocessing"
+
+    def get_area_input(self, parameters, context):
+        """Return the ThreediResult, the polygon source and the model part
+
+        :raises QgsProcessingException: on invalid input
+        """
+        threedi_result = ThreediResult(
+            self.parameterAsFile(parameters, self.RESULTS_3DI_INPUT, context)
+        )
+        if "q_cum" not in threedi_result.available_aggregation_vars:
+            raise QgsProcessingException(
+                self.tr("The aggregation results (with q_cum) are not found")
+            )
+        source = self.parameterAsSource(parameters, self.POLYGONS_INPUT, context)
+        if source is None:
+            raise QgsProcessingException(
+                self.invalidSourceError(parameters, self.POLYGONS_INPUT)
+            )
+        model_part = MODEL_PARTS[
+            self.parameterAsEnum(parameters, self.MODEL_PART_INPUT, context)
+        ]
+        return threedi_result, source, model_part
+
+    def calculate_area_balances(
+        self, threedi_result, source, model_part, parameters, context, feedback
+    ):
+        """Return the water balances of the polygons of the source
+
+        See :py:meth:`get_area_input` for the first three parameters.
+
+        :return: tuple (features, results, closure_errors) with the
+            (ts, total_time) and the (relative closure error, flagged) per
+            feature
+        :raises QgsProcessingException: if cancelled,
+            ``calculate_water_balances`` then returns less results than
+            polygons and writing those would silently give a partial output
+        """
+        # the water balance selects on the WGS84 gridadmin coordinates
+        transform = QgsCoordinateTransform(
+            source.sourceCrs(),
+            QgsCoordinateReferenceSystem("EPSG:4326"),
+            context.transformContext(),
+        )
+        features = list(source.getFeatures())
+        polygons = []
+        for feature in features:
+            polygon = QgsGeometry(feature.geometry())
+            polygon.transform(transform)
+            polygons.append(polygon)
+
+        feedback.pushInfo(self.tr("Calculating %d water balances") % len(polygons))
+        results = calculate_water_balances(
+            WaterBalanceCalculation(threedi_result=threedi_result),
+            polygons,
+            model_part,
+            max_workers=self.parameterAsInt(
+                parameters, self.PARALLEL_AREAS_INPUT, context
+            ),
+            feedback=feedback,
+        )
+        if feedback.isCanceled() or len(results) != len(polygons):
+            raise QgsProcessingException(
+                self.tr("Cancelled, the water balances are not written")
+            )
+        closure_errors = [
+            get_area_closure_error(ts, total_time, model_part)
+            for ts, total_time in results
+        ]
+        return features, results, closure_errors
+
+
+class ThreediWaterBalanceBatch(AreaWaterBalanceAlgorithm):
+    """
+    Calculates the water balance of every polygon of a layer on a 3Di result
+    """
+
+    def createInstance(self):
+        return ThreediWaterBalanceBatch()
+
+    def name(self):
+        """Returns the algorithm name, used for identifying the algorithm"""
+        return "threediwaterbalancebatch"
+
+    def displayName(self):
+        """
+        Returns the translated algorithm name, which should be used for any
+        user-visible display of the algorithm name.
+        """
+        return self.tr("Water balance per area")
+
+    def shortHelpString(self):
+        """Returns a localised short helper string for the algorithm"""
+        return self.tr(
+            "Calculate the water balance of every polygon of a layer, like the "
+            "water balance tool does for a drawn polygon. The output has the "
+            "attributes of the polygons and the total volume (m3) of every "
+            "water balance series. Requires the aggregation results. The "
+            "relative closure error is the difference between the change in "
+            "storage and the sum of the flows, relative to the gross flow. "
+            "Areas with a large closure error are flagged."
+        )
+
+    def initAlgorithm(self, config=None):
+        """Here we define the inputs and output of the algorithm"""
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.RESULTS_3DI_INPUT,
+                self.tr("Results_3di.nc file"),
+                extension="nc",
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.POLYGONS_INPUT,
+                self.tr("Areas"),
+                [QgsProcessing.TypeVectorPolygon],
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.MODEL_PART_INPUT,
+                self.tr("Model part"),
+                options=MODEL_PARTS,
+                defaultValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PARALLEL_AREAS_INPUT,
+                self.tr("Number of areas aggregated in parallel"),
+                defaultValue=os.cpu_count() or 1,
+                minValue=1,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT,
+                self.tr("Water balance per area"),
+                QgsProcessing.TypeVectorPolygon,
+            )
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        """
+        Classify the flowlines and nodes of all areas and aggregate the flows
+        """
+        threedi_result, source, model_part = self.get_area_input(
+            parameters, context
+        )
+
+        fields = QgsFields(source.fields())
+        for name, _ in get_model_part_series(model_part):
+            fields.append(QgsField(name, QVariant.Double))
+        fields.append(QgsField("closure_error", QVariant.Double))
+        fields.append(QgsField("closure_flagged", QVariant.Bool))
+        sink, dest_id = self.parameterAsSink(
+            parameters,
+            self.OUTPUT,
+            context,
+            fields,
+            source.wkbType(),
+            source.sourceCrs(),
+        )
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+
+        features, results, closure_errors = self.calculate_area_balances(
+            threedi_result, source, model_part, parameters, context, feedback
+        )
+        nr_flagged = 0
+        for feature, (ts, total_time), (closure_error, flagged) in zip(
+            features, results, closure_errors
+        ):
+            nr_flagged += flagged
+            area = QgsFeature(fields)
+            area.setGeometry(feature.geometry())
+            area.setAttributes(
+                feature.attributes()
+                + [
+                    volume
+                    for _, volume in get_area_volumes(ts, total_time, model_part)
+                ]
+                + [closure_error, flagged]
+            )
+            sink.addFeature(area, QgsFeatureSink.FastInsert)
+        if nr_flagged:
+            feedback.reportError(
+                self.tr(
+                    "The water balance of %d areas doesn't close, see the "
+                    "closure_flagged attribute"
+                )
+                % nr_flagged
+            )
+        return {self.OUTPUT: dest_id}
+
+
+class ThreediWaterBalanceExport(AreaWaterBalanceAlgorithm):
+    """
+    Writes the water balance flows per timestep of every polygon of a layer
+    """
+
+    AREA_ID_FIELD_INPUT = "AREA_ID_FIELD_INPUT"
+
+    def createInstance(self):
+        return ThreediWaterBalanceExport()
+
+    def name(self):
+        """Returns the algorithm name, used for identifying the algorithm"""
+        return "threediwaterbalanceexport"
+
+    def displayName(self):
+        """
+        Returns the translated algorithm name, which should be used for any
+        user-visible display of the algorithm name.
+        """
+        return self.tr("Water balance flows per timestep")
+
+    def shortHelpString(self):
+        """Returns a localised short helper string for the algorithm"""
+        return self.tr(
+            "Write the flows (m3/s) of every water balance series per timestep "
+            "for every polygon of a layer to a CSV or NetCDF file, without the "
+            "water balance tool. Requires the aggregation results."
+        )
+
+    def initAlgorithm(self, config=None):
+        """Here we define the inputs and output of the algorithm"""
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.RESULTS_3DI_INPUT,
+                self.tr("Results_3di.nc file"),
+                extension="nc",
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.POLYGONS_INPUT,
+                self.tr("Areas"),
+                [QgsProcessing.TypeVectorPolygon],
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.AREA_ID_FIELD_INPUT,
+                self.tr("Area identifier field (default: the feature id)"),
+                parentLayerParameterName=self.POLYGONS_INPUT,
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.MODEL_PART_INPUT,
+                self.tr("Model part"),
+                options=MODEL_PARTS,
+                defaultValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PARALLEL_AREAS_INPUT,
+                self.tr("Number of areas aggregated in parallel"),
+                defaultValue=os.cpu_count() or 1,
+                minValue=1,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.OUTPUT,
+                self.tr("Water balance flows"),
+                fileFilter="CSV files (*.csv);;NetCDF files (*.nc)",
+            )
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        """
+        Calculate the water balances and write their flows
+        """
+        threedi_result, source, model_part = self.get_area_input(
+            parameters, context
+        )
+        id_field = self.parameterAsString(
+            parameters, self.AREA_ID_FIELD_INPUT, context
+        )
+        output = self.parameterAsFileOutput(parameters, self.OUTPUT, context)
+
+        features, results, closure_errors = self.calculate_area_balances(
+            threedi_result, source, model_part, parameters, context, feedback
+        )
+        if not results:
+            return {self.OUTPUT: None}
+        nr_flagged = sum(flagged for _, flagged in closure_errors)
+        if nr_flagged:
+            feedback.reportError(
+                self.tr("The water balance of %d areas doesn't close") % nr_flagged
+            )
+
+        area_ids = [
+            feature[id_field] if id_field else feature.id() for feature in features
+        ]
+        ts = results[0][0]
+        total_times = [total_time for _, total_time in results]
+        series = get_model_part_series(model_part)
+        if os.path.splitext(output)[1].lower() == ".nc":
+            write_netcdf(output, area_ids, ts, total_times, series)
+        else:
+            write_csv(output, area_ids, ts, total_times, series)
+        return {self.OUTPUT: output}
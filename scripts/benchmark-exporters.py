@@ -0,0 +1,232 @@
+"""Benchmark the gridadmin.sqlite exporters on synthetic gridadmin data.
+
+Every exporter is run against synthetic node, line and cell data of 10k, 100k
+and 1M objects. Per run the throughput (features/s) and the peak memory usage
+(max RSS) are reported. Each run happens in a fresh process, so the peak RSS
+is that of the single run.
+
+Usage (in the docker, like the tests)::
+
+    $ python3 scripts/benchmark-exporters.py --save-baseline baseline.json
+    $ python3 scripts/benchmark-exporters.py --baseline baseline.json
+
+With ``--baseline``, the script exits with a non-zero exit code when the
+throughput of a run is more than ``--threshold`` (default 20%) below the
+baseline. With ``--max-rss``, it also does so when the peak memory usage of a
+run exceeds that number of MiB. ``make benchmark`` checks against
+``scripts/benchmark-exporters-baseline.json``.
+
+"""
+from concurrent.futures import ProcessPoolExecutor
+from osgeo import ogr
+
+import argparse
+import json
+import multiprocessing
+import numpy as np
+import resource
+import sys
+import tempfile
+import time
+
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DEFAULT_THRESHOLD = 0.2
+EXPORTERS = ["nodes", "lines", "cells"]
+WGS84_EPSG = 4326
+
+
+def synthetic_node_data(size, seed=0):
+    """Return a gridadmin-like dict of node data of ``size`` nodes"""
+    rng = np.random.RandomState(seed)
+    ids = np.arange(1, size + 1, dtype=np.int32)
+    return {
+        "id": ids,
+        "seq_id": ids.copy(),
+        "content_pk": rng.randint(0, 10000, size).astype(np.int32),
+        "node_type": rng.choice([1, 2, 3, 5], size).astype(np.int32),
+        "coordinates": np.vstack(
+            [rng.uniform(4.6, 4.8, size), rng.uniform(52.6, 52.7, size)]
+        ),
+    }
+
+
+def synthetic_line_data(size, seed=0):
+    """Return a gridadmin-like dict of line data of ``size`` lines"""
+    rng = np.random.RandomState(seed)
+    ids = np.arange(1, size + 1, dtype=np.int32)
+    x = rng.uniform(4.6, 4.8, size)
+    y = rng.uniform(52.6, 52.7, size)
+    return {
+        "id": ids,
+        "kcu": rng.choice([1, 51, 100, 101, 150, -150], size).astype(np.int32),
+        "lik": ids.copy(),
+        "line": rng.randint(1, size + 1, (2, size)).astype(np.int32),
+        "content_type": rng.choice([b"", b"v2_pipe", b"v2_channel"], size),
+        "content_pk": rng.randint(0, 10000, size).astype(np.int32),
+        "line_coords": np.vstack([x, y, x + 0.001, y + 0.001]),
+    }
+
+
+def synthetic_cell_data(size, seed=0):
+    """Return a gridadmin-like dict of 2D cell data of ``size`` cells"""
+    rng = np.random.RandomState(seed)
+    pixel_width = rng.choice([1, 2, 4, 8], size).astype(np.int32)
+    x = rng.uniform(4.6, 4.8, size)
+    y = rng.uniform(52.6, 52.7, size)
+    width = pixel_width * 0.0001
+    return {
+        "id": np.arange(1, size + 1, dtype=np.int32),
+        "node_type": rng.choice([1, 2], size).astype(np.int32),
+        "pixel_width": pixel_width,
+        "cell_coords": np.vstack([x, y, x + width, y + width]),
+    }
+
+
+def _run(exporter_name, size):
+    """Export ``size`` synthetic objects, return (seconds, max RSS in MiB)
+
+    Runs in a separate process, see ``run()``.
+    """
+    from ThreeDiToolbox.utils.gridadmin import QgisCellsOgrExporter
+    from ThreeDiToolbox.utils.gridadmin import QgisLinesOgrExporter
+    from ThreeDiToolbox.utils.gridadmin import QgisNodesOgrExporter
+
+    if exporter_name == "nodes":
+        exporter = QgisNodesOgrExporter(None)
+        data = synthetic_node_data(size)
+    elif exporter_name == "lines":
+        exporter = QgisLinesOgrExporter(None)
+        data = synthetic_line_data(size)
+    else:
+        exporter = QgisCellsOgrExporter(None)
+        data = synthetic_cell_data(size)
+    exporter.driver = ogr.GetDriverByName("SQLite")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = "%s/gridadmin.sqlite" % tmp_dir
+        start = time.perf_counter()
+        exporter.save(file_name, exporter_name, data, WGS84_EPSG)
+        seconds = time.perf_counter() - start
+    # ru_maxrss is in KiB on linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return seconds, max_rss
+
+
+def run(exporter_name, size):
+    """Run one benchmark in a fresh process and return its results"""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        seconds, max_rss = executor.submit(_run, exporter_name, size).result()
+    return {
+        "exporter": exporter_name,
+        "size": size,
+        "seconds": round(seconds, 3),
+        "features_per_second": round(size / seconds),
+        "max_rss_mib": round(max_rss, 1),
+    }
+
+
+def find_regressions(results, baseline, threshold):
+    """Return messages for the results that are slower than the baseline"""
+    baseline_throughput = {
+        (item["exporter"], item["size"]): item["features_per_second"]
+        for item in baseline
+    }
+    regressions = []
+    for result in results:
+        key = (result["exporter"], result["size"])
+        if key not in baseline_throughput:
+            continue
+        minimum = baseline_throughput[key] * (1 - threshold)
+        if result["features_per_second"] < minimum:
+            regressions.append(
+                "%s (%d): %d features/s, baseline %d features/s"
+                % (
+                    result["exporter"],
+                    result["size"],
+                    result["features_per_second"],
+                    baseline_throughput[key],
+                )
+            )
+    return regressions
+
+
+def find_memory_overruns(results, max_rss):
+    """Return messages for the results with a peak RSS above ``max_rss`` MiB"""
+    return [
+        "%s (%d): %.1f MiB, limit %.1f MiB"
+        % (result["exporter"], result["size"], result["max_rss_mib"], max_rss)
+        for result in results
+        if result["max_rss_mib"] > max_rss
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="object counts"
+    )
+    parser.add_argument(
+        "--exporters", nargs="+", choices=EXPORTERS, default=EXPORTERS
+    )
+    parser.add_argument("--baseline", help="json file with earlier results")
+    parser.add_argument("--save-baseline", help="write the results to this file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="allowed relative throughput regression (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-rss", type=float, help="allowed peak memory usage per run in MiB"
+    )
+    args = parser.parse_args()
+
+    results = []
+    print(
+        "%-8s %9s %10s %12s %10s"
+        % ("exporter", "size", "seconds", "features/s", "RSS (MiB)")
+    )
+    for exporter_name in args.exporters:
+        for size in args.sizes:
+            result = run(exporter_name, size)
+            results.append(result)
+            print(
+                "%-8s %9d %10.3f %12d %10.1f"
+                % (
+                    exporter_name,
+                    size,
+                    result["seconds"],
+                    result["features_per_second"],
+                    result["max_rss_mib"],
+                )
+            )
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+    failed = False
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = find_regressions(results, baseline, args.threshold)
+        if regressions:
+            print("Throughput regressed more than %d%%:" % (args.threshold * 100))
+            for regression in regressions:
+                print("  " + regression)
+            failed = True
+    if args.max_rss is not None:
+        overruns = find_memory_overruns(results, args.max_rss)
+        if overruns:
+            print("Peak memory usage exceeded:")
+            for overrun in overruns:
+                print("  " + overrun)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
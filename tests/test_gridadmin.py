@@ -0,0 +1,112 @@
+"""
+Test the gridadmin.sqlite exporters.
+"""
+from osgeo import ogr
+from qgis.core import QgsFeedback
+from ThreeDiToolbox.utils.gridadmin import _create_features_in_chunks
+from ThreeDiToolbox.utils.gridadmin import ExportCancelledError
+from ThreeDiToolbox.utils.gridadmin import QgisCellsOgrExporter
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def point_layer(tmpdir):
+    """A real (empty) SQLite point layer with an integer 'value' field"""
+    driver = ogr.GetDriverByName("SQLite")
+    data_source = driver.CreateDataSource(str(tmpdir / "points.sqlite"))
+    layer = data_source.CreateLayer("points", geom_type=ogr.wkbPoint)
+    layer.CreateField(ogr.FieldDefn("value", ogr.OFTInteger))
+    yield layer
+    data_source = None
+
+
+def _point_arrays(nr_features):
+    """x, y, fid and value arrays, the fids are numpy ints on purpose"""
+    x = np.arange(nr_features, dtype=float)
+    fids = np.arange(1, nr_features + 1, dtype=np.int32)
+    values = np.array([None if i % 2 else i for i in range(nr_features)])
+    return x, 2 * x, fids, values
+
+
+def _point_factory(layer):
+    definition = layer.GetLayerDefn()
+
+    def create_feature(x, y, fid, value):
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(x, y)
+        feature = ogr.Feature(definition)
+        feature.SetGeometry(point)
+        if value is not None:
+            feature.SetField("value", value)
+        feature.SetFID(fid)
+        return feature
+
+    return create_feature
+
+
+def test_create_features_in_chunks_commits_per_chunk(point_layer):
+    feedback = QgsFeedback()
+    committed = []
+    feedback.progressChanged.connect(
+        lambda progress: committed.append((progress, point_layer.GetFeatureCount()))
+    )
+    _create_features_in_chunks(
+        point_layer,
+        _point_arrays(5),
+        _point_factory(point_layer),
+        feedback=feedback,
+        chunk_size=2,
+    )
+    assert committed == [(40.0, 2), (80.0, 4), (100.0, 5)]
+    features = {f.GetFID(): f for f in point_layer}
+    assert sorted(features) == [1, 2, 3, 4, 5]
+    assert features[5].GetGeometryRef().GetPoint_2D() == (4.0, 8.0)
+    assert features[3].GetField("value") == 2
+    assert features[2].GetField("value") is None
+
+
+def test_create_features_in_chunks_cancel(point_layer):
+    feedback = QgsFeedback()
+    # cancel as soon as the first chunk has been committed
+    feedback.progressChanged.connect(lambda progress: feedback.cancel())
+    with pytest.raises(ExportCancelledError):
+        _create_features_in_chunks(
+            point_layer,
+            _point_arrays(5),
+            _point_factory(point_layer),
+            feedback=feedback,
+            chunk_size=2,
+        )
+    # the first chunk is committed, the second one never started
+    assert sorted(f.GetFID() for f in point_layer) == [1, 2]
+
+
+def test_create_features_in_chunks_no_features(point_layer):
+    feedback = QgsFeedback()
+    _create_features_in_chunks(
+        point_layer, _point_arrays(0), _point_factory(point_layer), feedback
+    )
+    assert point_layer.GetFeatureCount() == 0
+
+
+def test_cells_exporter_filter_and_levels():
+    cell_data = {
+        "id": np.array([1, 2, 3, 4]),
+        "node_type": np.array([1, 1, 2, 3]),
+        "cell_coords": np.array(
+            [
+                [0.0, 0.0, 0.0, np.nan],
+                [0.0, 0.0, 0.0, np.nan],
+                [10.0, 40.0, 20.0, np.nan],
+                [10.0, 40.0, 20.0, np.nan],
+            ]
+        ),
+        "pixel_width": np.array(None, dtype=object),
+    }
+    filtered = QgisCellsOgrExporter.filter_cells(cell_data)
+    assert filtered["id"].tolist() == [1, 2, 3]
+    columns = QgisCellsOgrExporter.get_attribute_columns(filtered)
+    assert columns["type"].tolist() == ["2d", "2d", "2d_groundwater"]
+    assert columns["level"].tolist() == [1, 3, 2]
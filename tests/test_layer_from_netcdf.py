@@ -0,0 +1,59 @@
+"""
+Test the layer catalogue of the gridadmin.sqlite.
+"""
+from ThreeDiToolbox.utils import layer_from_netCDF
+from ThreeDiToolbox.utils.layer_from_netCDF import contains_layer
+from ThreeDiToolbox.utils.layer_from_netCDF import get_layer_names
+from ThreeDiToolbox.utils.layer_from_netCDF import get_sqlite_uri
+from ThreeDiToolbox.utils.layer_from_netCDF import LAYER_NAMES_CACHE_SIZE
+
+import os
+import sqlite3
+
+
+def _add_geometry_column(sqlite_path, table_name):
+    connection = sqlite3.connect(sqlite_path)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS geometry_columns (f_table_name TEXT)"
+    )
+    connection.execute("INSERT INTO geometry_columns VALUES (?)", (table_name,))
+    connection.commit()
+    connection.close()
+
+
+def test_contains_layer_without_geometry_columns(tmpdir):
+    sqlite_path = str(tmpdir / "gridadmin.sqlite")
+    sqlite3.connect(sqlite_path).close()
+    assert not contains_layer(sqlite_path, "flowlines")
+
+
+def test_get_layer_names_is_refreshed_on_change(tmpdir):
+    sqlite_path = str(tmpdir / "gridadmin.sqlite")
+    _add_geometry_column(sqlite_path, "flowlines")
+    assert get_layer_names(sqlite_path) == {"flowlines"}
+    _add_geometry_column(sqlite_path, "nodes")
+    # make sure the mtime differs, even on coarse file systems
+    stat = os.stat(sqlite_path)
+    os.utime(sqlite_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert contains_layer(sqlite_path, "nodes")
+
+
+def test_contains_layer_with_special_characters_in_path(tmpdir):
+    directory = tmpdir / "model dir #1"
+    directory.mkdir()
+    sqlite_path = str(directory / "grid admin.sqlite")
+    _add_geometry_column(sqlite_path, "flowlines")
+    assert contains_layer(sqlite_path, "flowlines")
+
+
+def test_get_sqlite_uri_of_unc_path_has_no_authority():
+    uri = get_sqlite_uri("//server/share/gridadmin.sqlite")
+    assert uri == "file:////server/share/gridadmin.sqlite?mode=ro"
+
+
+def test_layer_names_cache_is_bounded(tmpdir):
+    for i in range(LAYER_NAMES_CACHE_SIZE + 2):
+        sqlite_path = str(tmpdir / ("gridadmin%d.sqlite" % i))
+        _add_geometry_column(sqlite_path, "flowlines")
+        get_layer_names(sqlite_path)
+    assert len(layer_from_netCDF._layer_names_cache) == LAYER_NAMES_CACHE_SIZE
@@ -0,0 +1,32 @@
+from ThreeDiToolbox.utils.line_adjacency import ENDS_AT_NODE
+from ThreeDiToolbox.utils.line_adjacency import LineAdjacency
+from ThreeDiToolbox.utils.line_adjacency import STARTS_AT_NODE
+
+
+def _adjacency():
+    # line 3 has no end node
+    return LineAdjacency([1, 2, 3, 4], [1, 2, 2, 5], [2, 3, -9999, 2])
+
+
+def test_get_lines():
+    line_ids, directions = _adjacency().get_lines(2)
+    assert line_ids.tolist() == [2, 3, 1, 4]
+    assert directions.tolist() == [
+        STARTS_AT_NODE,
+        STARTS_AT_NODE,
+        ENDS_AT_NODE,
+        ENDS_AT_NODE,
+    ]
+
+
+def test_get_lines_unknown_node():
+    line_ids, directions = _adjacency().get_lines(9)
+    assert line_ids.size == 0
+    assert directions.size == 0
+
+
+def test_get_incident_lines():
+    node_ids, line_ids, directions = _adjacency().get_incident_lines([5, 9, 1])
+    assert node_ids.tolist() == [5, 1]
+    assert line_ids.tolist() == [4, 1]
+    assert directions.tolist() == [STARTS_AT_NODE, STARTS_AT_NODE]
@@ -8,6 +8,7 @@ from ThreeDiToolbox.misc_tools import About
 from ThreeDiToolbox.misc_tools import CacheClearer
 from ThreeDiToolbox.misc_tools import ShowLogfile
 from ThreeDiToolbox.processing.provider import ThreediProvider
+from ThreeDiToolbox.tool_animation import expressions
 from ThreeDiToolbox.tool_animation.map_animator import MapAnimator
 from ThreeDiToolbox.tool_commands.command_box import CommandBox
 from ThreeDiToolbox.tool_graph.graph import ThreeDiGraph
@@ -193,6 +194,8 @@ class ThreeDiPlugin(QObject, ProjectStateMixin):
             )
         # Processing Toolbox of Qgis will eventually replace our custom-toolbox
         self.initProcessing()
+        # Expression function used by the animation layers
+        expressions.register()
 
         self.toolbar_animation.addWidget(self.map_animator_widget)
         self.toolbar_animation.addWidget(self.timeslider_widget)
@@ -270,6 +273,8 @@ class ThreeDiPlugin(QObject, ProjectStateMixin):
 
         self.unload_state_sync()
         QgsApplication.processingRegistry().removeProvider(self.provider)
+        expressions.unregister()
+        self.map_animator_widget.shutdown()
 
         for action in self.actions:
             self.iface.removePluginMenu("&3Di toolbox", action)
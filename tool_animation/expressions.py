@@ -0,0 +1,68 @@
+"""Expression function that reads animation values from numpy arrays
+
+The animation layers get a virtual ``result`` field with the expression
+``threedi_value('<layer id>', "id")``, "id" being the node or line id. The
+symbology reads that field like any other, but the value comes from the array
+registered for the layer with :py:func:`set_values`. Changing the timestep
+therefore only replaces the array and triggers a repaint: no attribute values
+are written.
+
+"""
+from qgis.core import QgsExpression
+from qgis.core import qgsfunction
+
+import math
+
+
+FUNCTION_NAME = "threedi_value"
+
+# Current values per buffer name (the layer id of the animation layer)
+_buffers = {}
+
+
+def set_values(buffer_name, values):
+    """Set the values ``threedi_value(buffer_name, "id")`` reads from
+
+    :param values: numpy array indexed by node or line id - 1, like the
+        arrays returned by ``ThreediResult.get_values_by_timestep_nr``. The
+        array is not copied, so don't modify it afterwards.
+    """
+    _buffers[buffer_name] = values
+
+
+def remove_values(buffer_name):
+    _buffers.pop(buffer_name, None)
+
+
+def get_expression(buffer_name):
+    """Return the expression for the virtual field of an animation layer"""
+    return "{}('{}', \"id\")".format(FUNCTION_NAME, buffer_name)
+
+
+@qgsfunction(args="auto", group="3Di", register=False)
+def threedi_value(buffer_name, object_id, feature, parent):
+    """
+    Returns the current animation value of a 3Di node or line.
+    <h4>Syntax</h4>
+    <p>threedi_value(<i>buffer</i>, <i>node or line id</i>)</p>
+    <h4>Example</h4>
+    <p>threedi_value('node_results_1234', "id")</p>
+    """
+    values = _buffers.get(buffer_name)
+    if values is None or object_id is None or not 0 < object_id <= len(values):
+        return None
+    value = float(values[object_id - 1])
+    if math.isnan(value):
+        return None
+    return value
+
+
+def register():
+    """Register ``threedi_value`` in the expression engine"""
+    if not QgsExpression.isFunctionName(FUNCTION_NAME):
+        QgsExpression.registerFunction(threedi_value)
+
+
+def unregister():
+    QgsExpression.unregisterFunction(FUNCTION_NAME)
+    _buffers.clear()
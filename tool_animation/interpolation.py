@@ -0,0 +1,79 @@
+"""Values of a result on the time axis of another result
+
+Results can have different output time steps. To animate several results on
+one time axis, the values of a result are linearly interpolated between its
+two timesteps around the shown moment.
+
+"""
+from collections import OrderedDict
+
+import numpy as np
+import threading
+
+
+# Number of timesteps per ResultValues that are kept in memory
+CACHE_SIZE = 8
+
+
+def get_interpolation_weights(timestamps, timestamp):
+    """Return how to interpolate the values at ``timestamp``
+
+    Before the first and after the last timestamp, the first and last
+    timestep are used.
+
+    :return: tuple (timestep, next timestep, weight of the next timestep)
+    """
+    timestamps = np.asarray(timestamps)
+    if timestamp <= timestamps[0]:
+        return 0, 0, 0.0
+    last = len(timestamps) - 1
+    if timestamp >= timestamps[last]:
+        return last, last, 0.0
+    next_timestep = int(np.searchsorted(timestamps, timestamp, side="right"))
+    timestep = next_timestep - 1
+    weight = (timestamp - timestamps[timestep]) / (
+        timestamps[next_timestep] - timestamps[timestep]
+    )
+    return timestep, next_timestep, float(weight)
+
+
+class ResultValues(object):
+    """Values of a ThreediResult interpolated onto another time axis
+
+    The values of the last :py:data:`CACHE_SIZE` timesteps are cached, so
+    consecutive frames between the same timesteps only cost the
+    interpolation. Can be used from several threads.
+    """
+
+    def __init__(self, threedi_result, cache_size=CACHE_SIZE):
+        self.threedi_result = threedi_result
+        self.timestamps = np.asarray(threedi_result.get_timestamps())
+        self.cache_size = cache_size
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_values(self, parameter, timestep_nr):
+        """Return the values of a timestep of the result itself"""
+        key = (parameter, timestep_nr)
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                return self._values[key]
+        values = self.threedi_result.get_values_by_timestep_nr(parameter, timestep_nr)
+        if isinstance(values, np.ma.MaskedArray):
+            values = values.filled(np.NaN)
+        with self._lock:
+            self._values[key] = values
+            while len(self._values) > self.cache_size:
+                self._values.popitem(last=False)
+        return values
+
+    def get_interpolated_values(self, parameter, timestamp):
+        """Return the values at ``timestamp`` (seconds since the start)"""
+        timestep, next_timestep, weight = get_interpolation_weights(
+            self.timestamps, timestamp
+        )
+        values = self.get_values(parameter, timestep)
+        if weight == 0.0:
+            return values
+        return values + weight * (self.get_values(parameter, next_timestep) - values)
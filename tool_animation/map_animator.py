@@ -1,43 +1,510 @@
 import copy
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from qgis.core import Qgis
+from qgis.core import QgsCoordinateTransform
+from qgis.core import QgsFeatureRequest
 from qgis.core import QgsField
 from qgis.core import QgsProject
-from qgis.core import QgsVectorLayer
-from qgis.core import QgsWkbTypes
+from qgis.core import QgsReadWriteContext
+from qgis.core import QgsSpatialIndex
+from qgis.PyQt.QtCore import QSettings
 from qgis.PyQt.QtCore import QVariant
+from qgis.PyQt.QtWidgets import QCheckBox
 from qgis.PyQt.QtWidgets import QComboBox
 from qgis.PyQt.QtWidgets import QHBoxLayout
+from qgis.PyQt.QtWidgets import QMenu
 from qgis.PyQt.QtWidgets import QPushButton
+from qgis.PyQt.QtWidgets import QSpinBox
+from qgis.PyQt.QtWidgets import QToolButton
 from qgis.PyQt.QtWidgets import QWidget
+from qgis.PyQt.QtXml import QDomDocument
+from ThreeDiToolbox.tool_animation import expressions
+from ThreeDiToolbox.tool_animation.interpolation import ResultValues
+from ThreeDiToolbox.tool_animation.playback import AnimationPlayer
+from ThreeDiToolbox.tool_animation.playback import DEFAULT_FPS
+from ThreeDiToolbox.tool_animation.playback import MAX_FPS
+from ThreeDiToolbox.tool_animation.raster import RasterAnimation
+from ThreeDiToolbox.utils.layer_from_netCDF import create_memory_flowline_layer
+from ThreeDiToolbox.utils.layer_from_netCDF import create_memory_node_layer
+from ThreeDiToolbox.utils.user_messages import messagebar_message
 from ThreeDiToolbox.utils.utils import generate_parameter_config
 
+import html
 import logging
 import numpy as np
 import os
+import re
 
 
 logger = logging.getLogger(__name__)
 
+#: QSettings key of the option to render the animation through expressions
+EXPRESSION_RENDERING_SETTING = "animation_expression_rendering"
+#: QSettings key of the option to only update features that change class
+ANIMATION_INCREMENTAL_UPDATES_SETTING = "animation_incremental_updates"
 
-def copy_layer_into_memory_layer(source_layer, layer_name):
+# Maximum number of results that are animated next to the active result
+MAX_COMPARED_RESULTS = 4
 
-    source_provider = source_layer.dataProvider()
+GROUNDWATER_LINE_TYPES = ("2d_groundwater", "1d_2d_groundwater")
+GROUNDWATER_NODE_TYPES = ("2d_groundwater", "2d_groundwater_bound")
 
-    uri = "{0}?crs=EPSG:{1}".format(
-        QgsWkbTypes.displayString(source_provider.wkbType()).lstrip("WKB"),
-        str(source_provider.crs().postgisSrid()),
+ANIMATION_LAYER_STYLES = {
+    "line_results": "line_discharge.qml",
+    "line_results_groundwater": "line_groundwater_velocity.qml",
+    "node_results": "node_waterlevel_diff.qml",
+    "node_results_groundwater": "node_groundwaterlevel_diff.qml",
+}
+
+# Comparison of the result field with a constant in a renderer, e.g. in the
+# filter of a rule or the expression of a data defined symbol property
+RESULT_COMPARISON = re.compile(
+    r'"result"\s*(?:<=|>=|<>|!=|<|>|=)\s*(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)'
+)
+RESULT_RANGE = re.compile(r'<range [^>]*lower="([^"]+)" upper="([^"]+)"')
+
+
+def expression_rendering_enabled():
+    """Return whether the animation layers read their values via expressions
+
+    If enabled (the default), the ``result`` field of the animation layers is
+    a virtual field reading the values from numpy arrays (see
+    :py:mod:`ThreeDiToolbox.tool_animation.expressions`) instead of an
+    attribute that is rewritten on every timestep.
+    """
+    settings = QSettings("3di", "qgisplugin")
+    return settings.value(EXPRESSION_RENDERING_SETTING, True, type=bool)
+
+
+def animation_incremental_updates_enabled():
+    """Return whether the animation only updates features that change class
+
+    If enabled (the default), a timestep change only updates the features
+    whose value crosses a class boundary of the layer style and only repaints
+    if any feature did. The ``result`` attribute of the other features keeps
+    the value of an earlier timestep within the same class.
+    """
+    settings = QSettings("3di", "qgisplugin")
+    return settings.value(ANIMATION_INCREMENTAL_UPDATES_SETTING, True, type=bool)
+
+
+def get_class_bounds(renderer_xml):
+    """Return the values of ``result`` at which the rendering changes
+
+    :param renderer_xml: xml of the renderer of a layer
+    :return: sorted numpy array, or None if the renderer uses ``result`` in
+        another way than comparing it with constants (or graduated ranges)
+    """
+    text = html.unescape(renderer_xml)
+    if 'attr="result"' in text:
+        if 'type="graduatedSymbol"' not in text:
+            return None
+        ranges = RESULT_RANGE.findall(text)
+        bounds = [float(value) for value_range in ranges for value in value_range]
+        text = text.replace('attr="result"', "")
+    else:
+        bounds = []
+    comparisons = RESULT_COMPARISON.findall(text)
+    if text.count('"result"') != len(comparisons):
+        return None
+    bounds += [float(value) for value in comparisons]
+    return np.unique(np.array(bounds, dtype=float))
+
+
+def get_layer_class_bounds(layer):
+    """Return the class bounds of the style of ``layer``, see get_class_bounds"""
+    if layer.labelsEnabled():
+        # the labels might show the value
+        return None
+    document = QDomDocument()
+    document.appendChild(layer.renderer().save(document, QgsReadWriteContext()))
+    return get_class_bounds(document.toString())
+
+
+def get_class_indices(values, bounds):
+    """Return an array with the class of each value
+
+    Values on a bound get a class of their own, as the renderer can include
+    or exclude the bound. NaN values (NULL) get class -1.
+    """
+    classes = np.digitize(values, bounds) + np.digitize(values, bounds, right=True)
+    classes[np.isnan(values)] = -1
+    return classes
+
+
+def get_value_index(layer):
+    """Return the feature ids of ``layer`` and their index in the result arrays
+
+    The ``id`` attribute is the node or line id. The arrays returned by
+    ``get_values_by_timestep_nr`` skip the trash element (index 0), so the
+    index of an id is ``id - 1``.
+
+    :return: tuple (list of feature ids, numpy array of value indexes)
+    """
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(["id"], layer.fields())
+    feature_ids = []
+    ids = []
+    for feature in layer.getFeatures(request):
+        feature_ids.append(feature.id())
+        ids.append(feature["id"])
+    return feature_ids, np.array(ids, dtype=np.int64) - 1
+
+
+def write_values(layer, value_index, values, positions=None):
+    """Write ``values`` into the ``result`` attribute of ``layer``
+
+    :param value_index: the result of :py:func:`get_value_index` for the layer
+    :param positions: optional array with the positions in ``value_index`` of
+        the features to write, all features by default
+    """
+    field_index = layer.fields().lookupField("result")
+    feature_ids, indexes = value_index
+    if positions is not None:
+        feature_ids = np.asarray(feature_ids)[positions].tolist()
+        indexes = indexes[positions]
+    values = values[indexes].astype(float).tolist()
+    update_dict = {
+        feature_id: {field_index: value}
+        for feature_id, value in zip(feature_ids, values)
+    }
+    layer.dataProvider().changeAttributeValues(update_dict)
+
+
+class ExtentValueWriter(object):
+    """Writes the animation values of the features within the map extent
+
+    Writing the values of every feature of a large model is what makes a
+    timestep change slow when the ``result`` field is an attribute. Only the
+    features in the map extent (looked up in a spatial index) are written. The
+    other features get the values of the current timestep when they come into
+    view, see :py:meth:`write_stale`.
+
+    :param class_bounds: optional class bounds of the layer style (see
+        :py:func:`get_class_bounds`). If given, only the features whose class
+        changed are written.
+    """
+
+    def __init__(self, layer, class_bounds=None):
+        self.layer = layer
+        self.class_bounds = class_bounds
+        feature_ids, indexes = get_value_index(layer)
+        self.value_index = (np.array(feature_ids, dtype=np.int64), indexes)
+        self._sorter = np.argsort(self.value_index[0])
+        self.spatial_index = QgsSpatialIndex(layer.getFeatures())
+        self.values = None
+        # features that don't have the values of the current timestep yet
+        self.stale = np.ones(len(feature_ids), dtype=bool)
+        # class of the current and of the written values, with class_bounds
+        self.classes = None
+        self.written_classes = np.full(len(feature_ids), -2)
+
+    def get_positions(self, extent):
+        """Return the positions in ``value_index`` of the features in extent
+
+        :param extent: QgsRectangle in the CRS of the layer
+        """
+        feature_ids = np.array(self.spatial_index.intersects(extent), dtype=np.int64)
+        return self._sorter[
+            np.searchsorted(self.value_index[0], feature_ids, sorter=self._sorter)
+        ]
+
+    def write(self, values, extent):
+        """Write the values of a new timestep for the features in extent
+
+        :return: whether any feature was written
+        """
+        self.values = values
+        if self.class_bounds is None:
+            self.stale[:] = True
+        else:
+            self.classes = get_class_indices(
+                values[self.value_index[1]], self.class_bounds
+            )
+            self.stale = self.classes != self.written_classes
+        return self.write_stale(extent)
+
+    def reset(self, class_bounds=None):
+        """Write all features again, e.g. after a style change"""
+        self.class_bounds = class_bounds
+        self.classes = None
+        self.written_classes[:] = -2
+        self.stale[:] = True
+
+    def write_stale(self, extent):
+        """Write the current values of the stale features in extent
+
+        :return: whether any feature was written
+        """
+        if self.values is None:
+            return False
+        positions = self.get_positions(extent)
+        positions = positions[self.stale[positions]]
+        if positions.size == 0:
+            return False
+        write_values(self.layer, self.value_index, self.values, positions)
+        self.stale[positions] = False
+        if self.classes is not None:
+            self.written_classes[positions] = self.classes[positions]
+        return True
+
+
+def _filled(values):
+    if isinstance(values, np.ma.MaskedArray):
+        return values.filled(np.NaN)
+    return values
+
+
+class DiffReference(object):
+    """The values the "diff" animation statistic is the difference with
+
+    By default this is the first timestep of the animated result. It can be
+    another timestep (``timestep_nr``) or the same moment in another result of
+    the same model (``threedi_result``), e.g. to animate the difference between
+    two scenarios. The values of another result are interpolated onto the
+    time axis of the animated result.
+
+    The reference values are cached per (result, variable, timestep), so a
+    difference animation costs one subtraction per frame.
+    """
+
+    def __init__(self, timestep_nr=0, threedi_result=None):
+        self.timestep_nr = timestep_nr
+        self.threedi_result = threedi_result
+        self._values = {}
+        self._result_values = None
+        if threedi_result is not None:
+            self._result_values = ResultValues(threedi_result)
+
+    def get_values(self, threedi_result, parameter, timestep_nr):
+        """Return the reference values of ``parameter`` for a timestep"""
+        if self._result_values is not None:
+            timestamp = threedi_result.timestamps[timestep_nr]
+            return self._result_values.get_interpolated_values(parameter, timestamp)
+        key = (str(threedi_result.file_path), parameter, self.timestep_nr)
+        values = self._values.get(key)
+        if values is None:
+            values = _filled(
+                threedi_result.get_values_by_timestep_nr(parameter, self.timestep_nr)
+            )
+            self._values[key] = values
+        return values
+
+    def get_interpolated_values(
+        self, threedi_result, result_values, parameter, timestep_nr
+    ):
+        """Return the reference values of a result shown next to the animated one
+
+        The values of the compared result (``result_values``, see
+        :py:class:`ComparedResult`) are interpolated onto the time axis of the
+        animated ``threedi_result``, so the reference timestep is a moment of
+        the animated result as well.
+        """
+        if self._result_values is not None:
+            return self.get_values(threedi_result, parameter, timestep_nr)
+        timestamp = float(threedi_result.timestamps[self.timestep_nr])
+        key = (str(result_values.threedi_result.file_path), parameter, timestamp)
+        values = self._values.get(key)
+        if values is None:
+            values = result_values.get_interpolated_values(parameter, timestamp)
+            self._values[key] = values
+        return values
+
+
+def get_frame_values(threedi_result, parameter, stat, timestep_nr, reference=None):
+    """Return the values of ``parameter`` to show for a timestep
+
+    :param stat: "diff" for the difference with the ``reference``, "act" for
+        the actual value
+    :param reference: :py:class:`DiffReference`, defaults to the first
+        timestep of ``threedi_result``. Pass the same instance for every frame
+        to reuse the cached reference values.
+    """
+    values = _filled(threedi_result.get_values_by_timestep_nr(parameter, timestep_nr))
+    if stat == "diff":
+        if reference is None:
+            reference = DiffReference()
+        reference_values = reference.get_values(threedi_result, parameter, timestep_nr)
+        if reference_values.shape != values.shape:
+            raise ValueError(
+                "The reference result of %s has %s values instead of %s"
+                % (parameter, reference_values.shape[0], values.shape[0])
+            )
+        values = values - reference_values
+    # updated to act for actual, display actual value
+    elif stat == "act":
+        values = values  # removed np.fabs(values) to get actual value
+    return values
+
+
+def _type_filter(type_names, exclude=False):
+    """Return a function selecting the features of one of ``type_names``"""
+
+    def type_filter(types):
+        mask = np.zeros(len(types), dtype=bool)
+        for type_name in type_names:
+            mask |= types == type_name
+        return ~mask if exclude else mask
+
+    return type_filter
+
+
+def _create_animation_layer(
+    threedi_result, layer_name, create_layer, type_filter, expression_rendering
+):
+    """Return a memory layer with a ``result`` field for the animation
+
+    The layer is built from the gridadmin arrays: only the features that pass
+    the ``type_filter`` are added.
+    """
+    if expression_rendering:
+        layer = create_layer(threedi_result, layer_name, type_filter)
+        layer.addExpressionField(
+            expressions.get_expression(layer.id()),
+            QgsField("result", QVariant.Double),
+        )
+    else:
+        layer = create_layer(
+            threedi_result, layer_name, type_filter, extra_fields=["result DOUBLE"]
+        )
+    layer.loadNamedStyle(
+        os.path.join(
+            os.path.dirname(os.path.realpath(__file__)),
+            os.path.pardir,
+            "layer_styles",
+            "tools",
+            ANIMATION_LAYER_STYLES[layer_name],
+        )
+    )
+    return layer
+
+
+def create_animation_layers(threedi_result, expression_rendering=True):
+    """Return the styled animation layers of a ThreediResult
+
+    :return: tuple of the line, groundwater line, node and groundwater node
+        layers, each with a ``result`` field
+    """
+    return (
+        _create_animation_layer(
+            threedi_result,
+            "line_results",
+            create_memory_flowline_layer,
+            _type_filter(GROUNDWATER_LINE_TYPES, exclude=True),
+            expression_rendering,
+        ),
+        _create_animation_layer(
+            threedi_result,
+            "line_results_groundwater",
+            create_memory_flowline_layer,
+            _type_filter(GROUNDWATER_LINE_TYPES),
+            expression_rendering,
+        ),
+        _create_animation_layer(
+            threedi_result,
+            "node_results",
+            create_memory_node_layer,
+            _type_filter(GROUNDWATER_NODE_TYPES, exclude=True),
+            expression_rendering,
+        ),
+        _create_animation_layer(
+            threedi_result,
+            "node_results_groundwater",
+            create_memory_node_layer,
+            _type_filter(GROUNDWATER_NODE_TYPES),
+            expression_rendering,
+        ),
     )
 
-    dest_layer = QgsVectorLayer(uri, layer_name, "memory")
-    dest_provider = dest_layer.dataProvider()
 
-    dest_provider.addAttributes(source_provider.fields())
-    dest_layer.updateFields()
+def get_layer_parameters(layers, node_parameter, line_parameter):
+    """Return (layer, parameter, stat) of the line, groundwater line, node and
+    groundwater node animation layers (as returned by create_animation_layers)
+    """
+    line_layer, line_layer_groundwater, node_layer, node_layer_groundwater = layers
+    # stat "act" for actual: display actual value
+    return (
+        (node_layer, node_parameter, "diff"),
+        (line_layer, line_parameter, "act"),
+        (node_layer_groundwater, node_parameter, "diff"),
+        (line_layer_groundwater, line_parameter, "act"),
+    )
+
 
-    dest_provider.addFeatures([f for f in source_provider.getFeatures()])
-    dest_layer.updateExtents()
+class ComparedResult(object):
+    """Animation layers of another result, shown next to the animated result
 
-    return dest_layer
+    The values are interpolated at the moments of the timesteps of the
+    animated result, so both are driven by the same time slider. The layers
+    always read their values through the ``threedi_value()`` expression.
+    """
+
+    def __init__(self, name, threedi_result):
+        self.name = name
+        self.result_values = ResultValues(threedi_result)
+        self.layers = create_animation_layers(threedi_result)
+        self.group_name = "animation_layers: %s" % name
+
+    def add_to_project(self):
+        root = QgsProject.instance().layerTreeRoot()
+        group = root.findGroup(self.group_name)
+        if group is None:
+            group = root.insertGroup(1, self.group_name)
+        group.removeAllChildren()
+        for i, layer in enumerate(self.layers):
+            QgsProject.instance().addMapLayer(layer, False)
+            group.insertLayer(i, layer)
+
+    def remove_from_project(self):
+        for layer in self.layers:
+            expressions.remove_values(layer.id())
+        QgsProject.instance().removeMapLayers([layer.id() for layer in self.layers])
+        root = QgsProject.instance().layerTreeRoot()
+        group = root.findGroup(self.group_name)
+        if group is not None:
+            root.removeChildNode(group)
+
+    def load_frame(self, parameters, threedi_result, timestep_nr, reference=None):
+        """Return the values per (parameter, stat) at a timestep of the animation
+
+        Only numpy work, so this can run on a worker thread.
+
+        :param threedi_result: the animated ThreediResult
+        :param timestep_nr: the timestep of ``threedi_result`` to show
+        :param reference: the :py:class:`DiffReference` of the animation for
+            the "diff" stat, defaults to the first timestep
+        :raises ValueError: if the values don't match those of the reference
+        """
+        if reference is None:
+            reference = DiffReference()
+        timestamp = threedi_result.timestamps[timestep_nr]
+        values_per_parameter = {}
+        for parameter, stat in parameters:
+            values = self.result_values.get_interpolated_values(parameter, timestamp)
+            if stat == "diff":
+                reference_values = reference.get_interpolated_values(
+                    threedi_result, self.result_values, parameter, timestep_nr
+                )
+                if reference_values.shape != values.shape:
+                    raise ValueError(
+                        "The reference result of %s has %s values instead of %s"
+                        % (parameter, reference_values.shape[0], values.shape[0])
+                    )
+                values = values - reference_values
+            values_per_parameter[(parameter, stat)] = values
+        return values_per_parameter
+
+    def show_frame(self, node_parameter, line_parameter, values_per_parameter):
+        """Show the values returned by :py:meth:`load_frame`"""
+        for layer, parameter, stat in get_layer_parameters(
+            self.layers, node_parameter, line_parameter
+        ):
+            expressions.set_values(layer.id(), values_per_parameter[(parameter, stat)])
+            layer.triggerRepaint()
 
 
 class MapAnimator(QWidget):
@@ -66,15 +533,43 @@ class MapAnimator(QWidget):
         self.line_layer = None
         self.line_layer_groundwater = None
         self.node_layer_groundwater = None
+        # ExtentValueWriter per layer id, if the result field is an attribute
+        self.value_writers = {}
+        # class bounds and class indices of the shown values per layer id, if
+        # only class changes are updated
+        self.class_bounds = {}
+        self.shown_classes = {}
+        # RasterAnimation of the 2D nodes, if the raster mode is on
+        self.raster_animation = None
+        # ComparedResult per file path of the results shown side by side
+        self.compared_results = OrderedDict()
+        self._compare_executor = ThreadPoolExecutor(max_workers=MAX_COMPARED_RESULTS)
+        self.expression_rendering = expression_rendering_enabled()
+        self.diff_reference = DiffReference()
         self.state = False
         self.setup_ui()
+        self.player = AnimationPlayer(
+            self.load_frame,
+            self.show_played_frame,
+            is_busy=self.iface.mapCanvas().isDrawing,
+            get_context=self.get_frame_context,
+            parent=self,
+        )
 
         # set initial state
         self.line_parameter_combo_box.setEnabled(False)
         self.node_parameter_combo_box.setEnabled(False)
+        self.reference_combo_box.setEnabled(False)
+        self.rasterCheckBox.setEnabled(False)
+        self.compareButton.setEnabled(False)
+        self.set_playback_enabled(False)
 
         # connect to signals
         self.activateButton.clicked.connect(self.set_activation_state)
+        self.playButton.toggled.connect(self.on_play_toggled)
+        self.loopCheckBox.toggled.connect(self.on_loop_toggled)
+        self.fpsSpinBox.valueChanged.connect(self.player.set_fps)
+        self.player.finished.connect(self.on_playback_finished)
 
         self.state_connectiong_set = False
 
@@ -84,10 +579,19 @@ class MapAnimator(QWidget):
         self.node_parameter_combo_box.currentIndexChanged.connect(
             self.on_node_parameter_change
         )
+        self.reference_combo_box.activated.connect(self.on_reference_change)
+        self.rasterCheckBox.toggled.connect(self.on_raster_toggled)
+        self.root_tool.ts_datasources.results_change.connect(
+            self.populate_reference_combo_box
+        )
+        self.root_tool.ts_datasources.results_change.connect(
+            self.populate_compare_menu
+        )
 
         self.root_tool.timeslider_widget.datasource_changed.connect(
             self.on_active_ts_datasource_change
         )
+        self.iface.mapCanvas().extentsChanged.connect(self.on_extents_changed)
 
         self.on_active_ts_datasource_change()
 
@@ -99,6 +603,7 @@ class MapAnimator(QWidget):
         ]
 
         if old_parameter != self.current_line_parameter:
+            self.player.invalidate()
             self.update_results()
 
     def on_node_parameter_change(self):
@@ -108,10 +613,147 @@ class MapAnimator(QWidget):
         ]
 
         if old_parameter != self.current_node_parameter:
+            self.player.invalidate()
             self.update_results()
 
+    def populate_reference_combo_box(self, *args):
+        """Fill the reference options of the "diff" statistic
+
+        The options are the first timestep, the timestep shown at the moment
+        of selecting and the other loaded results.
+        """
+        active_ts_datasource = self.root_tool.timeslider_widget.active_ts_datasource
+        self.reference_combo_box.blockSignals(True)
+        self.reference_combo_box.clear()
+        self.reference_combo_box.addItem("Diff with first timestep", None)
+        self.reference_combo_box.addItem("Diff with current timestep", "current")
+        for row in self.root_tool.ts_datasources.rows:
+            if row is active_ts_datasource:
+                continue
+            self.reference_combo_box.addItem("Diff with %s" % row.name.value, row)
+        self.reference_combo_box.blockSignals(False)
+        # the reference result can be removed: fall back to the first timestep
+        self.diff_reference = DiffReference()
+
+    def populate_compare_menu(self, *args):
+        """Fill the menu with the results that can be shown side by side"""
+        active_ts_datasource = self.root_tool.timeslider_widget.active_ts_datasource
+        rows = [
+            row
+            for row in self.root_tool.ts_datasources.rows
+            if row is not active_ts_datasource
+        ]
+        # forget the compared results that are no longer loaded
+        file_paths = [row.file_path.value for row in rows]
+        for key in list(self.compared_results):
+            if key not in file_paths:
+                self.compared_results.pop(key).remove_from_project()
+        self.compare_menu.clear()
+        for row in rows:
+            action = self.compare_menu.addAction(row.name.value)
+            action.setCheckable(True)
+            action.setChecked(row.file_path.value in self.compared_results)
+            action.toggled.connect(partial(self.on_compare_toggled, row))
+        self.compareButton.setEnabled(self.state and bool(rows))
+
+    def on_compare_toggled(self, row, checked):
+        """Show or remove the animation layers of another result"""
+        key = row.file_path.value
+        if checked and key not in self.compared_results:
+            if len(self.compared_results) >= MAX_COMPARED_RESULTS:
+                messagebar_message(
+                    "Animation",
+                    "At most %s results can be compared" % MAX_COMPARED_RESULTS,
+                    level=Qgis.Warning,
+                    duration=5,
+                )
+                self.populate_compare_menu()
+                return
+            compared_result = ComparedResult(row.name.value, row.threedi_result())
+            parameters = {
+                (parameter, stat) for _, parameter, stat in self._get_layer_parameters()
+            }
+            timeslider = self.root_tool.timeslider_widget
+            try:
+                compared_result.load_frame(
+                    parameters,
+                    timeslider.active_ts_datasource.threedi_result(),
+                    timeslider.value(),
+                    self.diff_reference,
+                )
+            except (KeyError, ValueError):
+                logger.exception("Can't animate %s", key)
+                messagebar_message(
+                    "Animation",
+                    "%s lacks the animated variables or doesn't match the "
+                    "reference" % row.name.value,
+                    level=Qgis.Warning,
+                    duration=5,
+                )
+                self.populate_compare_menu()
+                return
+            compared_result.add_to_project()
+            self.compared_results[key] = compared_result
+        elif not checked and key in self.compared_results:
+            self.compared_results.pop(key).remove_from_project()
+        self.player.invalidate()
+        self.update_results()
+
+    def on_reference_change(self, index):
+        data = self.reference_combo_box.itemData(index)
+        timeslider = self.root_tool.timeslider_widget
+        if data is None:
+            reference = DiffReference()
+        elif data == "current":
+            reference = DiffReference(timeslider.value())
+        else:
+            reference = DiffReference(threedi_result=data.threedi_result())
+            if not self._is_valid_reference(reference):
+                messagebar_message(
+                    "Animation",
+                    "%s can't be used as reference: it is not a result of the "
+                    "same model or lacks the variable." % data.name.value,
+                    level=Qgis.Warning,
+                    duration=5,
+                )
+                self.reference_combo_box.setCurrentIndex(0)
+                reference = DiffReference()
+        self.diff_reference = reference
+        self.player.invalidate()
+        self.update_results()
+
+    def _is_valid_reference(self, reference):
+        """Return whether the node values can be compared with ``reference``
+
+        This includes the node values of the compared results.
+        """
+        if self.current_node_parameter is None:
+            return True
+        timeslider = self.root_tool.timeslider_widget
+        threedi_result = timeslider.active_ts_datasource.threedi_result()
+        parameter = self.current_node_parameter["parameters"]
+        try:
+            get_frame_values(
+                threedi_result, parameter, "diff", timeslider.value(), reference
+            )
+            for compared_result in self.compared_results.values():
+                compared_result.load_frame(
+                    [(parameter, "diff")],
+                    threedi_result,
+                    timeslider.value(),
+                    reference,
+                )
+        except (KeyError, ValueError):
+            logger.exception("Invalid animation reference")
+            return False
+        return True
+
     def on_active_ts_datasource_change(self):
         # reset
+        self.playButton.setChecked(False)
+        self.player.stop()
+        self.populate_reference_combo_box()
+        self.populate_compare_menu()
         parameter_config = self._get_active_parameter_config()
 
         for combo_box, parameters, pc in (
@@ -148,7 +790,8 @@ class MapAnimator(QWidget):
         active_ts_datasource = self.root_tool.timeslider_widget.active_ts_datasource
 
         if active_ts_datasource is not None:
-            # TODO: just taking the first datasource, not sure if correct:
+            # the parameters of the result the timeslider animates, which is
+            # also the result the animation layers are prepared for
             threedi_result = active_ts_datasource.threedi_result()
             available_subgrid_vars = threedi_result.available_subgrid_map_vars
             # Make a deepcopy because we don't want to change the cached variables
@@ -175,7 +818,11 @@ class MapAnimator(QWidget):
             if self.root_tool.ts_datasources.rowCount() > 0:
                 self.line_parameter_combo_box.setEnabled(True)
                 self.node_parameter_combo_box.setEnabled(True)
+                self.reference_combo_box.setEnabled(True)
+                self.rasterCheckBox.setEnabled(True)
+                self.set_playback_enabled(True)
                 self.prepare_animation_layers()
+                self.populate_compare_menu()
                 self.root_tool.timeslider_widget.sliderReleased.connect(
                     self.update_results
                 )
@@ -185,6 +832,11 @@ class MapAnimator(QWidget):
         else:
             self.line_parameter_combo_box.setEnabled(False)
             self.node_parameter_combo_box.setEnabled(False)
+            self.reference_combo_box.setEnabled(False)
+            self.rasterCheckBox.setEnabled(False)
+            self.compareButton.setEnabled(False)
+            self.playButton.setChecked(False)
+            self.set_playback_enabled(False)
 
             if self.state_connection_set:
                 # remove listeners
@@ -202,112 +854,13 @@ class MapAnimator(QWidget):
             # todo: react on datasource change
             return
 
-        line, node, pump = result.get_result_layers()
-
-        # lines without groundwater results
-        self.line_layer = copy_layer_into_memory_layer(line, "line_results")
-        self.line_layer.dataProvider().addAttributes(
-            [QgsField("result", QVariant.Double)]
-        )
-        features = self.line_layer.getFeatures()
-        ids = [
-            f.id()
-            for f in features
-            if f.attribute("type") == "2d_groundwater"
-            or f.attribute("type") == "1d_2d_groundwater"
-        ]
-        self.line_layer.dataProvider().deleteFeatures(ids)
-        self.line_layer.updateFields()
-
-        # lines with groundwater results
-        self.line_layer_groundwater = copy_layer_into_memory_layer(
-            line, "line_results_groundwater"
-        )
-        self.line_layer_groundwater.dataProvider().addAttributes(
-            [QgsField("result", QVariant.Double)]
-        )
-        features = self.line_layer_groundwater.getFeatures()
-        ids = [
-            f.id()
-            for f in features
-            if f.attribute("type") != "2d_groundwater"
-            and f.attribute("type") != "1d_2d_groundwater"
-        ]
-        self.line_layer_groundwater.dataProvider().deleteFeatures(ids)
-        self.line_layer_groundwater.updateFields()
-
-        # nodes without groundwater results
-        self.node_layer = copy_layer_into_memory_layer(node, "node_results")
-        self.node_layer.dataProvider().addAttributes(
-            [QgsField("result", QVariant.Double)]
-        )
-        features = self.node_layer.getFeatures()
-        ids = [
-            f.id()
-            for f in features
-            if f.attribute("type") == "2d_groundwater"
-            or f.attribute("type") == "2d_groundwater_bound"
-        ]
-        self.node_layer.dataProvider().deleteFeatures(ids)
-        self.node_layer.updateFields()
-
-        # nodes with groundwater results
-        self.node_layer_groundwater = copy_layer_into_memory_layer(
-            node, "node_results_groundwater"
-        )
-        self.node_layer_groundwater.dataProvider().addAttributes(
-            [QgsField("result", QVariant.Double)]
-        )
-        features = self.node_layer_groundwater.getFeatures()
-        ids = [
-            f.id()
-            for f in features
-            if f.attribute("type") != "2d_groundwater"
-            and f.attribute("type") != "2d_groundwater_bound"
-        ]
-        self.node_layer_groundwater.dataProvider().deleteFeatures(ids)
-        self.node_layer_groundwater.updateFields()
-
-        # todo: add this layers to the correct location
-        self.line_layer.loadNamedStyle(
-            os.path.join(
-                os.path.dirname(os.path.realpath(__file__)),
-                os.path.pardir,
-                "layer_styles",
-                "tools",
-                "line_discharge.qml",
-            )
-        )
-
-        self.line_layer_groundwater.loadNamedStyle(
-            os.path.join(
-                os.path.dirname(os.path.realpath(__file__)),
-                os.path.pardir,
-                "layer_styles",
-                "tools",
-                "line_groundwater_velocity.qml",
-            )
-        )
-
-        self.node_layer.loadNamedStyle(
-            os.path.join(
-                os.path.dirname(os.path.realpath(__file__)),
-                os.path.pardir,
-                "layer_styles",
-                "tools",
-                "node_waterlevel_diff.qml",
-            )
-        )
-
-        self.node_layer_groundwater.loadNamedStyle(
-            os.path.join(
-                os.path.dirname(os.path.realpath(__file__)),
-                os.path.pardir,
-                "layer_styles",
-                "tools",
-                "node_groundwaterlevel_diff.qml",
-            )
-        )
+        self.expression_rendering = expression_rendering_enabled()
+        (
+            self.line_layer,
+            self.line_layer_groundwater,
+            self.node_layer,
+            self.node_layer_groundwater,
+        ) = create_animation_layers(result.threedi_result(), self.expression_rendering)
 
         root = QgsProject.instance().layerTreeRoot()
 
@@ -327,64 +880,270 @@ class MapAnimator(QWidget):
         animation_group.insertLayer(2, self.node_layer)
         animation_group.insertLayer(3, self.node_layer_groundwater)
 
-    def update_results(self):
-        if not self.state:
+        layers = (
+            self.line_layer,
+            self.line_layer_groundwater,
+            self.node_layer,
+            self.node_layer_groundwater,
+        )
+        for layer in layers:
+            layer.rendererChanged.connect(self.on_renderer_changed)
+        self.update_class_bounds()
+        if not self.expression_rendering:
+            self.value_writers = {
+                layer.id(): ExtentValueWriter(layer, self.class_bounds[layer.id()])
+                for layer in layers
+            }
+        if self.rasterCheckBox.isChecked():
+            self.enable_raster()
+
+    def on_raster_toggled(self, checked):
+        if self.node_layer is None:
             return
+        if checked:
+            self.enable_raster()
+        else:
+            self.disable_raster()
+        self.player.invalidate()
+        self.update_results()
 
+    def enable_raster(self):
+        """Show the 2D nodes as a raster of their cells instead of points"""
+        if self.raster_animation is not None:
+            return
         result = self.root_tool.timeslider_widget.active_ts_datasource
+        self.raster_animation = RasterAnimation(
+            result.threedi_result(), "node_results_raster", self.node_layer.renderer()
+        )
+        QgsProject.instance().addMapLayer(self.raster_animation.layer, False)
+        animation_group = QgsProject.instance().layerTreeRoot().findGroup(
+            "animation_layers"
+        )
+        if animation_group is not None:
+            animation_group.addLayer(self.raster_animation.layer)
+        self.node_layer.setSubsetString("\"type\" != '2d'")
 
-        timestep_nr = self.root_tool.timeslider_widget.value()
-
-        threedi_result = result.threedi_result()
-
-        for layer, parameter, stat in (
-            (self.node_layer, self.current_node_parameter["parameters"], "diff"),
-            (self.line_layer, self.current_line_parameter["parameters"], "act"),
+    def disable_raster(self):
+        if self.raster_animation is None:
+            return
+        QgsProject.instance().removeMapLayer(self.raster_animation.layer.id())
+        self.raster_animation.remove()
+        self.raster_animation = None
+        self.node_layer.setSubsetString("")
+
+    def update_class_bounds(self):
+        """Read the class bounds of the styles of the animation layers"""
+        incremental = animation_incremental_updates_enabled()
+        self.class_bounds = {}
+        for layer in (
+            self.line_layer,
+            self.line_layer_groundwater,
+            self.node_layer,
+            self.node_layer_groundwater,
+        ):
+            bounds = get_layer_class_bounds(layer) if incremental else None
+            self.class_bounds[layer.id()] = bounds
+        self.shown_classes = {}
+
+    def on_renderer_changed(self):
+        """Show all values again with the class bounds of the new style"""
+        self.update_class_bounds()
+        for layer_id, writer in self.value_writers.items():
+            writer.reset(self.class_bounds[layer_id])
+        self.update_results()
+
+    def _get_layer_parameters(self):
+        """Return (layer, parameter, stat) of the four animation layers"""
+        return get_layer_parameters(
             (
+                self.line_layer,
+                self.line_layer_groundwater,
+                self.node_layer,
                 self.node_layer_groundwater,
-                self.current_node_parameter["parameters"],
-                "diff",
             ),
-            (
-                self.line_layer_groundwater,
-                self.current_line_parameter["parameters"],
-                "act",
+            self.current_node_parameter["parameters"],
+            self.current_line_parameter["parameters"],
+        )
+
+    def get_frame_context(self):
+        """Return the state :py:meth:`load_frame` needs, on the main thread"""
+        return {
+            "threedi_result": (
+                self.root_tool.timeslider_widget.active_ts_datasource.threedi_result()
             ),
-        ):  # updated to act for actual, display actual value
+            "reference": self.diff_reference,
+            "parameters": [
+                (parameter, stat)
+                for _, parameter, stat in self._get_layer_parameters()
+            ],
+            "node_parameter": self.current_node_parameter["parameters"],
+            "raster_animation": self.raster_animation,
+            "compared_results": list(self.compared_results.items()),
+        }
+
+    def load_frame(self, timestep_nr, context=None):
+        """Return the values to show per (parameter, stat) for a timestep
+
+        Only numpy work, no Qt objects are touched, so this can run on a
+        worker thread (see :py:class:`AnimationPlayer`).
+
+        :param context: the state returned by :py:meth:`get_frame_context`,
+            which must be called on the main thread. Defaults to the current
+            state.
+        """
+        if context is None:
+            context = self.get_frame_context()
+        threedi_result = context["threedi_result"]
+        reference = context["reference"]
+        # the compared results are loaded in parallel with the animated one
+        parameters = set(context["parameters"])
+        compared_futures = {
+            key: self._compare_executor.submit(
+                compared_result.load_frame,
+                parameters,
+                threedi_result,
+                timestep_nr,
+                reference,
+            )
+            for key, compared_result in context["compared_results"]
+        }
+        values_per_parameter = {}
+        # the groundwater layers share the values with the other layers
+        for parameter, stat in context["parameters"]:
+            if (parameter, stat) in values_per_parameter:
+                continue
+            values = get_frame_values(
+                threedi_result, parameter, stat, timestep_nr, reference
+            )
+            values_per_parameter[(parameter, stat)] = values
+        raster_animation = context["raster_animation"]
+        if raster_animation is not None:
+            values = values_per_parameter[(context["node_parameter"], "diff")]
+            values_per_parameter["raster"] = (
+                raster_animation,
+                raster_animation.render(values),
+            )
+        values_per_parameter["compared"] = {
+            key: future.result() for key, future in compared_futures.items()
+        }
+        return values_per_parameter
+
+    def show_frame(self, timestep_nr, values_per_parameter):
+        """Show the values returned by :py:meth:`load_frame` on the layers
+
+        Layers are only repainted if the class of any of their features
+        changed, if their class bounds are known.
+        """
+        raster_animation, raster_frame = values_per_parameter.get(
+            "raster", (None, None)
+        )
+        if self.raster_animation is not None:
+            if raster_animation is not self.raster_animation:
+                # the raster mode was switched on after loading the frame
+                raster_frame = self.raster_animation.render(
+                    values_per_parameter[
+                        (self.current_node_parameter["parameters"], "diff")
+                    ]
+                )
+            self.raster_animation.show(raster_frame)
+        for layer, parameter, stat in self._get_layer_parameters():
+            values = values_per_parameter[(parameter, stat)]
+            if self.expression_rendering:
+                # the virtual result field reads straight from the array
+                expressions.set_values(layer.id(), values)
+                changed = self._classes_changed(layer, values)
+            else:
+                changed = self.value_writers[layer.id()].write(
+                    values, self._get_layer_extent(layer)
+                )
+            if changed:
+                # layer.setCacheImage(None)
+                layer.triggerRepaint()
+        for key, compared_values in values_per_parameter.get("compared", {}).items():
+            compared_result = self.compared_results.get(key)
+            if compared_result is not None:
+                compared_result.show_frame(
+                    self.current_node_parameter["parameters"],
+                    self.current_line_parameter["parameters"],
+                    compared_values,
+                )
 
-            provider = layer.dataProvider()
+    def _classes_changed(self, layer, values):
+        """Return whether the class of any value changed since the last call"""
+        bounds = self.class_bounds.get(layer.id())
+        if bounds is None:
+            return True
+        classes = get_class_indices(values, bounds)
+        previous_classes = self.shown_classes.get(layer.id())
+        self.shown_classes[layer.id()] = classes
+        return previous_classes is None or not np.array_equal(
+            classes, previous_classes
+        )
 
-            values = threedi_result.get_values_by_timestep_nr(parameter, timestep_nr)
-            if isinstance(values, np.ma.MaskedArray):
-                values = values.filled(np.NaN)
-            if stat == "diff":
-                values = values - threedi_result.get_values_by_timestep_nr(parameter, 0)
-            # updated to act for actual, display actual value
-            elif stat == "act":
-                values = values  # removed np.fabs(values) to get actual value
-
-            update_dict = {}
-            field_index = layer.fields().lookupField("result")
-
-            for feature in layer.getFeatures():
-                ids = int(feature.id())
-                # NOTE OF CAUTION: subtracting 1 from id  is mandatory for
-                # groundwater because those indexes start from 1 (something to
-                # do with a trash element), but for the non-groundwater version
-                # it is not. HOWEVER, due to some magic hackery in how the
-                # *_result layers are created/copied from the regular result
-                # layers, the resulting feature ids also start from 1, which
-                # why we need to subtract it in both cases, which btw is
-                # purely coincidental.
-                # TODO: to avoid all this BS this part should be refactored
-                # by passing the index to get_values_by_timestep_nr, which
-                # should take this into account
-                value = values[ids - 1]
-                update_dict[ids] = {field_index: float(value)}
-
-            provider.changeAttributeValues(update_dict)
-            # layer.setCacheImage(None)
-            layer.triggerRepaint()
+    def _get_layer_extent(self, layer):
+        """Return the map canvas extent in the CRS of ``layer``"""
+        canvas = self.iface.mapCanvas()
+        transform = QgsCoordinateTransform(
+            canvas.mapSettings().destinationCrs(), layer.crs(), QgsProject.instance()
+        )
+        return transform.transformBoundingBox(canvas.extent())
+
+    def on_extents_changed(self):
+        """Write the current values of the features that came into view"""
+        if not self.state or self.expression_rendering or not self.value_writers:
+            return
+        for layer, _, _ in self._get_layer_parameters():
+            writer = self.value_writers.get(layer.id())
+            if writer is not None and writer.write_stale(
+                self._get_layer_extent(layer)
+            ):
+                layer.triggerRepaint()
+
+    def update_results(self):
+        if not self.state:
+            return
+
+        timestep_nr = self.root_tool.timeslider_widget.value()
+        self.show_frame(timestep_nr, self.load_frame(timestep_nr))
+
+    def on_play_toggled(self, checked):
+        if not checked:
+            self.player.pause()
+            self.playButton.setText("Play")
+            return
+        if not self.state or self.node_layer is None:
+            self.playButton.setChecked(False)
+            return
+        self.playButton.setText("Pause")
+        timeslider = self.root_tool.timeslider_widget
+        self.player.loop = self.loopCheckBox.isChecked()
+        self.player.set_fps(self.fpsSpinBox.value())
+        self.player.play(timeslider.value(), timeslider.maximum() + 1)
+
+    def on_loop_toggled(self, checked):
+        self.player.loop = checked
+
+    def set_playback_enabled(self, enabled):
+        self.playButton.setEnabled(enabled)
+        self.loopCheckBox.setEnabled(enabled)
+        self.fpsSpinBox.setEnabled(enabled)
+
+    def on_playback_finished(self):
+        self.playButton.setChecked(False)
+
+    def show_played_frame(self, timestep_nr, values_per_parameter):
+        """Callback of the player: move the slider along and show the frame"""
+        self.root_tool.timeslider_widget.setValue(timestep_nr)
+        self.show_frame(timestep_nr, values_per_parameter)
+
+    def shutdown(self):
+        """Stop the playback and remove the extra layers, on plugin unload"""
+        self.player.shutdown()
+        self.disable_raster()
+        for compared_result in self.compared_results.values():
+            compared_result.remove_from_project()
+        self.compared_results.clear()
+        self._compare_executor.shutdown(wait=False)
 
     def activate_animator(self):
         pass
@@ -405,3 +1164,41 @@ class MapAnimator(QWidget):
 
         self.HLayout.addWidget(self.line_parameter_combo_box)
         self.HLayout.addWidget(self.node_parameter_combo_box)
+
+        self.reference_combo_box = QComboBox(self)
+        self.reference_combo_box.setToolTip(
+            "Reference of the node values: a timestep or another result"
+        )
+        self.HLayout.addWidget(self.reference_combo_box)
+
+        self.rasterCheckBox = QCheckBox("2D as raster", self)
+        self.rasterCheckBox.setToolTip(
+            "Show the 2D node values on a raster of the computational cells, "
+            "faster for large 2D models"
+        )
+        self.HLayout.addWidget(self.rasterCheckBox)
+
+        self.compareButton = QToolButton(self)
+        self.compareButton.setText("Compare")
+        self.compareButton.setToolTip(
+            "Animate other results side by side, on the time axis of this result"
+        )
+        self.compareButton.setPopupMode(QToolButton.InstantPopup)
+        self.compare_menu = QMenu(self.compareButton)
+        self.compareButton.setMenu(self.compare_menu)
+        self.HLayout.addWidget(self.compareButton)
+
+        self.playButton = QPushButton(self)
+        self.playButton.setCheckable(True)
+        self.playButton.setText("Play")
+        self.HLayout.addWidget(self.playButton)
+
+        self.loopCheckBox = QCheckBox("Loop", self)
+        self.HLayout.addWidget(self.loopCheckBox)
+
+        self.fpsSpinBox = QSpinBox(self)
+        self.fpsSpinBox.setRange(1, MAX_FPS)
+        self.fpsSpinBox.setValue(DEFAULT_FPS)
+        self.fpsSpinBox.setSuffix(" fps")
+        self.fpsSpinBox.setToolTip("Target frames per second of the playback")
+        self.HLayout.addWidget(self.fpsSpinBox)
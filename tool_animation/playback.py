@@ -0,0 +1,204 @@
+"""Playback of the animation: play/pause/loop with a target frame rate
+
+The :py:class:`AnimationPlayer` decides which timestep (frame) should be shown
+based on the elapsed wall clock time. When showing frames can't keep up with
+the target fps, frames are skipped instead of slowing the animation down. The
+values of the upcoming frames are loaded on a worker thread in the meantime.
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+from qgis.PyQt.QtCore import pyqtSignal
+from qgis.PyQt.QtCore import QObject
+from qgis.PyQt.QtCore import QTimer
+
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FPS = 4
+MAX_FPS = 30
+# Number of frames that are loaded ahead of the shown frame
+PREFETCH_FRAMES = 3
+
+
+def get_target_frame(start_frame, elapsed, fps, nr_frames, loop):
+    """Return the frame that should be shown ``elapsed`` seconds after start
+
+    :return: frame number or None if the animation has finished (no loop)
+    """
+    frame = start_frame + int(elapsed * fps)
+    if frame < nr_frames:
+        return frame
+    if loop:
+        return frame % nr_frames
+    return None
+
+
+class AnimationPlayer(QObject):
+    """Plays frames ``0`` until ``nr_frames - 1``
+
+    On every tick the newest loaded frame at or before the target frame is
+    shown, so frames are skipped when loading can't keep up.
+
+    :param load_frame: function ``load_frame(frame)`` returning the data of a
+        frame. It is called on a worker thread, so it should not touch Qt
+        objects.
+    :param show_frame: function ``show_frame(frame, data)``, called on the main
+        thread with the result of ``load_frame``.
+    :param is_busy: optional function returning True while the previous frame
+        is still being drawn, e.g. ``iface.mapCanvas().isDrawing``. Frames are
+        skipped while busy.
+    :param get_context: optional function returning the state ``load_frame``
+        needs, called on the main thread when a frame is submitted. It is
+        passed as ``load_frame(frame, context)``.
+    """
+
+    finished = pyqtSignal()
+
+    def __init__(
+        self, load_frame, show_frame, is_busy=None, get_context=None, parent=None
+    ):
+        super().__init__(parent)
+        self.load_frame = load_frame
+        self.show_frame = show_frame
+        self.is_busy = is_busy
+        self.get_context = get_context
+        self.fps = DEFAULT_FPS
+        self.loop = False
+        self.nr_frames = 0
+        self.current_frame = None
+        self._start_frame = 0
+        self._start_time = None
+        self._futures = {}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._on_tick)
+
+    @property
+    def playing(self):
+        return self._timer.isActive()
+
+    def set_fps(self, fps):
+        self.fps = max(1, min(int(fps), MAX_FPS))
+        if self.playing:
+            # restart the clock, otherwise the animation jumps
+            self._restart_clock(self.current_frame)
+
+    def play(self, start_frame, nr_frames):
+        self.nr_frames = nr_frames
+        if start_frame >= nr_frames - 1:
+            start_frame = 0
+        self.current_frame = None
+        # the old frames could be taken for frames behind the new start
+        self.invalidate()
+        self._restart_clock(start_frame)
+        self._prefetch(start_frame)
+        self._timer.start()
+
+    def pause(self):
+        self._timer.stop()
+
+    def stop(self):
+        """Pause and forget the prefetched frames"""
+        self.pause()
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget the prefetched frames, e.g. after a parameter change"""
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+
+    def shutdown(self):
+        self.stop()
+        self._executor.shutdown(wait=False)
+
+    def _restart_clock(self, start_frame):
+        self._start_frame = start_frame or 0
+        self._start_time = time.monotonic()
+        # check often enough to not miss a frame
+        self._timer.setInterval(max(1, int(500 / self.fps)))
+
+    def _get_offset(self, frame, target):
+        """Return the number of frames ``frame`` is ahead of ``target``
+
+        When looping, only the prefetched frames count as ahead, the others
+        are behind ``target``.
+        """
+        offset = frame - target
+        if self.loop and self.nr_frames:
+            offset %= self.nr_frames
+            if offset > PREFETCH_FRAMES:
+                offset -= self.nr_frames
+        return offset
+
+    def _get_loaded_frame(self, target):
+        """Return the newest loaded frame at or before ``target``, or None"""
+        loaded = [
+            frame
+            for frame, future in self._futures.items()
+            if future.done()
+            and not future.cancelled()
+            and self._get_offset(frame, target) <= 0
+        ]
+        if not loaded:
+            return None
+        return max(loaded, key=lambda frame: self._get_offset(frame, target))
+
+    def _prefetch(self, frame):
+        wanted = set()
+        for offset in range(PREFETCH_FRAMES + 1):
+            wanted_frame = frame + offset
+            if wanted_frame >= self.nr_frames:
+                if not self.loop:
+                    break
+                wanted_frame %= self.nr_frames
+            wanted.add(wanted_frame)
+        for old_frame in set(self._futures) - wanted:
+            # a frame that is loading or loaded is kept: it is shown if no
+            # newer frame is loaded
+            if self._futures[old_frame].cancel():
+                del self._futures[old_frame]
+        context = () if self.get_context is None else (self.get_context(),)
+        for wanted_frame in sorted(wanted, key=lambda f: (f - frame) % self.nr_frames):
+            if wanted_frame not in self._futures:
+                self._futures[wanted_frame] = self._executor.submit(
+                    self.load_frame, wanted_frame, *context
+                )
+
+    def _on_tick(self):
+        elapsed = time.monotonic() - self._start_time
+        frame = get_target_frame(
+            self._start_frame, elapsed, self.fps, self.nr_frames, self.loop
+        )
+        if frame is None:
+            self.pause()
+            self.finished.emit()
+            return
+        self._prefetch(frame)
+        if frame == self.current_frame:
+            return
+        if self.is_busy is not None and self.is_busy():
+            # the previous frame is still being drawn: skip this one
+            return
+        # loading can't keep up: show the newest frame that has been loaded
+        loaded_frame = self._get_loaded_frame(frame)
+        if loaded_frame is None or loaded_frame == self.current_frame:
+            return
+        future = self._futures[loaded_frame]
+        # forget the frames before it, they are skipped
+        loaded_offset = self._get_offset(loaded_frame, frame)
+        for old_frame in list(self._futures):
+            if self._get_offset(old_frame, frame) < loaded_offset:
+                self._futures.pop(old_frame).cancel()
+        try:
+            data = future.result()
+        except Exception:
+            logger.exception("Loading animation frame %s failed", loaded_frame)
+            self.pause()
+            self.finished.emit()
+            return
+        self.current_frame = loaded_frame
+        self.show_frame(loaded_frame, data)
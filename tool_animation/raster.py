@@ -0,0 +1,182 @@
+"""Animation of the 2D node values as a raster of the computational cells
+
+Drawing a point per node is slow for dense 2D models. The raster mode draws
+the values of the 2D nodes on their (quadtree) cells instead. A grid with the
+value index (node id - 1) of every pixel is computed once from the cell bounds
+in the gridadmin, after which a frame is a single numpy lookup that is written
+into an in-memory GDAL raster.
+
+"""
+from osgeo import gdal
+from osgeo import osr
+from qgis.core import QgsColorRampShader
+from qgis.core import QgsRasterLayer
+from qgis.core import QgsRasterShader
+from qgis.core import QgsSingleBandPseudoColorRenderer
+from ThreeDiToolbox.utils.layer_from_netCDF import IGNORE_FIRST
+
+import logging
+import numpy as np
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+NODATA = -9999.0
+# Larger grids are drawn with a coarser pixel than the smallest cell
+MAX_PIXELS = 25000000
+# node_type of the 2D surface water nodes
+NODE_TYPE_2D = 1
+
+
+def get_index_grid(cell_coords, ids, max_pixels=MAX_PIXELS):
+    """Return a grid with the value index of the cell covering each pixel
+
+    The pixel size is the size of the smallest cell, doubled until the grid
+    has at most ``max_pixels`` pixels. Cells smaller than a pixel are drawn on
+    the pixel of their center. Smaller cells are drawn over larger cells.
+
+    :param cell_coords: array (4, N) with the x0, y0, x1, y1 of the cells
+    :param ids: array (N) with the node ids of the cells
+    :return: tuple (grid, geotransform). The grid is an int array with the
+        value index (id - 1) per pixel and -1 outside the cells, its first
+        row is the north side.
+    """
+    x0, y0, x1, y1 = cell_coords
+    xmin, ymin, xmax, ymax = x0.min(), y0.min(), x1.max(), y1.max()
+    pixel_size = float((x1 - x0).min())
+
+    def get_shape(pixel_size):
+        return (
+            max(int(np.ceil((ymax - ymin) / pixel_size - 1e-6)), 1),
+            max(int(np.ceil((xmax - xmin) / pixel_size - 1e-6)), 1),
+        )
+
+    while np.prod(get_shape(pixel_size), dtype=np.int64) > max_pixels:
+        pixel_size *= 2
+    nr_rows, nr_cols = get_shape(pixel_size)
+
+    grid = np.full((nr_rows, nr_cols), -1, dtype=np.int64)
+    cell_size = np.maximum(np.rint((x1 - x0) / pixel_size).astype(int), 1)
+    for size in sorted(np.unique(cell_size), reverse=True):
+        mask = cell_size == size
+        # the upper left pixel, via the center to be robust for rounding
+        center_x = (x0[mask] + x1[mask]) / 2
+        center_y = (y0[mask] + y1[mask]) / 2
+        first_col = np.floor((center_x - xmin) / pixel_size - (size - 1) / 2)
+        first_row = np.floor((ymax - center_y) / pixel_size - (size - 1) / 2)
+        offsets = np.arange(size)
+        rows = first_row.astype(int)[:, None, None] + offsets[None, :, None]
+        cols = first_col.astype(int)[:, None, None] + offsets[None, None, :]
+        grid[np.clip(rows, 0, nr_rows - 1), np.clip(cols, 0, nr_cols - 1)] = (
+            ids[mask] - 1
+        )[:, None, None]
+    geotransform = (float(xmin), pixel_size, 0.0, float(ymax), 0.0, -pixel_size)
+    return grid, geotransform
+
+
+def create_raster_renderer(data_provider, node_renderer):
+    """Return a raster renderer with the classes of the node layer style
+
+    :param node_renderer: renderer of the node animation layer
+    :return: QgsSingleBandPseudoColorRenderer, or None if the node layer isn't
+        styled with graduated classes
+    """
+    if node_renderer is None or node_renderer.type() != "graduatedSymbol":
+        return None
+    ranges = node_renderer.ranges()
+    if not ranges:
+        return None
+    color_ramp = QgsColorRampShader(ranges[0].lowerValue(), ranges[-1].upperValue())
+    color_ramp.setColorRampType(QgsColorRampShader.Discrete)
+    color_ramp.setColorRampItemList(
+        [
+            QgsColorRampShader.ColorRampItem(
+                value_range.upperValue(),
+                value_range.symbol().color(),
+                value_range.label(),
+            )
+            for value_range in ranges
+        ]
+    )
+    shader = QgsRasterShader()
+    shader.setRasterShaderFunction(color_ramp)
+    return QgsSingleBandPseudoColorRenderer(data_provider, 1, shader)
+
+
+class RasterAnimation(object):
+    """In-memory raster layer showing the values of the 2D nodes
+
+    The frame is written alternately to two GDAL rasters in ``/vsimem``, the
+    layer switches to the written one. A raster that is still being drawn is
+    therefore never written to.
+
+    :param node_renderer: renderer of the node animation layer, its classes
+        are used for the raster style
+    """
+
+    def __init__(self, threedi_result, layer_name, node_renderer=None):
+        ga = threedi_result.gridadmin
+        cell_data = ga.cells.slice(IGNORE_FIRST).data
+        mask = cell_data["node_type"] == NODE_TYPE_2D
+        mask &= np.all(np.isfinite(cell_data["cell_coords"]), axis=0)
+        grid, geotransform = get_index_grid(
+            cell_data["cell_coords"][:, mask], cell_data["id"][mask]
+        )
+        self.shape = grid.shape
+        self._pixels = np.flatnonzero(grid >= 0)
+        self._indexes = grid.ravel()[self._pixels]
+
+        spatial_reference = osr.SpatialReference()
+        spatial_reference.ImportFromEPSG(int(ga.epsg_code))
+        name = uuid.uuid4().hex
+        self.paths = ["/vsimem/{}_{}.tif".format(name, i) for i in range(2)]
+        driver = gdal.GetDriverByName("GTiff")
+        for path in self.paths:
+            dataset = driver.Create(
+                path, self.shape[1], self.shape[0], 1, gdal.GDT_Float32
+            )
+            dataset.SetGeoTransform(geotransform)
+            dataset.SetProjection(spatial_reference.ExportToWkt())
+            band = dataset.GetRasterBand(1)
+            band.SetNoDataValue(NODATA)
+            band.Fill(NODATA)
+            dataset = None
+        self._current = 0
+        self.layer = QgsRasterLayer(self.paths[0], layer_name, "gdal")
+        self.renderer = create_raster_renderer(
+            self.layer.dataProvider(), node_renderer
+        )
+        if self.renderer is not None:
+            self.layer.setRenderer(self.renderer.clone())
+
+    def render(self, values):
+        """Return the raster array of a frame
+
+        Only numpy work, so this can run on a worker thread.
+
+        :param values: node values indexed by id - 1, e.g. the result of
+            ``get_frame_values``
+        """
+        frame = np.full(self.shape, NODATA, dtype=np.float32)
+        frame_values = values[self._indexes]
+        frame_values[np.isnan(frame_values)] = NODATA
+        frame.ravel()[self._pixels] = frame_values
+        return frame
+
+    def show(self, frame):
+        """Show a frame returned by :py:meth:`render`"""
+        self._current = 1 - self._current
+        path = self.paths[self._current]
+        dataset = gdal.Open(path, gdal.GA_Update)
+        dataset.GetRasterBand(1).WriteArray(frame)
+        dataset = None
+        self.layer.setDataSource(path, self.layer.name(), "gdal")
+        if self.renderer is not None:
+            self.layer.setRenderer(self.renderer.clone())
+        self.layer.triggerRepaint()
+
+    def remove(self):
+        """Free the in-memory rasters"""
+        for path in self.paths:
+            gdal.Unlink(path)
@@ -0,0 +1,23 @@
+from ThreeDiToolbox.tool_animation.raster import get_index_grid
+
+import numpy as np
+
+
+def test_get_index_grid():
+    # one 20x20 cell and four 10x10 cells to the east of it
+    cell_coords = np.array(
+        [
+            [0.0, 20.0, 30.0, 20.0, 30.0],
+            [0.0, 0.0, 0.0, 10.0, 10.0],
+            [20.0, 30.0, 40.0, 30.0, 40.0],
+            [20.0, 10.0, 10.0, 20.0, 20.0],
+        ]
+    )
+    ids = np.array([1, 2, 3, 4, 5])
+    grid, geotransform = get_index_grid(cell_coords, ids)
+    assert grid.tolist() == [[0, 0, 3, 4], [0, 0, 1, 2]]
+    assert geotransform == (0.0, 10.0, 0.0, 20.0, 0.0, -10.0)
+    # a coarser pixel: the smaller cells are drawn on the pixel of their center
+    grid, geotransform = get_index_grid(cell_coords, ids, max_pixels=2)
+    assert grid.tolist() == [[0, 4]]
+    assert geotransform[1] == 20.0
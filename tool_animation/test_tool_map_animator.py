@@ -1,7 +1,27 @@
+from qgis.core import QgsExpression
+from qgis.core import QgsExpressionContext
+from qgis.core import QgsFeature
+from qgis.core import QgsGeometry
+from qgis.core import QgsPointXY
+from qgis.core import QgsRectangle
+from qgis.core import QgsVectorLayer
+from ThreeDiToolbox.tests.utilities import ensure_qgis_app_is_initialized
 from ThreeDiToolbox.threedi_plugin import CommandBox
+from ThreeDiToolbox.tool_animation import expressions
+from ThreeDiToolbox.tool_animation.interpolation import get_interpolation_weights
+from ThreeDiToolbox.tool_animation.interpolation import ResultValues
+from ThreeDiToolbox.tool_animation.map_animator import DiffReference
+from ThreeDiToolbox.tool_animation.map_animator import ExtentValueWriter
+from ThreeDiToolbox.tool_animation.map_animator import get_class_bounds
+from ThreeDiToolbox.tool_animation.map_animator import get_class_indices
+from ThreeDiToolbox.tool_animation.map_animator import get_frame_values
+from ThreeDiToolbox.tool_animation.map_animator import get_value_index
+from ThreeDiToolbox.tool_animation.playback import AnimationPlayer
+from ThreeDiToolbox.tool_animation.playback import get_target_frame
 from ThreeDiToolbox.tool_result_selection.models import TimeseriesDatasourceModel
 
 import mock
+import numpy as np
 
 
 def test_smoke():
@@ -18,3 +38,164 @@ def test_smoke():
     toolbar_animation = iface.addToolBar("ThreeDiAnimation")
     toolbar_animation.setObjectName("ThreeDiAnimation")
     assert tdi_root_tool
+
+
+def test_get_value_index():
+    ensure_qgis_app_is_initialized()
+    layer = QgsVectorLayer("Point?crs=EPSG:4326&field=id:integer", "nodes", "memory")
+    features = []
+    for node_id in (3, 5):
+        feature = QgsFeature(layer.fields())
+        feature.setAttributes([node_id])
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    feature_ids, value_index = get_value_index(layer)
+    assert feature_ids == [1, 2]
+    assert value_index.tolist() == [2, 4]
+
+
+def test_threedi_value_expression():
+    ensure_qgis_app_is_initialized()
+    expressions.register()
+    expressions.set_values("some_layer", np.array([1.5, np.nan]))
+    context = QgsExpressionContext()
+    assert QgsExpression("threedi_value('some_layer', 1)").evaluate(context) == 1.5
+    # NaN and unknown feature ids are NULL
+    assert QgsExpression("threedi_value('some_layer', 2)").evaluate(context) is None
+    assert QgsExpression("threedi_value('some_layer', 3)").evaluate(context) is None
+    expressions.unregister()
+
+
+def test_get_target_frame():
+    # 2.6 seconds at 4 fps: 10 frames further
+    assert get_target_frame(3, 2.6, 4, 20, loop=False) == 13
+    # frames are skipped instead of slowing down
+    assert get_target_frame(3, 2.6, 10, 40, loop=False) == 29
+    assert get_target_frame(3, 2.6, 10, 20, loop=False) is None
+    assert get_target_frame(3, 2.6, 10, 20, loop=True) == 9
+
+
+def test_player_shows_newest_loaded_frame():
+    ensure_qgis_app_is_initialized()
+    shown = []
+    player = AnimationPlayer(lambda frame: frame, lambda *args: shown.append(args))
+    player.nr_frames = 20
+    # frame 5 was loaded while the target moved on to 9
+    loaded = mock.Mock(done=mock.Mock(return_value=True))
+    loaded.cancelled.return_value = False
+    loaded.result.return_value = "values of 5"
+    loading = mock.Mock(done=mock.Mock(return_value=False))
+    player._futures = {4: loaded, 5: loaded, 9: loading}
+    player._start_time = 0
+    with mock.patch.object(player, "_prefetch"), mock.patch(
+        "ThreeDiToolbox.tool_animation.playback.time.monotonic", return_value=2.25
+    ):
+        player._on_tick()
+    assert shown == [(5, "values of 5")]
+    # the skipped frame is forgotten
+    assert sorted(player._futures) == [5, 9]
+    player.shutdown()
+
+
+def test_get_frame_values_diff_reference():
+    threedi_result = mock.Mock(file_path="results_3di.nc")
+    threedi_result.get_values_by_timestep_nr.side_effect = (
+        lambda parameter, timestep_nr: np.array([1.0, 2.0]) * timestep_nr
+    )
+    reference = DiffReference(timestep_nr=1)
+    for timestep_nr in (2, 3):
+        values = get_frame_values(threedi_result, "s1", "diff", timestep_nr, reference)
+    assert values.tolist() == [2.0, 4.0]
+    # the reference values are read once
+    assert threedi_result.get_values_by_timestep_nr.call_count == 3
+
+
+def test_diff_reference_other_result():
+    threedi_result = mock.Mock(file_path="a/results_3di.nc")
+    threedi_result.timestamps = np.array([0.0, 300.0, 600.0])
+    other_result = mock.Mock(file_path="b/results_3di.nc")
+    other_result.get_timestamps.return_value = np.array([0.0, 200.0, 400.0, 600.0])
+    other_result.get_values_by_timestep_nr.side_effect = (
+        lambda parameter, timestep_nr: np.array([10.0]) * timestep_nr
+    )
+    reference = DiffReference(threedi_result=other_result)
+    # 300 s is halfway the second and third timestep of the other result
+    assert reference.get_values(threedi_result, "s1", 1).tolist() == [15.0]
+    assert reference.get_values(threedi_result, "s1", 2).tolist() == [30.0]
+
+
+def test_diff_reference_interpolated_values():
+    threedi_result = mock.Mock(file_path="a/results_3di.nc")
+    threedi_result.timestamps = np.array([0.0, 300.0, 600.0])
+    compared_result = mock.Mock(file_path="b/results_3di.nc")
+    compared_result.get_timestamps.return_value = np.array([0.0, 200.0, 400.0])
+    compared_result.get_values_by_timestep_nr.side_effect = (
+        lambda parameter, timestep_nr: np.array([10.0]) * timestep_nr
+    )
+    result_values = ResultValues(compared_result)
+    # the reference timestep is a moment of the animated result
+    reference = DiffReference(timestep_nr=1)
+    for timestep_nr in (0, 2):
+        values = reference.get_interpolated_values(
+            threedi_result, result_values, "s1", timestep_nr
+        )
+        assert values.tolist() == [15.0]
+    # a reference result is interpolated at the moment of the timestep
+    reference = DiffReference(threedi_result=compared_result)
+    values = reference.get_interpolated_values(
+        threedi_result, result_values, "s1", 2
+    )
+    assert values.tolist() == [20.0]
+
+
+def test_extent_value_writer():
+    ensure_qgis_app_is_initialized()
+    layer = QgsVectorLayer(
+        "Point?crs=EPSG:4326&field=id:integer&field=result:double", "nodes", "memory"
+    )
+    features = []
+    for node_id, x in ((1, 0.0), (2, 10.0), (3, 20.0)):
+        feature = QgsFeature(layer.fields())
+        feature.setAttributes([node_id, None])
+        feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, 0.0)))
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    writer = ExtentValueWriter(layer)
+
+    writer.write(np.array([1.0, 2.0, 3.0]), QgsRectangle(-1, -1, 11, 1))
+    assert [f["result"] for f in layer.getFeatures()] == [1.0, 2.0, None]
+    # panning fills the features that came into view
+    assert writer.write_stale(QgsRectangle(9, -1, 21, 1))
+    assert [f["result"] for f in layer.getFeatures()] == [1.0, 2.0, 3.0]
+    assert not writer.write_stale(QgsRectangle(-1, -1, 21, 1))
+
+
+def test_get_class_bounds():
+    graduated = (
+        '<renderer-v2 attr="result" type="graduatedSymbol"><ranges>'
+        '<range lower="-1.0" upper="0.5" label="a"/>'
+        '<range lower="0.5" upper="99" label="b"/></ranges></renderer-v2>'
+    )
+    assert get_class_bounds(graduated).tolist() == [-1.0, 0.5, 99.0]
+    rules = (
+        '<rule filter="&quot;result&quot; &gt; -0.05 AND '
+        '&quot;result&quot; &lt;= 1e-1"/>'
+        '<prop k="angle_dd_expression" v="CASE WHEN &quot;result&quot; &lt; 0"/>'
+    )
+    assert get_class_bounds(rules).tolist() == [-0.05, 0.0, 0.1]
+    # the size depends on the value itself: every change matters
+    assert get_class_bounds('<prop v="abs(&quot;result&quot;) * 2"/>') is None
+
+
+def test_get_class_indices():
+    bounds = np.array([0.0, 1.0])
+    classes = get_class_indices(np.array([-1.0, 0.0, 0.5, 0.9, 1.0, np.nan]), bounds)
+    assert classes.tolist() == [0, 1, 2, 2, 3, -1]
+
+
+def test_get_interpolation_weights():
+    timestamps = np.array([0.0, 300.0, 600.0])
+    assert get_interpolation_weights(timestamps, -10.0) == (0, 0, 0.0)
+    assert get_interpolation_weights(timestamps, 300.0) == (1, 2, 0.0)
+    assert get_interpolation_weights(timestamps, 450.0) == (1, 2, 0.5)
+    assert get_interpolation_weights(timestamps, 900.0) == (2, 2, 0.0)
@@ -1,11 +1,20 @@
 from cached_property import cached_property
 from pathlib import Path
+from qgis.core import QgsFeedback
+from qgis.core import QgsProcessingFeedback
+from qgis.core import QgsProcessingMultiStepFeedback
 from qgis.PyQt.QtCore import pyqtSignal
+from qgis.PyQt.QtCore import QSettings
 from qgis.PyQt.QtCore import Qt
 from ThreeDiToolbox.datasource.threedi_results import ThreediResult
 from ThreeDiToolbox.models.base import BaseModel
 from ThreeDiToolbox.models.base_fields import CheckboxField
 from ThreeDiToolbox.models.base_fields import ValueField
+from ThreeDiToolbox.utils.layer_from_netCDF import create_memory_cell_layer
+from ThreeDiToolbox.utils.layer_from_netCDF import create_memory_flowline_layer
+from ThreeDiToolbox.utils.layer_from_netCDF import create_memory_node_layer
+from ThreeDiToolbox.utils.layer_from_netCDF import create_memory_pumpline_layer
+from ThreeDiToolbox.utils.layer_from_netCDF import get_or_create_cell_layer
 from ThreeDiToolbox.utils.layer_from_netCDF import get_or_create_flowline_layer
 from ThreeDiToolbox.utils.layer_from_netCDF import get_or_create_node_layer
 from ThreeDiToolbox.utils.layer_from_netCDF import get_or_create_pumpline_layer
@@ -17,6 +26,20 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+#: QSettings key of the option to build the result layers in memory
+IN_MEMORY_RESULT_LAYERS_SETTING = "in_memory_result_layers"
+
+
+def in_memory_result_layers_enabled():
+    """Return whether result layers should be built as memory layers.
+
+    Building the layers straight from the gridadmin arrays skips writing and
+    re-reading the gridadmin.sqlite, which is mostly a win for a quick look at
+    results on slow (network) drives.
+    """
+    settings = QSettings("3di", "qgisplugin")
+    return settings.value(IN_MEMORY_RESULT_LAYERS_SETTING, False, type=bool)
+
 
 def get_line_pattern(item_field):
     """Return (default) line pattern for plots from this datasource.
@@ -108,32 +131,98 @@ class DatasourceLayerHelper(object):
         self._line_layer = None
         self._node_layer = None
         self._pumpline_layer = None
+        # Cache for self.get_cell_layer()
+        self._cell_layer = None
 
     @cached_property
     def threedi_result(self):
         """Return an instance of a subclass of ``BaseDataSource``."""
         return ThreediResult(self.file_path)
 
-    def get_result_layers(self, progress_bar=None):
+    def get_result_layers(self, progress_bar=None, in_memory=None, feedback=None):
         """Return QgsVectorLayers for line, node, and pumpline layers.
 
         Use cached versions (``self._line_layer`` and so) if present.
 
+        If ``in_memory`` is True the layers are memory layers built directly
+        from the gridadmin instead of spatialite layers of the
+        gridadmin.sqlite. The default is taken from the
+        ``in_memory_result_layers`` setting. Use the ``id`` attribute to get
+        the line or node id of a feature: only the spatialite layers use it
+        as feature id, the memory provider numbers its features itself.
+
+        Writing the gridadmin.sqlite reports progress per chunk of features
+        to ``progress_bar`` and can be cancelled through ``feedback`` (a
+        ``QgsFeedback``, which is also what a ``QgsTask`` provides). By
+        default a progress bar with a cancel button is shown. On cancel,
+        :py:class:`ThreeDiToolbox.utils.gridadmin.ExportCancelledError` is
+        raised and no partial layers are left behind.
+
         """
+        if in_memory is None:
+            in_memory = in_memory_result_layers_enabled()
+        if in_memory:
+            return self._get_memory_result_layers()
+        if feedback is None:
+            feedback = QgsFeedback()
         if progress_bar is None:
-            progress_bar = StatusProgressBar(100, "create gridadmin.sqlite")
-        progress_bar.increase_progress(0, "create flowline layer")
-        progress_bar.increase_progress(33, "create node layer")
+            progress_bar = StatusProgressBar(
+                100, "create gridadmin.sqlite", feedback=feedback
+            )
+        # Spread the three layers over the progress of the overall feedback
+        total_feedback = QgsProcessingFeedback()
+        total_feedback.progressChanged.connect(progress_bar.set_progress)
+        feedback.canceled.connect(total_feedback.cancel)
+        step_feedback = QgsProcessingMultiStepFeedback(3, total_feedback)
+
+        progress_bar.set_progress(0, "create flowline layer")
         self._line_layer = self._line_layer or get_or_create_flowline_layer(
-            self.threedi_result, self.sqlite_gridadmin_filepath
+            self.threedi_result, self.sqlite_gridadmin_filepath, step_feedback
         )
-        progress_bar.increase_progress(33, "create pumplayer layer")
+        step_feedback.setCurrentStep(1)
+        progress_bar.set_progress(total_feedback.progress(), "create node layer")
         self._node_layer = self._node_layer or get_or_create_node_layer(
-            self.threedi_result, self.sqlite_gridadmin_filepath
+            self.threedi_result, self.sqlite_gridadmin_filepath, step_feedback
         )
-        progress_bar.increase_progress(34, "done")
+        step_feedback.setCurrentStep(2)
+        progress_bar.set_progress(total_feedback.progress(), "create pumpline layer")
         self._pumpline_layer = self._pumpline_layer or get_or_create_pumpline_layer(
-            self.threedi_result, self.sqlite_gridadmin_filepath
+            self.threedi_result, self.sqlite_gridadmin_filepath, step_feedback
+        )
+        progress_bar.set_progress(100, "done")
+        return [self._line_layer, self._node_layer, self._pumpline_layer]
+
+    def get_cell_layer(self, in_memory=None, feedback=None):
+        """Return a QgsVectorLayer with the 2D cells as polygons, or None
+
+        The ``id`` attribute is the id of the 2D node of the cell, so 2D node
+        results can be shown on the cells instead of on the node points. Like
+        for the other result layers, only the spatialite layer also uses it as
+        feature id. See :py:meth:`get_result_layers` for ``in_memory`` and
+        ``feedback``.
+
+        """
+        if self._cell_layer is not None:
+            return self._cell_layer
+        if in_memory is None:
+            in_memory = in_memory_result_layers_enabled()
+        if in_memory:
+            self._cell_layer = create_memory_cell_layer(self.threedi_result)
+        else:
+            self._cell_layer = get_or_create_cell_layer(
+                self.threedi_result, self.sqlite_gridadmin_filepath, feedback
+            )
+        return self._cell_layer
+
+    def _get_memory_result_layers(self):
+        self._line_layer = self._line_layer or create_memory_flowline_layer(
+            self.threedi_result
+        )
+        self._node_layer = self._node_layer or create_memory_node_layer(
+            self.threedi_result
+        )
+        self._pumpline_layer = self._pumpline_layer or create_memory_pumpline_layer(
+            self.threedi_result
         )
         return [self._line_layer, self._node_layer, self._pumpline_layer]
 
@@ -199,6 +288,9 @@ class TimeseriesDatasourceModel(BaseModel):
         def get_result_layers(self):
             return self.datasource_layer_helper.get_result_layers()
 
+        def get_cell_layer(self):
+            return self.datasource_layer_helper.get_cell_layer()
+
     def reset(self):
         self.removeRows(0, self.rowCount())
 
@@ -1,3 +1,4 @@
+from qgis.core import QgsWkbTypes
 from ThreeDiToolbox.datasource.threedi_results import ThreediResult
 from ThreeDiToolbox.tests.test_init import TEST_DATA_DIR
 from ThreeDiToolbox.tests.utilities import ensure_qgis_app_is_initialized
@@ -122,6 +123,44 @@ def test_datasource_layer_helper_get_result_layers_validation():
     assert pumps.name() == "pumplines"
 
 
+def test_datasource_layer_helper_get_result_layers_in_memory():
+    ensure_qgis_app_is_initialized()
+    datasource_layer_helper = models.DatasourceLayerHelper(THREEDI_RESULTS_PATH)
+    lines, nodes, pumps = datasource_layer_helper.get_result_layers(in_memory=True)
+    assert lines.providerType() == "memory"
+    assert lines.featureCount() == 31915
+    assert lines.fields().lookupField("start_node_idx") != -1
+    assert nodes.isValid()
+    assert pumps.name() == "pumplines"
+
+
+def test_datasource_layer_helper_get_cell_layer():
+    ensure_qgis_app_is_initialized()
+    datasource_layer_helper = models.DatasourceLayerHelper(THREEDI_RESULTS_PATH)
+    cells = datasource_layer_helper.get_cell_layer(in_memory=True)
+    assert cells.geometryType() == QgsWkbTypes.PolygonGeometry
+    assert cells.featureCount() > 0
+    assert min(cells.uniqueValues(cells.fields().lookupField("level"))) == 1
+
+
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_datasource_layer_helper_cell_layer_ids(in_memory):
+    """The id attribute of a cell is the id of its 2D node"""
+    ensure_qgis_app_is_initialized()
+    datasource_layer_helper = models.DatasourceLayerHelper(THREEDI_RESULTS_PATH)
+    cells = datasource_layer_helper.get_cell_layer(in_memory=in_memory)
+    nodes = datasource_layer_helper.get_result_layers(
+        progress_bar=mock.Mock(), in_memory=in_memory
+    )[1]
+    node_types = {node["id"]: node["type"] for node in nodes.getFeatures()}
+    cell_ids = {cell.id(): cell["id"] for cell in cells.getFeatures()}
+    assert len(set(cell_ids.values())) == len(cell_ids)
+    assert {node_types[i] for i in cell_ids.values()} <= {"2d", "2d_groundwater"}
+    if not in_memory:
+        # the spatialite layer also uses the node id as feature id
+        assert all(fid == node_id for fid, node_id in cell_ids.items())
+
+
 def test_ts_datasource_model_field_models():
     """Smoke test of the three helper methods on the Fields object."""
     test_values = {
@@ -0,0 +1,42 @@
+from ThreeDiToolbox.tool_water_balance.tools.batch import get_area_closure_error
+from ThreeDiToolbox.tool_water_balance.tools.batch import get_area_volumes
+from ThreeDiToolbox.tool_water_balance.tools.waterbalance import get_closure_matrix
+from ThreeDiToolbox.tool_water_balance.views.waterbalance_widget import (
+    get_model_part_series,
+)
+
+import numpy as np
+
+
+def test_get_model_part_series():
+    names = [name for name, _ in get_model_part_series("1d")]
+    assert "1d_in" in names
+    assert "1d__1d_2d_exch_in" in names
+    assert "2d_in" not in names
+
+
+def test_get_area_volumes():
+    ts = np.array([0.0, 10.0, 30.0])
+    total_time = np.zeros((3, 36))
+    total_time[:, 0] = [5.0, 1.0, 2.0]  # 2d_in
+    volumes = dict(get_area_volumes(ts, total_time, "2d"))
+    # the first timestep has no duration
+    assert volumes["2d_in"] == 50.0
+    assert volumes["2d_out"] == 0.0
+    assert "1d_in" not in volumes
+
+
+def test_get_area_closure_error():
+    ts = np.array([0.0, 10.0, 30.0])
+    total_time = np.zeros((3, 36))
+    total_time[:, 0] = [0.0, 1.0, 1.0]  # 2d_in
+    total_time[:, 18] = [0.0, 1.0, 1.0]  # d_2d_vol
+    total_time[:, 20:23] = total_time @ get_closure_matrix("2d")
+    assert get_area_closure_error(ts, total_time, "2d") == (0.0, False)
+
+    # 10 m3 of the 30 m3 inflow is missing in the storage
+    total_time[:, 18] = [0.0, 1.0, 0.5]
+    total_time[:, 20:23] = total_time @ get_closure_matrix("2d")
+    closure_error, flagged = get_area_closure_error(ts, total_time, "2d")
+    assert closure_error == 10.0 / 30.0
+    assert flagged
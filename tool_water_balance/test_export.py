@@ -0,0 +1,45 @@
+from ThreeDiToolbox.tool_water_balance.tools.export import write_csv
+from ThreeDiToolbox.tool_water_balance.tools.export import write_netcdf
+
+import h5py
+import numpy as np
+
+
+def test_write_csv(tmp_path):
+    path = tmp_path / "flows.csv"
+    ts = np.array([0.0, 10.0])
+    total_time = np.zeros((2, 36))
+    total_time[:, 14] = [0.0, 2.5]  # rain
+    write_csv(str(path), ["area_1"], ts, [total_time], [("rain", 14)])
+    assert path.read_text().splitlines() == [
+        "area,time,rain",
+        "area_1,0.0,0.0",
+        "area_1,10.0,2.5",
+    ]
+
+
+def test_write_netcdf(tmp_path):
+    path = tmp_path / "flows.nc"
+    ts = np.array([0.0, 10.0, 20.0])
+    total_times = [np.zeros((3, 36)), np.zeros((3, 36))]
+    total_times[0][:, 14] = [0.0, 2.5, 3.0]  # rain
+    total_times[1][:, 14] = [0.0, 1.0, 0.5]
+    total_times[1][:, 16] = [0.0, -1.0, -2.0]  # lateral 2d
+    write_netcdf(
+        str(path), ["area_1", 2], ts, total_times, [("rain", 14), ("lat_2d", 16)]
+    )
+    with h5py.File(str(path), "r") as netcdf:
+        rain = netcdf["rain"]
+        assert rain.shape == (2, 3)
+        assert rain[()].tolist() == [[0.0, 2.5, 3.0], [0.0, 1.0, 0.5]]
+        assert netcdf["lat_2d"][()].tolist() == [[0.0, 0.0, 0.0], [0.0, -1.0, -2.0]]
+        # the dimensions are the area and time dimension scales
+        assert [dim[0].name for dim in rain.dims] == ["/area", "/time"]
+        assert netcdf["time"][()].tolist() == [0.0, 10.0, 20.0]
+        assert netcdf["area"][()].tolist() == [0, 1]
+        area_ids = [
+            value.decode() if isinstance(value, bytes) else value
+            for value in netcdf["area_id"][()]
+        ]
+        assert area_ids == ["area_1", "2"]
+        assert netcdf["area_id"].dims[0][0].name == "/area"
@@ -0,0 +1,9 @@
+from ThreeDiToolbox.tool_water_balance.tools.incremental import diff_ids
+
+
+def test_diff_ids():
+    old = {"2d_in": [1, 2, 3], "2d_out": [4]}
+    new = {"2d_in": [2, 3, 5], "2d_out": []}
+    removed, added = diff_ids(old, new)
+    assert removed == {"2d_in": [1], "2d_out": [4]}
+    assert added == {"2d_in": [5], "2d_out": []}
@@ -0,0 +1,53 @@
+from qgis.core import QgsGeometry
+from ThreeDiToolbox.tool_water_balance.tools.polygon_selection import (
+    get_flowline_categories,
+)
+from ThreeDiToolbox.tool_water_balance.tools.polygon_selection import (
+    get_polygon_rings,
+)
+from ThreeDiToolbox.tool_water_balance.tools.polygon_selection import points_in_polygon
+from ThreeDiToolbox.tool_water_balance.tools.polygon_selection import points_in_rings
+
+import numpy as np
+
+
+SQUARE = QgsGeometry.fromWkt(
+    "POLYGON((0 0, 10 0, 10 10, 0 10, 0 0), (4 4, 6 4, 6 6, 4 6, 4 4))"
+)
+
+
+def test_points_in_polygon():
+    x = np.array([1.0, 5.0, 9.0, 11.0, -1.0])
+    y = np.array([1.0, 5.0, 9.0, 5.0, 5.0])
+    inside = points_in_polygon(SQUARE, x, y)
+    # the second point is inside the hole
+    assert inside.tolist() == [True, False, True, False, False]
+
+
+def test_get_flowline_categories():
+    types = np.array(["v2_pipe", "v2_pipe", "2d", "2d", "2d", "1d_2d", "1d_2d"])
+    line_arrays = {
+        "id": np.arange(1, 8),
+        "type": types.astype(object),
+        "x1": np.array([1.0, 12.0, 8.0, 11.0, 1.0, 2.0, 12.0]),
+        "y1": np.array([1.0, 1.0, 2.0, 2.0, 8.0, 2.0, 2.0]),
+        "x2": np.array([12.0, 1.0, 11.0, 8.0, 1.0, 3.0, 2.0]),
+        "y2": np.array([1.0, 1.0, 2.0, 2.0, 11.0, 3.0, 2.0]),
+        "x_dir": np.array([False, False, True, True, False, False, False]),
+        "y_dir": np.array([False, False, False, False, True, False, False]),
+        "x_dir_groundwater": np.zeros(7, dtype=bool),
+        "y_dir_groundwater": np.zeros(7, dtype=bool),
+    }
+    rings = get_polygon_rings(SQUARE)
+    flow_lines = get_flowline_categories(
+        line_arrays,
+        points_in_rings(rings, line_arrays["x1"], line_arrays["y1"]),
+        points_in_rings(rings, line_arrays["x2"], line_arrays["y2"]),
+    )
+    assert flow_lines["1d_out"] == [1]
+    assert flow_lines["1d_in"] == [2]
+    # 2d lines are directed to the east or north, line 4 is drawn reversed
+    assert flow_lines["2d_out"] == [3, 4, 5]
+    assert flow_lines["2d_in"] == []
+    assert flow_lines["1d_2d_exch"] == [6]
+    assert flow_lines["1d__1d_2d_flow"] == [7]
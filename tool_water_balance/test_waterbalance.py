@@ -6,6 +6,12 @@ from qgis.core import QgsPointXY
 from qgis.core import QgsProject
 from ThreeDiToolbox.tests.test_init import TEST_DATA_DIR
 from ThreeDiToolbox.tests.utilities import ensure_qgis_app_is_initialized
+from ThreeDiToolbox.tool_water_balance.tools import waterbalance
+from ThreeDiToolbox.tool_water_balance.tools.waterbalance import BALANCE_CACHE_SIZE
+from ThreeDiToolbox.tool_water_balance.tools.waterbalance import get_closure_errors
+from ThreeDiToolbox.tool_water_balance.tools.waterbalance import get_closure_matrix
+from ThreeDiToolbox.tool_water_balance.tools.waterbalance import get_membership_matrix
+from ThreeDiToolbox.tool_water_balance.tools.waterbalance import sum_by_category
 from ThreeDiToolbox.tool_water_balance.tools.waterbalance import WaterBalanceCalculation
 from ThreeDiToolbox.tool_water_balance.views import waterbalance_widget
 
@@ -150,6 +156,13 @@ def test_get_nodes(progress_bar_mock, wb_calculation, wb_polygon):
     assert nodes == NODES_EXPECTED
 
 
+@mock.patch("ThreeDiToolbox.tool_result_selection.models.StatusProgressBar")
+def test_get_selection(progress_bar_mock, wb_calculation, wb_polygon):
+    link_ids, pump_ids, node_ids = wb_calculation.get_selection(wb_polygon, None)
+    assert (link_ids, pump_ids) == LINKS_EXPECTED
+    assert node_ids == NODES_EXPECTED
+
+
 @mock.patch("ThreeDiToolbox.tool_result_selection.models.StatusProgressBar")
 def test_time_steps_get_aggregated_flows(progress_bar_mock, wb_calculation):
     """test A) number of timesteps, B) wheter we get a time series for each link,
@@ -419,3 +432,178 @@ def test_waterbalance_closure(
     assert _helper_round_numpy(
         sum([d_vol_1d, d_vol_2d, d_vol_2d_gr])
     ) == _helper_round_numpy(d_vol_net)
+
+
+def test_cumulative_balance_get_volumes():
+    ts = np.array([0.0, 10.0, 20.0, 40.0])
+    ts_series = np.array([[0.0, 0.0], [1.0, -1.0], [-2.0, 1.0], [3.0, 0.5]])
+    cumulative = waterbalance_widget.CumulativeBalance(ts, ts_series)
+    volumes_in, volumes_out = cumulative.get_volumes(10, 40)
+    # timesteps 10 and 20 (t2 is not included)
+    assert volumes_in.tolist() == [10.0, 10.0]
+    assert volumes_out.tolist() == [-20.0, -10.0]
+    volumes_in, volumes_out = cumulative.get_volumes()
+    assert volumes_in.tolist() == [70.0, 20.0]
+    assert volumes_out.tolist() == [-20.0, -10.0]
+    volumes_in, volumes_out = cumulative.get_volumes(30, 20)
+    assert volumes_in.tolist() == [0.0, 0.0]
+
+
+def test_sum_by_category():
+    membership = get_membership_matrix(["2d", "1d", "2d", "1d"], ["1d", "2d"])
+    values = np.array([[1.0, 2.0, 3.0, 4.0], [1.0, np.nan, 1.0, 1.0]])
+    totals = sum_by_category(values, membership)
+    # a NaN only affects the sum of its own category
+    assert totals[0].tolist() == [6.0, 4.0]
+    assert np.isnan(totals[1, 0])
+    assert totals[1, 1] == 2.0
+
+
+def test_get_closure_errors():
+    ts = np.array([0.0, 10.0, 20.0])
+    total_time = np.zeros((3, 36))
+    total_time[:, 2] = [0.0, 2.0, 2.0]  # 1d_in
+    total_time[:, 11] = [0.0, -1.0, -1.0]  # 1d__1d_2d_exch_out
+    total_time[:, 32] = [0.0, 1.0, 1.0]  # 2d__1d_2d_exch_in
+    total_time[:, 18] = [0.0, 1.0, 1.0]  # d_2d_vol
+    total_time[:, 19] = [0.0, 1.0, 1.0]  # d_1d_vol
+    total_time[:, 20:23] = total_time @ get_closure_matrix("1d and 2d")
+    closure_errors = get_closure_errors(ts, total_time, "1d and 2d")
+    # the exchange within the polygon cancels out in the combined balance
+    for name in ["error_2d", "error_1d", "error_1d_2d"]:
+        assert not closure_errors[name]["residual"].any()
+        assert not closure_errors[name]["flagged"]
+    # only the balances of the model part
+    total_time[:, 20:23] = total_time @ get_closure_matrix("1d")
+    closure_errors = get_closure_errors(ts, total_time, "1d")
+    assert list(closure_errors) == ["error_1d"]
+    assert not total_time[:, [20, 22]].any()
+
+
+@mock.patch(
+    "ThreeDiToolbox.tool_water_balance.views.waterbalance_widget.messagebar_message"
+)
+def test_warn_closure_errors_once(messagebar_mock, wb_widget, wb_polygon):
+    ts = np.array([0.0, 10.0, 20.0])
+    total_time = np.zeros((3, 36))
+    total_time[:, 2] = [0.0, 2.0, 2.0]  # 1d_in without a change in storage
+    total_time[:, 20:23] = total_time @ get_closure_matrix("1d")
+    wb_widget.wb_polygon = wb_polygon
+    wb_widget.warn_closure_errors(ts, total_time, "1d")
+    assert messagebar_mock.call_count == 1
+    # e.g. only the aggregation changed
+    wb_widget.warn_closure_errors(ts, total_time, "1d")
+    assert messagebar_mock.call_count == 1
+
+
+@mock.patch("ThreeDiToolbox.tool_result_selection.models.StatusProgressBar")
+def test_get_balance_is_memoized(progress_bar_mock, wb_calculation, wb_polygon):
+    with mock.patch.object(
+        wb_calculation,
+        "get_aggregated_flows",
+        wraps=wb_calculation.get_aggregated_flows,
+    ) as get_aggregated_flows:
+        _, _, _, _, total_time = wb_calculation.get_balance(wb_polygon, "1d")
+        total_time[:, (10, 11)] *= -1
+        _, _, _, _, total_time_again = wb_calculation.get_balance(wb_polygon, "1d")
+        wb_calculation.get_balance(wb_polygon, "2d")
+    assert get_aggregated_flows.call_count == 2
+    # the memoized flows aren't changed by modifying the returned copy
+    assert (total_time[:, (10, 11)] == -total_time_again[:, (10, 11)]).all()
+
+
+@mock.patch("ThreeDiToolbox.tool_result_selection.models.StatusProgressBar")
+@mock.patch(
+    "ThreeDiToolbox.tool_water_balance.tools.waterbalance."
+    "incremental_updates_enabled",
+    return_value=True,
+)
+def test_get_balance_cache_is_bounded_when_incremental(
+    incremental_mock, progress_bar_mock, wb_calculation, wb_polygon
+):
+    # edit the polygon more often than the size of the cache
+    for i in range(BALANCE_CACHE_SIZE + 4):
+        polygon = QgsGeometry(wb_polygon)
+        polygon.translate(i * 1e-5, 0)
+        wb_calculation.get_balance(polygon, "1d and 2d")
+    assert len(wb_calculation._balances) == BALANCE_CACHE_SIZE
+
+
+@mock.patch("ThreeDiToolbox.tool_result_selection.models.StatusProgressBar")
+def test_get_balance_follows_the_active_result(
+    progress_bar_mock, wb_calculation, wb_polygon, threedi_result
+):
+    expected = wb_calculation.get_balance(wb_polygon, "1d and 2d")
+    gridadmin = wb_calculation.gridadmin
+    line_arrays = wb_calculation.line_arrays
+    # another result is selected
+    with mock.patch.object(
+        WaterBalanceCalculation,
+        "threedi_result",
+        new_callable=mock.PropertyMock,
+        return_value=threedi_result,
+    ):
+        balance = wb_calculation.get_balance(wb_polygon, "1d and 2d")
+        assert wb_calculation.gridadmin is not gridadmin
+        assert wb_calculation.line_arrays is not line_arrays
+    # both are results of the bergermeer model
+    assert balance[:3] == expected[:3]
+    np.testing.assert_allclose(balance[4], expected[4])
+
+
+def _move_vertex(polygon, index, dx, dy):
+    moved = QgsGeometry(polygon)
+    point = moved.vertexAt(index)
+    assert moved.moveVertex(point.x() + dx, point.y() + dy, index)
+    return moved
+
+
+@pytest.mark.parametrize("with_nan", [False, True])
+@mock.patch("ThreeDiToolbox.tool_result_selection.models.StatusProgressBar")
+def test_get_balance_incremental_equals_full(
+    progress_bar_mock, with_nan, ts_datasources, wb_polygon
+):
+    """Editing a vertex gives the same balance with and without incremental"""
+    ensure_qgis_app_is_initialized()
+    model_part = "1d and 2d"
+    edited = _move_vertex(wb_polygon, 2, 3e-4, -2e-4)
+    full_calculation = WaterBalanceCalculation(ts_datasources)
+    incremental_calculation = WaterBalanceCalculation(ts_datasources)
+
+    # a NaN in the flows of a link that is selected before and after the edit
+    def get_inflow_links(polygon):
+        link_ids, _ = full_calculation.get_incoming_and_outcoming_link_ids(
+            polygon, model_part
+        )
+        return set(link_ids["2d_in"])
+
+    kept_links = get_inflow_links(wb_polygon) & get_inflow_links(edited)
+    assert kept_links
+    nan_ids = [min(kept_links)] if with_nan else []
+    original_get_timeseries = waterbalance.get_timeseries
+
+    def get_timeseries(threedi_result, variable, timestep_nrs, ids):
+        values = original_get_timeseries(threedi_result, variable, timestep_nrs, ids)
+        if variable == "q_cum_positive":
+            values[2, np.isin(ids, nan_ids)] = np.nan
+        return values
+
+    incremental_path = (
+        "ThreeDiToolbox.tool_water_balance.tools.waterbalance."
+        "incremental_updates_enabled"
+    )
+    with mock.patch(
+        "ThreeDiToolbox.tool_water_balance.tools.waterbalance.get_timeseries",
+        side_effect=get_timeseries,
+    ):
+        with mock.patch(incremental_path, return_value=False):
+            expected = full_calculation.get_balance(edited, model_part)
+        with mock.patch(incremental_path, return_value=True):
+            before = incremental_calculation.get_balance(wb_polygon, model_part)
+            result = incremental_calculation.get_balance(edited, model_part)
+
+    # the edit changes the selection, so the flows are updated
+    assert before[0] != result[0]
+    assert result[:3] == expected[:3]
+    np.testing.assert_array_equal(result[3], expected[3])
+    np.testing.assert_allclose(result[4], expected[4], atol=1e-6)
@@ -0,0 +1,111 @@
+"""Water balances of many areas on one result
+
+The polygons are classified one after another on the (cached) gridadmin
+arrays of one :py:class:`WaterBalanceCalculation`. The aggregation of the
+flows is pure numpy on the values the ThreediResult keeps in memory, so the
+areas are aggregated in parallel on a thread pool after the variables have
+been read once.
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+from ThreeDiToolbox.tool_water_balance.tools.waterbalance import get_closure_errors
+from ThreeDiToolbox.tool_water_balance.tools.waterbalance import get_series_volumes
+from ThreeDiToolbox.tool_water_balance.tools.waterbalance import (
+    MODEL_PART_CLOSURE_BALANCE,
+)
+from ThreeDiToolbox.tool_water_balance.views.waterbalance_widget import (
+    get_model_part_series,
+)
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# The result variables read by ``WaterBalanceCalculation.get_aggregated_flows``
+AGGREGATION_VARIABLES = [
+    "q_cum_positive",
+    "q_cum_negative",
+    "q_pump_cum",
+    "rain_cum",
+    "infiltration_rate_simple_cum",
+    "q_lat_cum",
+    "leak_cum",
+    "intercepted_volume_current",
+    "q_sss_cum",
+    "vol_current",
+]
+
+def load_aggregation_variables(threedi_result):
+    """Read the variables of the water balance into memory
+
+    The ThreediResult caches every variable as a whole on first use. Reading
+    them up front means the areas only index the cached arrays.
+    """
+    for variable in AGGREGATION_VARIABLES:
+        if variable in threedi_result.available_vars:
+            threedi_result.get_values_by_timestep_nr(variable, 0)
+
+
+def calculate_water_balances(
+    calculation, polygons, model_part, max_workers=None, feedback=None
+):
+    """Return the aggregated flows of every polygon
+
+    :param calculation: WaterBalanceCalculation of the result
+    :param polygons: list of QgsGeometry polygons in WGS84
+    :param model_part: '1d and 2d', '2d' or '1d'
+    :param max_workers: number of threads aggregating areas in parallel
+    :param feedback: optional QgsFeedback for the progress and cancelling
+    :return: list with a (ts, total_time) tuple per polygon, like
+        ``WaterBalanceCalculation.get_aggregated_flows``. The list is
+        shorter than ``polygons`` if the feedback has been cancelled.
+    """
+    selections = []
+    for polygon in polygons:
+        if feedback is not None and feedback.isCanceled():
+            return []
+        selections.append(calculation.get_selection(polygon, model_part))
+        if feedback is not None:
+            feedback.setProgress(20 * len(selections) / len(polygons))
+
+    load_aggregation_variables(calculation.threedi_result)
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                calculation.get_aggregated_flows,
+                link_ids,
+                pump_ids,
+                node_ids,
+                model_part,
+            )
+            for link_ids, pump_ids, node_ids in selections
+        ]
+        for future in futures:
+            if feedback is not None and feedback.isCanceled():
+                for remaining in futures:
+                    remaining.cancel()
+                break
+            results.append(future.result())
+            if feedback is not None:
+                feedback.setProgress(20 + 80 * len(results) / len(futures))
+    return results
+
+
+def get_area_volumes(ts, total_time, model_part):
+    """Return the total volume (m3) per series name of the model part"""
+    volumes = get_series_volumes(ts, total_time)
+    return [
+        (name, float(volumes[column]))
+        for name, column in get_model_part_series(model_part)
+    ]
+
+
+def get_area_closure_error(ts, total_time, model_part):
+    """Return the relative closure error of the balance of the model part
+    and whether it is flagged, see ``get_closure_errors``"""
+    closure_error = get_closure_errors(ts, total_time, model_part)[
+        MODEL_PART_CLOSURE_BALANCE[model_part]
+    ]
+    return closure_error["relative_volume"], closure_error["flagged"]
@@ -0,0 +1,61 @@
+"""Export of the water balance flows per timestep
+
+The flows of several areas are written to a CSV table (one row per area and
+timestep) or a NetCDF file (one variable per series with the dimensions area
+and time). The NetCDF is written with h5py as a NetCDF-4 file, the dimensions
+are HDF5 dimension scales.
+
+"""
+import csv
+import h5py
+import numpy as np
+
+
+def write_csv(path, area_ids, ts, total_times, series):
+    """Write the flows of the areas to a CSV file
+
+    :param area_ids: the identifier of every area
+    :param ts: array with the timestamps (seconds)
+    :param total_times: list with the ``total_time`` array of every area, see
+        ``WaterBalanceCalculation.get_aggregated_flows``
+    :param series: list of the (name, column) of the series to write
+    """
+    with open(path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["area", "time"] + [name for name, _ in series])
+        columns = [column for _, column in series]
+        for area_id, total_time in zip(area_ids, total_times):
+            for timestamp, flows in zip(ts, total_time[:, columns]):
+                writer.writerow([area_id, float(timestamp)] + flows.tolist())
+
+
+def write_netcdf(path, area_ids, ts, total_times, series):
+    """Write the flows of the areas to a NetCDF file
+
+    See :py:func:`write_csv` for the parameters.
+    """
+    with h5py.File(path, "w") as netcdf:
+        time = netcdf.create_dataset("time", data=np.asarray(ts, dtype=float))
+        time.attrs["units"] = "s"
+        time.attrs["long_name"] = "time since the start of the simulation"
+        time.make_scale("time")
+        area = netcdf.create_dataset("area", data=np.arange(len(area_ids)))
+        area.make_scale("area")
+        area_id = netcdf.create_dataset(
+            "area_id",
+            data=np.array([str(area_id) for area_id in area_ids], dtype=object),
+            dtype=h5py.string_dtype(),
+        )
+        area_id.dims[0].attach_scale(area)
+
+        for name, column in series:
+            flows = netcdf.create_dataset(
+                name,
+                data=np.array(
+                    [total_time[:, column] for total_time in total_times], dtype=float
+                ).reshape(len(area_ids), len(ts)),
+            )
+            flows.attrs["units"] = "m3 s-1"
+            flows.attrs["long_name"] = name
+            flows.dims[0].attach_scale(area)
+            flows.dims[1].attach_scale(time)
@@ -0,0 +1,163 @@
+"""Incremental update of a water balance on edits of its polygon
+
+The flows of a water balance are sums of the contributions of its flowlines,
+pumps and nodes. When the polygon changes, only the points in the symmetric
+difference of the old and new polygon change side, so only those are tested.
+The flows of the objects that left the selection are subtracted and the flows
+of the objects that entered it are added.
+
+A NaN in the results makes the flow of its whole category 0 (at that
+timestep), which doesn't add up. The flows that are NaN are tracked: they stay
+0 as long as the object with the NaN is selected. If an object with a NaN
+leaves the selection, the flows are recomputed, because other objects with a
+NaN may remain.
+
+"""
+from qgis.core import QgsGeometry
+from qgis.core import QgsWkbTypes
+from qgis.PyQt.QtCore import QSettings
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+INCREMENTAL_SETTING = "water_balance_incremental_updates"
+
+
+def incremental_updates_enabled():
+    """Return whether the water balance is updated incrementally
+
+    If enabled (the default), a changed polygon only reclassifies the area
+    that changed and updates the flows with the objects that changed.
+    """
+    settings = QSettings("3di", "qgisplugin")
+    return settings.value(INCREMENTAL_SETTING, True, type=bool)
+
+
+def diff_ids(old, new):
+    """Return the ids per category that are removed from and added to ``old``
+
+    :param old: dict with a list of ids per category
+    :param new: dict with a list of ids per category
+    :return: tuple (removed, added) of dicts with a sorted list per category
+    """
+    removed = {
+        key: sorted(set(ids) - set(new.get(key, []))) for key, ids in old.items()
+    }
+    added = {
+        key: sorted(set(ids) - set(old.get(key, []))) for key, ids in new.items()
+    }
+    return removed, added
+
+
+def _nr_ids(selection):
+    return sum(len(ids) for category_ids in selection for ids in category_ids.values())
+
+
+class IncrementalBalance(object):
+    """Water balance of one polygon at a time, updated on changes
+
+    :param calculation: WaterBalanceCalculation of the result
+    :param model_part: '1d and 2d', '2d' or '1d'
+    """
+
+    def __init__(self, calculation, model_part):
+        self.calculation = calculation
+        self.model_part = model_part
+        self.file_path = calculation.threedi_result.file_path
+        self.polygon = None
+        self.masks = None
+        self.selection = None
+        self.ts = None
+        self.total_time = None
+        self.nan = None
+
+    def _get_changed_region(self, polygon):
+        """Return the area between the old and new polygon, None if unknown"""
+        if self.polygon is None:
+            return None
+        if not (self.polygon.isGeosValid() and polygon.isGeosValid()):
+            return None
+        region = self.polygon.symDifference(polygon)
+        if region.isNull() or region.type() != QgsWkbTypes.PolygonGeometry:
+            return None
+        return region
+
+    def update(self, polygon):
+        """Return the balance of the (changed) polygon
+
+        :return: tuple (link_ids, pump_ids, node_ids, ts, total_time), see
+            ``WaterBalanceCalculation.get_balance``
+        """
+        calculation = self.calculation
+        region = self._get_changed_region(polygon)
+        if region is None:
+            masks = calculation.get_inside_masks(polygon)
+        else:
+            flipped = calculation.get_inside_masks(region)
+            masks = {key: mask ^ flipped[key] for key, mask in self.masks.items()}
+        selection = calculation.get_link_ids(masks) + (
+            calculation.get_node_ids(masks, self.model_part),
+        )
+
+        removed, added = None, None
+        if region is not None:
+            diffs = [diff_ids(old, new) for old, new in zip(self.selection, selection)]
+            removed = [diff[0] for diff in diffs]
+            added = [diff[1] for diff in diffs]
+            # recompute if that's less work than the changes
+            if _nr_ids(removed) + _nr_ids(added) >= _nr_ids(selection):
+                removed, added = None, None
+
+        flows = None
+        if removed is not None:
+            flows = self._update_flows(removed, added)
+        if flows is None:
+            flows = calculation.get_aggregated_flows(
+                *selection, self.model_part, with_nan=True
+            )
+        ts, total_time, nan = flows
+
+        self.polygon = QgsGeometry(polygon)
+        self.masks = masks
+        self.selection = selection
+        self.ts = ts
+        self.total_time = total_time
+        self.nan = nan
+        return selection + (ts, total_time)
+
+    def _update_flows(self, removed, added):
+        """Return (ts, total_time, nan) updated with the changed objects
+
+        Returns None if an object with a NaN flow is removed, then the flows
+        have to be recomputed.
+        """
+        # waterbalance imports this module
+        from .waterbalance import set_closure_residuals
+
+        calculation = self.calculation
+        total_time = self.total_time.copy()
+        nan = self.nan.copy()
+        if _nr_ids(removed):
+            _, removed_flows, removed_nan = calculation.get_aggregated_flows(
+                *removed, self.model_part, with_nan=True
+            )
+            if removed_nan.any():
+                return None
+            total_time -= removed_flows
+        if _nr_ids(added):
+            _, added_flows, added_nan = calculation.get_aggregated_flows(
+                *added, self.model_part, with_nan=True
+            )
+            total_time += added_flows
+            nan |= added_nan
+        logger.info(
+            "Updated the water balance with %d removed and %d added objects",
+            _nr_ids(removed),
+            _nr_ids(added),
+        )
+        # like in a full computation, a NaN makes the flow of its category 0
+        total_time[nan] = 0.0
+        set_closure_residuals(total_time, self.model_part)
+        return self.ts, total_time, nan
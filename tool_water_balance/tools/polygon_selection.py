@@ -0,0 +1,176 @@
+"""Selection of the flowlines, pumps and nodes of a water balance polygon
+
+The selection works on the gridadmin arrays (start and end coordinates, line
+types and ids) instead of on layer features: a vectorized point-in-polygon
+test of all start and end vertices, combined with boolean masks, gives every
+flowline category at once.
+
+"""
+import numpy as np
+
+
+# Line types of the 1D flowlines
+LINE_TYPES_1D = ("1d", "v2_pipe", "v2_channel", "v2_culvert", "v2_orifice", "v2_weir")
+
+
+def get_polygon_rings(polygon):
+    """Return the rings of a (multi)polygon QgsGeometry as (N, 2) arrays"""
+    if polygon.isMultipart():
+        parts = polygon.asMultiPolygon()
+    else:
+        parts = [polygon.asPolygon()]
+    return [
+        np.array([(point.x(), point.y()) for point in ring], dtype=float)
+        for part in parts
+        for ring in part
+        if len(ring) > 2
+    ]
+
+
+def points_in_rings(rings, x, y):
+    """Return a boolean array: which points are inside the rings
+
+    Even-odd rule ray casting, vectorized over the points. Holes and the
+    parts of a multipolygon are rings as well, so they are handled by the
+    same rule.
+
+    :param rings: list of (N, 2) arrays, see :py:func:`get_polygon_rings`
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    inside = np.zeros(x.shape, dtype=bool)
+    if not rings:
+        return inside
+    vertices = np.concatenate(rings)
+    # only test the points within the bounding box
+    candidates = np.flatnonzero(
+        (x >= vertices[:, 0].min())
+        & (x <= vertices[:, 0].max())
+        & (y >= vertices[:, 1].min())
+        & (y <= vertices[:, 1].max())
+    )
+    px = x[candidates]
+    py = y[candidates]
+    candidate_inside = np.zeros(candidates.size, dtype=bool)
+    for ring in rings:
+        x1, y1 = ring[:-1, 0], ring[:-1, 1]
+        x2, y2 = ring[1:, 0], ring[1:, 1]
+        for i in range(x1.size):
+            if y1[i] == y2[i]:
+                continue
+            crosses = (y1[i] > py) != (y2[i] > py)
+            x_cross = x1[i] + (py - y1[i]) * (x2[i] - x1[i]) / (y2[i] - y1[i])
+            candidate_inside ^= crosses & (px < x_cross)
+    inside[candidates] = candidate_inside
+    return inside
+
+
+def points_in_polygon(polygon, x, y):
+    """Return a boolean array: which points are inside the QgsGeometry"""
+    return points_in_rings(get_polygon_rings(polygon), x, y)
+
+
+def _ids(ids, mask):
+    return ids[mask].tolist()
+
+
+def get_flowline_categories(line_arrays, start_inside, end_inside):
+    """Return the ids of the flowlines per water balance category
+
+    :param line_arrays: dict with the arrays ``id``, ``type``, ``x1``, ``y1``,
+        ``x2``, ``y2`` and the boolean masks ``x_dir``, ``y_dir``,
+        ``x_dir_groundwater`` and ``y_dir_groundwater`` of the horizontal and
+        vertical (in top view) 2D lines
+    :param start_inside: boolean array, whether the start vertices are inside
+    :param end_inside: boolean array, whether the end vertices are inside
+    :return: dict with a sorted list of line ids per category, like
+        ``WaterBalanceCalculation.get_incoming_and_outcoming_link_ids``
+        without the boundary categories
+    """
+    types = line_arrays["type"]
+    ids = line_arrays["id"]
+
+    # the '_out' and '_in' indicate the draw direction of the flow_line:
+    # the start vertex inside the polygon (and the end vertex outside) is
+    # 'outgoing', the end vertex inside is 'incoming'
+    outgoing = start_inside & ~end_inside
+    incoming = end_inside & ~start_inside
+    crossing = outgoing | incoming
+    is_1d = np.isin(types, LINE_TYPES_1D)
+    is_1d_2d = types == "1d_2d"
+
+    # 2d links drawing direction is always from south to north or west to
+    # east. With the start vertex inside, positive discharge flows out of
+    # the polygon if the line is directed to the east (x-dir line) or north
+    # (y-dir line).
+    east = line_arrays["x2"] > line_arrays["x1"]
+    north = line_arrays["y2"] > line_arrays["y1"]
+
+    def out_and_in(x_dir, y_dir):
+        forward = (x_dir & east) | (y_dir & north)
+        directed = x_dir | y_dir
+        positive_out = directed & ((outgoing & forward) | (incoming & ~forward))
+        positive_in = directed & ((outgoing & ~forward) | (incoming & forward))
+        return positive_out, positive_in
+
+    is_2d = crossing & (types == "2d")
+    out_2d, in_2d = out_and_in(
+        is_2d & line_arrays["x_dir"], is_2d & line_arrays["y_dir"]
+    )
+    is_2d_groundwater = crossing & (types == "2d_groundwater")
+    out_groundwater, in_groundwater = out_and_in(
+        is_2d_groundwater & line_arrays["x_dir_groundwater"],
+        is_2d_groundwater & line_arrays["y_dir_groundwater"],
+    )
+
+    return {
+        "1d_in": _ids(ids, incoming & is_1d),
+        "1d_out": _ids(ids, outgoing & is_1d),
+        "2d_in": _ids(ids, in_2d),
+        "2d_out": _ids(ids, out_2d),
+        # draw direction of 1d_2d is always from 2d node to 1d node. So when
+        # the 2d node is inside the polygon (and the 1d node is not) it is a
+        # '2d__1d_2d_flow' link and vice versa.
+        "1d__1d_2d_flow": _ids(ids, incoming & is_1d_2d),
+        "2d__1d_2d_flow": _ids(ids, outgoing & is_1d_2d),
+        # 1d2d exchange lines are within polygon (both nodes inside)
+        "1d_2d_exch": _ids(ids, start_inside & end_inside & is_1d_2d),
+        "2d_groundwater_in": _ids(ids, in_groundwater),
+        "2d_groundwater_out": _ids(ids, out_groundwater),
+        # 2d vertical infiltration line is handmade diagonal (drawn from 2d
+        # point towards south-west). Thus, if at least its startpoint is
+        # within polygon then include the line
+        "2d_vertical_infiltration": _ids(
+            ids, start_inside & (types == "2d_vertical_infiltration")
+        ),
+    }
+
+
+def get_pump_categories(pump_arrays, start_inside, end_inside):
+    """Return the ids of the pumps pumping into and out of the polygon
+
+    :param pump_arrays: dict with the arrays ``id``, ``x1``, ``y1``, ``x2``
+        and ``y2`` of the pump lines
+    :param start_inside: boolean array, whether the start vertices are inside
+    :param end_inside: boolean array, whether the end vertices are inside
+    :return: dict with the sorted ids of the 'in' and 'out' pumps
+    """
+    return {
+        "in": _ids(pump_arrays["id"], end_inside & ~start_inside),
+        "out": _ids(pump_arrays["id"], start_inside & ~end_inside),
+    }
+
+
+def get_node_categories(node_arrays, inside, node_types):
+    """Return the ids of the nodes inside the polygon per node type
+
+    :param node_arrays: dict with the arrays ``id``, ``type``, ``x`` and ``y``
+        of the nodes
+    :param inside: boolean array, whether the nodes are inside
+    :param node_types: the node types ('1d', '2d', ...) to select
+    :return: dict with the sorted ids per node type
+    """
+    return {
+        node_type: _ids(node_arrays["id"], inside & (node_arrays["type"] == node_type))
+        for node_type in node_types
+    }
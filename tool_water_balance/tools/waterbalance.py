@@ -1,13 +1,38 @@
-from qgis.core import QgsFeatureRequest
-from qgis.core import QgsPointXY
+from cached_property import cached_property
+from collections import OrderedDict
 from qgis.PyQt.QtCore import Qt
 from qgis.PyQt.QtWidgets import QMessageBox
 from ThreeDiToolbox.datasource.threedi_results import find_h5_file
+from ThreeDiToolbox.tool_water_balance.tools.incremental import (
+    incremental_updates_enabled,
+)
+from ThreeDiToolbox.tool_water_balance.tools.incremental import IncrementalBalance
+from ThreeDiToolbox.tool_water_balance.tools.polygon_selection import (
+    get_flowline_categories,
+)
+from ThreeDiToolbox.tool_water_balance.tools.polygon_selection import (
+    get_node_categories,
+)
+from ThreeDiToolbox.tool_water_balance.tools.polygon_selection import get_polygon_rings
+from ThreeDiToolbox.tool_water_balance.tools.polygon_selection import (
+    get_pump_categories,
+)
+from ThreeDiToolbox.tool_water_balance.tools.polygon_selection import points_in_polygon
+from ThreeDiToolbox.tool_water_balance.tools.polygon_selection import points_in_rings
 from ThreeDiToolbox.tool_water_balance.views.waterbalance_widget import (
     WaterBalanceWidget,
 )
+from ThreeDiToolbox.utils.gridadmin import QgisLinesOgrExporter
+from ThreeDiToolbox.utils.gridadmin import QgisNodesOgrExporter
+from ThreeDiToolbox.utils.gridadmin import QgisPumpsOgrExporter
+from ThreeDiToolbox.utils.layer_from_netCDF import IGNORE_FIRST
+from ThreeDiToolbox.utils.layer_from_netCDF import WGS84_EPSG
+from ThreeDiToolbox.utils.line_adjacency import ENDS_AT_NODE
+from ThreeDiToolbox.utils.line_adjacency import STARTS_AT_NODE
 from ThreeDiToolbox.utils.patched_threedigrid import GridH5Admin
 
+import copy
+import hashlib
 import logging
 import numpy as np
 import numpy.ma as ma
@@ -15,13 +40,194 @@ import numpy.ma as ma
 
 logger = logging.getLogger(__name__)
 
+# Number of polygons of which the selection and flows are memoized
+BALANCE_CACHE_SIZE = 8
+
+# The balances of which the closure error is calculated: the change in storage
+# minus the fluxes, in the error column of the INPUT_SERIES. The 1D-2D
+# exchange and the vertical infiltration within the polygon cancel out in the
+# combined balances.
+CLOSURE_BALANCES = {
+    # name: (error column, storage columns, flux columns, model parts)
+    "error_2d": (
+        20,
+        [18, 25],
+        [0, 1, 4, 5, 14, 15, 16, 23, 24, 26, 30, 31, 32, 33, 34, 35],
+        ["1d and 2d", "2d"],
+    ),
+    "error_1d": (
+        21,
+        [19],
+        [2, 3, 6, 7, 8, 9, 10, 11, 12, 13, 17, 27],
+        ["1d and 2d", "1d"],
+    ),
+    "error_1d_2d": (
+        22,
+        [18, 19, 25],
+        [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 12, 13, 14, 15, 16, 17, 23, 24, 26, 27]
+        + [30, 31, 34, 35],
+        ["1d and 2d"],
+    ),
+}
+
+# The balance that includes all flows of a model part
+MODEL_PART_CLOSURE_BALANCE = {
+    "1d and 2d": "error_1d_2d",
+    "2d": "error_2d",
+    "1d": "error_1d",
+}
+
+# Relative closure error (of the total volume) above which a balance is flagged
+CLOSURE_ERROR_THRESHOLD = 0.05
+
+
+def get_timeseries(threedi_result, variable, timestep_nrs, ids):
+    """Return the values of ``ids`` for the given timesteps as 2d array
+
+    :param timestep_nrs: 1d array of timestep numbers
+    :return: float array of shape (len(timestep_nrs), len(ids))
+    """
+    timestep_nrs = np.asarray(timestep_nrs)
+    values = threedi_result.get_values_by_timestep_nr(variable, timestep_nrs, ids)
+    # one timestep gives a 1d array
+    values = np.reshape(values, (timestep_nrs.size, np.size(ids)))
+    # masked values are left out of the sums, like with masked arrays
+    return ma.filled(values, 0).astype(float)
+
+
+def get_membership_matrix(categories, category_names):
+    """Return a one-hot matrix (len(categories), len(category_names))
+
+    ``values @ matrix`` sums the columns of ``values`` per category.
+    """
+    return (
+        np.asarray(categories)[:, None] == np.asarray(category_names)[None, :]
+    ).astype(float)
+
+
+def sum_by_category(values, membership):
+    """Return the sum of the columns of ``values`` per category
+
+    Like summing per category separately, a NaN only makes the sum of its own
+    category NaN.
+
+    :param values: array (T, N)
+    :param membership: matrix (N, C), see :py:func:`get_membership_matrix`
+    :return: array (T, C)
+    """
+    nan = np.isnan(values)
+    totals = np.where(nan, 0.0, values) @ membership
+    if nan.any():
+        totals[(nan @ np.abs(membership)) > 0] = np.nan
+    return totals
+
+
+def get_flow_durations(ts):
+    """Return the durations that turn the volumes per timestep into flows
+
+    The first timestep is divided by the duration of the second one, just to
+    make sure machine precision distortion is reduced for the first timestamp
+    (everything should be 0). The second one is divided by its time since 0.
+    """
+    dt = np.empty(np.size(ts, 0))
+    dt[0] = ts[1] - ts[0]
+    dt[1] = ts[1]
+    dt[2:] = np.diff(ts[1:])
+    return dt
+
+
+def get_series_volumes(ts, total_time):
+    """Return the total volume of every series of ``total_time``
+
+    The flows are multiplied by the time since the previous timestamp, like
+    the 'm3 cumulative' aggregation of the graph.
+    """
+    return (total_time * np.append([0], np.diff(ts))[:, None]).sum(axis=0)
+
+
+def get_closure_matrix(model_part):
+    """Return the matrix of which ``total_time @ matrix`` are the residuals
+
+    The residual of a balance is its change in storage minus its fluxes, the
+    balances of other model parts have a residual of 0.
+
+    :return: matrix (len(INPUT_SERIES), len(CLOSURE_BALANCES))
+    """
+    matrix = np.zeros((len(WaterBalanceWidget.INPUT_SERIES), len(CLOSURE_BALANCES)))
+    for i, (_, storage, fluxes, model_parts) in enumerate(CLOSURE_BALANCES.values()):
+        if model_part in model_parts:
+            matrix[storage, i] = 1
+            matrix[fluxes, i] = -1
+    return matrix
+
+
+def set_closure_residuals(total_time, model_part):
+    """Write the residuals of the balances of ``model_part`` into ``total_time``
+
+    The residuals are linear in the flows, so they can be computed again after
+    the flows are changed, e.g. by an incremental update.
+    """
+    error_columns = [column for column, _, _, _ in CLOSURE_BALANCES.values()]
+    total_time[:, error_columns] = total_time @ get_closure_matrix(model_part)
+
+
+def get_closure_errors(ts, total_time, model_part):
+    """Return the closure errors of the balances of a model part
+
+    :param ts: array with the timestamps
+    :param total_time: flows with the residuals in the error columns, see
+        ``WaterBalanceCalculation.get_aggregated_flows``
+    :return: dict per CLOSURE_BALANCES name with the ``residual`` (m3/s) and
+        ``relative_error`` (of the gross flux) per timestep, the total
+        residual ``volume`` (m3), its ``relative_volume`` and whether it is
+        ``flagged`` for exceeding the CLOSURE_ERROR_THRESHOLD
+    """
+    durations = np.append([0], np.diff(ts))
+    closure_errors = {}
+    for name, (column, _, fluxes, model_parts) in CLOSURE_BALANCES.items():
+        if model_part not in model_parts:
+            continue
+        residual = total_time[:, column]
+        gross = np.abs(total_time[:, fluxes]).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            relative_error = np.where(gross > 0, np.abs(residual) / gross, 0.0)
+        volume = float((residual * durations).sum())
+        gross_volume = float((gross * durations).sum())
+        relative_volume = abs(volume) / gross_volume if gross_volume > 0 else 0.0
+        closure_errors[name] = {
+            "residual": residual,
+            "relative_error": relative_error,
+            "volume": volume,
+            "relative_volume": relative_volume,
+            "flagged": relative_volume > CLOSURE_ERROR_THRESHOLD,
+        }
+    return closure_errors
+
 
 class WaterBalanceCalculation(object):
-    def __init__(self, ts_datasources):
+    """Water balance of polygons on a 3Di result
+
+    :param ts_datasources: the result selection model, the water balance is
+        calculated on its first result
+    :param threedi_result: ThreediResult to use instead of the result
+        selection, e.g. outside of the plugin's GUI
+    """
+
+    def __init__(self, ts_datasources=None, threedi_result=None):
         self.ts_datasources = ts_datasources
+        self._threedi_result = threedi_result
+        self._balances = OrderedDict()
+        self._incremental_balances = {}
+        self._gridadmin_file_path = None
+        self._load_gridadmin()
+
+    def _load_gridadmin(self):
+        """Load the gridadmin of the current result
 
-        # gridadmin
-        nc_path = self.ts_datasources.rows[0].threedi_result().file_path
+        The arrays used for the polygon selection are derived from it, they
+        are rebuilt on first use.
+        """
+        nc_path = self.threedi_result.file_path
         h5 = find_h5_file(nc_path)
         ga = GridH5Admin(h5)
 
@@ -66,6 +272,128 @@ class WaterBalanceCalculation(object):
             self.y_grndwtr_range = list(
                 range(y_grndwtr_range_min, y_grndwtr_range_max + 1)
             )
+        self.gridadmin = ga
+        self._gridadmin_file_path = nc_path
+        for name in ("line_arrays", "node_arrays", "pump_arrays"):
+            self.__dict__.pop(name, None)  # reset the cached_property
+
+    def _ensure_current_gridadmin(self):
+        """Reload the gridadmin if the result has changed since it was loaded
+
+        The result of the result selection changes when the user selects
+        another result.
+        """
+        if self.threedi_result.file_path != self._gridadmin_file_path:
+            self._load_gridadmin()
+
+    @property
+    def threedi_result(self):
+        if self._threedi_result is not None:
+            return self._threedi_result
+        return self.ts_datasources.rows[0].threedi_result()
+
+    @cached_property
+    def line_arrays(self):
+        """The (WGS84) arrays of the flowlines used for the polygon selection"""
+        line_data = (
+            self.gridadmin.lines.slice(IGNORE_FIRST).reproject_to(str(WGS84_EPSG)).data
+        )
+        x1, y1, x2, y2 = QgisLinesOgrExporter.get_coordinates(line_data)
+        ids = line_data["id"].astype(int)
+        line_arrays = {
+            "id": ids,
+            "type": QgisLinesOgrExporter.get_line_types(line_data),
+            "x1": x1,
+            "y1": y1,
+            "x2": x2,
+            "y2": y2,
+            "x_dir": np.isin(ids, self.x2d_surf_range),
+            "y_dir": np.isin(ids, self.y2d_surf_range),
+            "x_dir_groundwater": np.zeros(ids.shape, dtype=bool),
+            "y_dir_groundwater": np.zeros(ids.shape, dtype=bool),
+        }
+        if self.gridadmin.has_groundwater:
+            line_arrays["x_dir_groundwater"] = np.isin(ids, self.x_grndwtr_range)
+            line_arrays["y_dir_groundwater"] = np.isin(ids, self.y_grndwtr_range)
+        return line_arrays
+
+    @cached_property
+    def node_arrays(self):
+        """The (WGS84) arrays of the nodes used for the polygon selection"""
+        node_data = (
+            self.gridadmin.nodes.slice(IGNORE_FIRST).reproject_to(str(WGS84_EPSG)).data
+        )
+        x, y = QgisNodesOgrExporter.get_coordinates(node_data)
+        columns = QgisNodesOgrExporter.get_attribute_columns(node_data)
+        return {
+            "id": node_data["id"].astype(int),
+            "type": np.asarray(columns["type"], dtype=object),
+            "x": x,
+            "y": y,
+        }
+
+    @cached_property
+    def pump_arrays(self):
+        """The (WGS84) arrays of the pumps, None without pumps"""
+        if not self.gridadmin.has_pumpstations:
+            return None
+        pump_data = (
+            self.gridadmin.pumps.slice(IGNORE_FIRST).reproject_to(str(WGS84_EPSG)).data
+        )
+        x1, y1, x2, y2 = QgisPumpsOgrExporter.get_coordinates(pump_data)
+        return {
+            "id": pump_data["id"].astype(int),
+            "x1": x1,
+            "y1": y1,
+            "x2": x2,
+            "y2": y2,
+        }
+
+    def get_balance(self, wb_polygon, model_part):
+        """Return the selection and the aggregated flows of a polygon
+
+        The result is memoized per (result, polygon, model part), so changing
+        the view of the same polygon doesn't recompute it. Copies are
+        returned, as the callers modify them. A changed polygon is updated
+        incrementally, see :py:mod:`.incremental`.
+
+        :return: tuple (link_ids, pump_ids, node_ids, ts, total_time), see
+            :py:meth:`get_incoming_and_outcoming_link_ids`,
+            :py:meth:`get_nodes` and :py:meth:`get_aggregated_flows`
+        """
+        self._ensure_current_gridadmin()
+        key = (
+            self.threedi_result.file_path,
+            hashlib.sha1(bytes(wb_polygon.asWkb())).hexdigest(),
+            model_part,
+        )
+        if key in self._balances:
+            self._balances.move_to_end(key)
+        elif incremental_updates_enabled():
+            incremental_balance = self._incremental_balances.get(model_part)
+            if (
+                incremental_balance is None
+                or incremental_balance.file_path != self.threedi_result.file_path
+            ):
+                incremental_balance = IncrementalBalance(self, model_part)
+                self._incremental_balances[model_part] = incremental_balance
+            self._balances[key] = incremental_balance.update(wb_polygon)
+        else:
+            link_ids, pump_ids, node_ids = self.get_selection(wb_polygon, model_part)
+            ts, total_time = self.get_aggregated_flows(
+                link_ids, pump_ids, node_ids, model_part
+            )
+            self._balances[key] = (link_ids, pump_ids, node_ids, ts, total_time)
+        while len(self._balances) > BALANCE_CACHE_SIZE:
+            self._balances.popitem(last=False)
+        link_ids, pump_ids, node_ids, ts, total_time = self._balances[key]
+        return (
+            copy.deepcopy(link_ids),
+            copy.deepcopy(pump_ids),
+            copy.deepcopy(node_ids),
+            ts.copy(),
+            total_time.copy(),
+        )
 
     def get_incoming_and_outcoming_link_ids(self, wb_polygon, model_part):
         """Returns a tuple of dictionaries with ids by category:
@@ -89,7 +417,54 @@ class WaterBalanceCalculation(object):
         # links, even when the 2D or 1D modelpart is selected in the combo box.
 
         logger.info("polygon of wb area: %s", wb_polygon.asWkt())
+        flow_lines, pump_selection = self.get_link_ids(
+            self.get_inside_masks(wb_polygon)
+        )
+        logger.info(str(flow_lines))
+        return flow_lines, pump_selection
+
+    def get_selection(self, polygon, model_part):
+        """Return the (link_ids, pump_ids, node_ids) inside the polygon
+
+        Like :py:meth:`get_incoming_and_outcoming_link_ids` and
+        :py:meth:`get_nodes`, but the vertices are tested against the polygon
+        only once.
+        """
+        masks = self.get_inside_masks(polygon)
+        link_ids, pump_ids = self.get_link_ids(masks)
+        return link_ids, pump_ids, self.get_node_ids(masks, model_part)
+
+    def get_inside_masks(self, polygon):
+        """Return which vertices of the lines, pumps and nodes are inside
+
+        :return: dict with the boolean arrays ``line_start``, ``line_end``,
+            ``node`` and (with pumps) ``pump_start`` and ``pump_end``
+        """
+        self._ensure_current_gridadmin()
+        rings = get_polygon_rings(polygon)
+        line_arrays = self.line_arrays
+        masks = {
+            "line_start": points_in_rings(rings, line_arrays["x1"], line_arrays["y1"]),
+            "line_end": points_in_rings(rings, line_arrays["x2"], line_arrays["y2"]),
+            "node": points_in_rings(
+                rings, self.node_arrays["x"], self.node_arrays["y"]
+            ),
+        }
+        if self.pump_arrays is not None:
+            masks["pump_start"] = points_in_rings(
+                rings, self.pump_arrays["x1"], self.pump_arrays["y1"]
+            )
+            masks["pump_end"] = points_in_rings(
+                rings, self.pump_arrays["x2"], self.pump_arrays["y2"]
+            )
+        return masks
+
+    def get_link_ids(self, masks):
+        """Return the (flow_lines, pump_selection) of the inside masks
 
+        See :py:meth:`get_incoming_and_outcoming_link_ids` and
+        :py:meth:`get_inside_masks`.
+        """
         # the '_out' and '_in' indicate the draw direction of the flow_line.
         # a flow line can have in 1 simulation both positive and negative
         # discharge (with extend to the draw direction). Later on, in
@@ -118,259 +493,32 @@ class WaterBalanceCalculation(object):
         }
         pump_selection = {"in": [], "out": []}
 
-        lines, points, pumps = self.ts_datasources.rows[0].get_result_layers()
-
-        # all links in and out
-        # use bounding box and spatial index to prefilter lines
-        request_filter = QgsFeatureRequest().setFilterRect(
-            wb_polygon.get().boundingBox()
-        )
-        for line in lines.getFeatures(request_filter):
-
-            if line["type"] == "2d_vertical_infiltration":
-                geom = line.geometry().asPolyline()
-                # 2d vertical infiltration line is handmade diagonal (drawn
-                # from 2d point 15m towards south-west ). Thus, if at-least
-                # its startpoint is within polygon then include the line
-                if wb_polygon.contains(QgsPointXY(geom[0])):
-                    flow_lines["2d_vertical_infiltration"].append(line["id"])
-
-            # test if lines are crossing boundary of polygon
-            if line.geometry().crosses(wb_polygon):
-                geom = line.geometry().asPolyline()
-                # check if flow is in or out by testing if startpoint
-                # is inside polygon --> out
-                outgoing = wb_polygon.contains(QgsPointXY(geom[0]))
-                # check if flow is in or out by testing if endpoint
-                # is inside polygon --> in
-                incoming = wb_polygon.contains(QgsPointXY(geom[-1]))
-
-                if incoming and outgoing:
-                    # skip lines that do have start- and end vertex outside of
-                    # polygon
-                    pass
-                elif outgoing:
-                    if line["type"] in [
-                        "1d",
-                        "v2_pipe",
-                        "v2_channel",
-                        "v2_culvert",
-                        "v2_orifice",
-                        "v2_weir",
-                    ]:
-                        flow_lines["1d_out"].append(line["id"])
-                    elif line["type"] in ["1d_2d"]:
-                        # draw direction of 1d_2d is always from 2d node to
-                        # 1d node. So when 2d node is inside polygon (and 1d
-                        # node is not) we define it as a '2d__1d_2d_flow' link
-                        # because
-                        flow_lines["2d__1d_2d_flow"].append(line["id"])
-                elif incoming:
-                    if line["type"] in [
-                        "1d",
-                        "v2_pipe",
-                        "v2_channel",
-                        "v2_culvert",
-                        "v2_orifice",
-                        "v2_weir",
-                    ]:
-                        flow_lines["1d_in"].append(line["id"])
-                    elif line["type"] in ["1d_2d"]:
-                        # draw direction of 1d_2d is always from 2d node to
-                        # 1d node. So when 1d node is inside polygon (and 2d
-                        # node is not) we define it as a '1d__1d_2d_flow' link
-                        flow_lines["1d__1d_2d_flow"].append(line["id"])
-
-                if line["type"] in ["2d"] and not (incoming and outgoing):
-                    # 2d lines are a separate story: discharge on a 2d
-                    # link in the nc can be positive and negative during 1
-                    # simulation - like you would expect - but we also have
-                    # to account for 2d link direction. We have to determine
-                    # two things:
-
-                    # A) is 2d link a vertical or horizontal one. Why?
-                    # vertical 2d lines (calc cells above each other):
-                    # when positive discharge then flow is to north, negative
-                    # discharge then flow southwards, while horizontal 2d lines
-                    # (calc cells next to each other) yields positive discharge
-                    # is flow to the east, negative is flow to west
-
-                    # B) how the start and endpoint are located with
-                    # reference to each other. Why? a positive discharge on
-                    # a vertical link in the north of your polygon DECREASES
-                    # the volume in the polygon, while a positive discharge on
-                    # a vertical link in the south of your polygon INCREASES
-                    # the volume in the polygon).
-
-                    # so why not only determine (B)?
-                    # because then a positive discharge on a diagonal 2d link -
-                    # in topview e.g. left up to right down - can mean flow
-                    # to east. But it can also mean flow to the north. If we
-                    # know it is a vertical link we can be sure flow is to the
-                    # north (thats why we need to know (A)
-
-                    # TODO: after I made this code Martijn Siemerink adviced:
-                    # 2d links drawing direction is always from south to north
-                    # OR west to east, so it not required to get start- and
-                    # endpoint of a 2d link
-
-                    start_x = geom[0][0]
-                    start_y = geom[0][1]
-                    end_x = geom[-1][0]
-                    end_y = geom[-1][1]
-
-                    # horizontal line?
-                    if line.id() in self.x2d_surf_range:
-                        # startpoint in polygon?
-                        if wb_polygon.contains(QgsPointXY(geom[0])):
-                            # directed to east?
-                            # long coords increase going east, so:
-                            if end_x > start_x:
-                                # thus, positive q means flow to east.
-                                # Startpoint is in polygon. Endpoint is
-                                # located eastwards of startpoint, so positive
-                                # q means flow goes OUT!! of polygon
-                                flow_lines["2d_out"].append(line["id"])
-                            else:
-                                flow_lines["2d_in"].append(line["id"])
-                        # endpoint in polygon?
-                        elif wb_polygon.contains(QgsPointXY(geom[-1])):
-                            # directed to east?
-                            # long coords increase going east
-                            if end_x > start_x:
-                                # positive q means flow to east. Endpoint is
-                                # inside polygon and located eastwards of
-                                # startpoint, so positive q means flow goes
-                                # INTO!! polygon
-                                flow_lines["2d_in"].append(line["id"])
-                            else:
-                                flow_lines["2d_out"].append(line["id"])
-
-                    # vertical line?
-                    if line.id() in self.y2d_surf_range:
-                        # startpoint in polygon?
-                        if wb_polygon.contains(QgsPointXY(geom[0])):
-                            # directed to north?
-                            # lat coords increase going north, so:
-                            if end_y > start_y:
-                                # thus, positive q means flow to north.
-                                # Startpoint is in polygon. Endpoint is
-                                # located northwards of startpoint, so positive
-                                # q means flow goes OUT!! of polygon
-                                flow_lines["2d_out"].append(line["id"])
-                            else:
-                                flow_lines["2d_in"].append(line["id"])
-                        # endpoint in polygon?
-                        elif wb_polygon.contains(QgsPointXY(geom[-1])):
-                            # directed to north?
-                            # lat coords increase going north, so:
-                            if end_y > start_y:
-                                # positive q means flow to north. Endpoint is
-                                # inside polygon and located northwards of
-                                # startpoint, so flow goes INTO!! polygon
-                                flow_lines["2d_in"].append(line["id"])
-                            else:
-                                flow_lines["2d_out"].append(line["id"])
-
-                if line["type"] in ["2d_groundwater"] and not (incoming and outgoing):
-
-                    start_x = geom[0][0]
-                    start_y = geom[0][1]
-                    end_x = geom[-1][0]
-                    end_y = geom[-1][1]
-
-                    # horizontal line?
-                    if line.id() in self.x_grndwtr_range:
-                        # startpoint in polygon?
-                        if wb_polygon.contains(QgsPointXY(geom[0])):
-                            if end_x > start_x:
-                                flow_lines["2d_groundwater_out"].append(line["id"])
-                            else:
-                                flow_lines["2d_groundwater_in"].append(line["id"])
-                        # endpoint in polygon?
-                        elif wb_polygon.contains(QgsPointXY(geom[-1])):
-                            if end_x > start_x:
-                                flow_lines["2d_groundwater_in"].append(line["id"])
-                            else:
-                                flow_lines["2d_groundwater_out"].append(line["id"])
-                    # vertical line?
-                    if line.id() in self.y_grndwtr_range:
-                        # startpoint in polygon?
-                        if wb_polygon.contains(QgsPointXY(geom[0])):
-                            if end_y > start_y:
-                                flow_lines["2d_groundwater_out"].append(line["id"])
-                            else:
-                                flow_lines["2d_groundwater_in"].append(line["id"])
-                        elif wb_polygon.contains(QgsPointXY(geom[-1])):
-                            if end_y > start_y:
-                                flow_lines["2d_groundwater_in"].append(line["id"])
-                            else:
-                                flow_lines["2d_groundwater_out"].append(line["id"])
-
-            elif line["type"] == "1d_2d" and line.geometry().within(wb_polygon):
-                flow_lines["1d_2d_exch"].append(line["id"])
-
-        # find boundaries in polygon
-        request_filter = (
-            QgsFeatureRequest()
-            .setFilterRect(wb_polygon.get().boundingBox())
-            .setFilterExpression(
-                u'"type" = ' u"'1d_bound' or \"type\" = " u"'2d_bound'"
+        # all links in and out, classified on the gridadmin arrays
+        flow_lines.update(
+            get_flowline_categories(
+                self.line_arrays, masks["line_start"], masks["line_end"]
             )
         )
 
-        # all boundaries in polygon
-        for bound in points.getFeatures(request_filter):
-            if wb_polygon.contains(QgsPointXY(bound.geometry().asPoint())):
-                # find link connected to boundary
-                request_filter_bound = QgsFeatureRequest().setFilterExpression(
-                    u'"start_node_idx" = '
-                    u"'{idx}' or \"end_node_idx\" ="
-                    u" '{idx}'".format(idx=bound["id"])
-                )
-                bound_lines = lines.getFeatures(request_filter_bound)
-                for bound_line in bound_lines:
-                    if bound_line["start_node_idx"] == bound["id"]:
-                        if bound["type"] == "1d_bound":
-                            flow_lines["1d_bound_in"].append(bound_line["id"])
-                        else:  # 2d
-                            flow_lines["2d_bound_in"].append(bound_line["id"])
-                    else:  # out
-                        if bound["type"] == "1d_bound":
-                            flow_lines["1d_bound_out"].append(bound_line["id"])
-                        else:  # 2d
-                            flow_lines["2d_bound_out"].append(bound_line["id"])
+        # all boundaries in polygon and the lines connected to them
+        bounds = get_node_categories(
+            self.node_arrays, masks["node"], ["1d_bound", "2d_bound"]
+        )
+        adjacency = self.threedi_result.line_adjacency
+        for bound_type in ["1d_bound", "2d_bound"]:
+            _, line_ids, directions = adjacency.get_incident_lines(bounds[bound_type])
+            flow_lines[bound_type + "_in"] += line_ids[
+                directions == STARTS_AT_NODE
+            ].tolist()
+            flow_lines[bound_type + "_out"] += line_ids[
+                directions == ENDS_AT_NODE
+            ].tolist()
 
         # pumps
-        # use bounding box and spatial index to prefilter pumps
-        if pumps is None:
-            f_pumps = []
-        else:
-            request_filter = QgsFeatureRequest().setFilterRect(
-                wb_polygon.get().boundingBox()
+        if self.pump_arrays is not None:
+            pump_selection = get_pump_categories(
+                self.pump_arrays, masks["pump_start"], masks["pump_end"]
             )
-            f_pumps = pumps.getFeatures(request_filter)
-
-        for pump in f_pumps:
-            # test if lines are crossing boundary of polygon
-            if pump.geometry().crosses(wb_polygon):
-                geom = pump.geometry().asPolyline()
-                # check if flow is in or out by testing if startpoint
-                # is inside polygon --> out
-                outgoing = wb_polygon.contains(QgsPointXY(geom[0]))
-                # check if flow is in or out by testing if endpoint
-                # is inside polygon --> in
-                incoming = wb_polygon.contains(QgsPointXY(geom[-1]))
-
-                if incoming and outgoing:
-                    # skip
-                    pass
-                elif outgoing:
-                    pump_selection["out"].append(pump["id"])
-                elif incoming:
-                    pump_selection["in"].append(pump["id"])
-
-        logger.info(str(flow_lines))
         return flow_lines, pump_selection
 
     def get_nodes(self, wb_polygon, model_part):
@@ -384,41 +532,46 @@ class WaterBalanceCalculation(object):
         """
 
         logger.info("polygon of wb area: %s", wb_polygon.asWkt())
+        self._ensure_current_gridadmin()
+        inside = points_in_polygon(
+            wb_polygon, self.node_arrays["x"], self.node_arrays["y"]
+        )
+        return self.get_node_ids({"node": inside}, model_part)
 
-        nodes = {"1d": [], "2d": [], "2d_groundwater": []}
+    def get_node_ids(self, masks, model_part):
+        """Return the node ids by category of the inside masks
 
-        lines, points, pumps = self.ts_datasources.rows[0].get_result_layers()
+        See :py:meth:`get_nodes` and :py:meth:`get_inside_masks`.
+        """
+        nodes = {"1d": [], "2d": [], "2d_groundwater": []}
 
-        # use bounding box and spatial index to prefilter lines
-        request_filter = QgsFeatureRequest().setFilterRect(
-            wb_polygon.get().boundingBox()
-        )
         if model_part == "1d":
-            request_filter.setFilterExpression(u"\"type\" = '1d'")
+            node_types = ["1d"]
         elif model_part == "2d":
-            request_filter.setFilterExpression(
-                u"\"type\" = '2d' OR \"type\" = '2d_groundwater'"
-            )
+            node_types = ["2d", "2d_groundwater"]
         else:
-            request_filter.setFilterExpression(
-                u'"type" = \'1d\' OR "type" ' u"= '2d' OR \"type\" = '2d_groundwater'"
-            )
+            node_types = ["1d", "2d", "2d_groundwater"]
         # todo: check if boundary nodes could not have rain, infiltration, etc.
-
-        for point in points.getFeatures(request_filter):
-            # test if points are contained by polygon
-            if wb_polygon.contains(point.geometry()):
-                _type = point["type"]
-                nodes[_type].append(point["id"])
+        nodes.update(get_node_categories(self.node_arrays, masks["node"], node_types))
 
         return nodes
 
-    def get_aggregated_flows(self, link_ids, pump_ids, node_ids, model_part):
+    def get_aggregated_flows(
+        self, link_ids, pump_ids, node_ids, model_part, with_nan=False
+    ):
         """
         Returns a tuple (ts, total_time) defined as:
 
             ts = array of timestamps
             total_time = array with shape (np.size(ts, 0), len(INPUT_SERIES))
+
+        The error columns of total_time are the residuals of the balances of
+        the model part, see :py:func:`get_closure_errors`.
+
+        A NaN in the results makes the flow of its whole category NaN, those
+        flows are 0 in total_time. With ``with_nan`` a third element is
+        returned: the boolean array (like total_time) of the flows that were
+        NaN, see :py:mod:`.incremental`.
         """
         # constants referenced in record array
         # shared by links and nodes
@@ -515,204 +668,65 @@ class WaterBalanceCalculation(object):
         # sort for faster reading of netcdf
         np_link.sort(axis=0)
 
-        # create masks
-        mask_2d = np_link["ntype"] != TYPE_2D
-        mask_1d = np_link["ntype"] != TYPE_1D
-        mask_2d_bound = np_link["ntype"] != TYPE_2D_BOUND_IN
-        mask_1d_bound = np_link["ntype"] != TYPE_1D_BOUND_IN
-
-        mask_1d__1d_2d_flow = np_link["ntype"] != TYPE_1D__1D_2D_FLOW
-        mask_2d__1d_2d_flow = np_link["ntype"] != TYPE_2D__1D_2D_FLOW
-        mask_1d__1d_2d_exch = np_link["ntype"] != TYPE_1D__1D_2D_EXCH
-        mask_2d__1d_2d_exch = np_link["ntype"] != TYPE_2D__1D_2D_EXCH
-        mask_2d_groundwater = np_link["ntype"] != TYPE_2D_GROUNDWATER
-        mask_2d_vertical_infiltration = (
-            np_link["ntype"] != TYPE_2D_VERTICAL_INFILTRATION
-        )
-
-        active_ts_datasource = self.ts_datasources.rows[0]
-        threedi_result = active_ts_datasource.threedi_result()
+        threedi_result = self.threedi_result
 
         # get all flows through incoming and outgoing flows
         ts = threedi_result.get_timestamps(parameter="q_cum")
 
         len_input_series = len(WaterBalanceWidget.INPUT_SERIES)
         total_time = np.zeros(shape=(np.size(ts, 0), len_input_series))
-        # total_location = np.zeros(shape=(np.size(np_link, 0), 2))
-
-        # non-2d links
-        pos_pref = 0
-        neg_pref = 0
+        timestep_nrs = np.arange(np.size(ts, 0))
 
         if np_link.size > 0:
-            for ts_idx, t in enumerate(ts):
-                # (1) inflow and outflow through 1d and 2d
-                # vol = threedi_result.get_values_by_timestep_nr('q', ts_idx,
-                # np_link['id']) * np_link['dir']  # * dt
-
-                flow_pos = (
-                    threedi_result.get_values_by_timestep_nr(
-                        "q_cum_positive", ts_idx, np_link["id"]
-                    )
-                    * np_link["dir"]
-                )
-                flow_neg = (
-                    threedi_result.get_values_by_timestep_nr(
-                        "q_cum_negative", ts_idx, np_link["id"]
-                    )
-                    * np_link["dir"]
-                    * -1
-                )
-
-                in_sum = flow_pos - pos_pref
-                out_sum = flow_neg - neg_pref
-                pos_pref = flow_pos
-                neg_pref = flow_neg
-
-                # 2d flow (2d_in)
-                total_time[ts_idx, 0] = (
-                    ma.masked_array(in_sum, mask=mask_2d).clip(min=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_2d).clip(min=0).sum()
-                )
-                # 2d flow (2d_out)
-                total_time[ts_idx, 1] = (
-                    ma.masked_array(in_sum, mask=mask_2d).clip(max=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_2d).clip(max=0).sum()
-                )
-
-                # 1d flow (1d_in)
-                total_time[ts_idx, 2] = (
-                    ma.masked_array(in_sum, mask=mask_1d).clip(min=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_1d).clip(min=0).sum()
-                )
-                # 1d flow (1d_out)
-                total_time[ts_idx, 3] = (
-                    ma.masked_array(in_sum, mask=mask_1d).clip(max=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_1d).clip(max=0).sum()
-                )
-
-                # 2d bound (2d_bound_in)
-                total_time[ts_idx, 4] = (
-                    ma.masked_array(in_sum, mask=mask_2d_bound).clip(min=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_2d_bound).clip(min=0).sum()
-                )
-                # 2d bound (2d_bound_out)
-                total_time[ts_idx, 5] = (
-                    ma.masked_array(in_sum, mask=mask_2d_bound).clip(max=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_2d_bound).clip(max=0).sum()
-                )
-
-                # 1d bound (1d_bound_in)
-                total_time[ts_idx, 6] = (
-                    ma.masked_array(in_sum, mask=mask_1d_bound).clip(min=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_1d_bound).clip(min=0).sum()
-                )
-                # 1d bound (1d_bound_out)
-                total_time[ts_idx, 7] = (
-                    ma.masked_array(in_sum, mask=mask_1d_bound).clip(max=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_1d_bound).clip(max=0).sum()
-                )
-
-                # 1d__1d_2d_flow_in
-                total_time[ts_idx, 8] = (
-                    ma.masked_array(in_sum, mask=mask_1d__1d_2d_flow).clip(min=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_1d__1d_2d_flow)
-                    .clip(min=0)
-                    .sum()
-                )
-                # 1d__1d_2d_flow_out
-                total_time[ts_idx, 9] = (
-                    ma.masked_array(in_sum, mask=mask_1d__1d_2d_flow).clip(max=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_1d__1d_2d_flow)
-                    .clip(max=0)
-                    .sum()
-                )
-
-                # 2d__1d_2d_flow_in
-                total_time[ts_idx, 30] = (
-                    ma.masked_array(in_sum, mask=mask_2d__1d_2d_flow).clip(min=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_2d__1d_2d_flow)
-                    .clip(min=0)
-                    .sum()
-                )
-                # 2d__1d_2d_flow_out
-                total_time[ts_idx, 31] = (
-                    ma.masked_array(in_sum, mask=mask_2d__1d_2d_flow).clip(max=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_2d__1d_2d_flow)
-                    .clip(max=0)
-                    .sum()
-                )
-
-                # 1d (1d__1d_2d_exch_in)
-                total_time[ts_idx, 10] = (
-                    ma.masked_array(in_sum, mask=mask_1d__1d_2d_exch).clip(min=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_1d__1d_2d_exch)
-                    .clip(min=0)
-                    .sum()
-                )
-                # 1d (1d__1d_2d_exch_out)
-                total_time[ts_idx, 11] = (
-                    ma.masked_array(in_sum, mask=mask_1d__1d_2d_exch).clip(max=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_1d__1d_2d_exch)
-                    .clip(max=0)
-                    .sum()
-                )
-
-                # 2d (2d__1d_2d_exch_in)
-                total_time[ts_idx, 32] = (
-                    ma.masked_array(in_sum, mask=mask_2d__1d_2d_exch).clip(min=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_2d__1d_2d_exch)
-                    .clip(min=0)
-                    .sum()
-                )
-                # 2d (2d__1d_2d_exch_out)
-                total_time[ts_idx, 33] = (
-                    ma.masked_array(in_sum, mask=mask_2d__1d_2d_exch).clip(max=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_2d__1d_2d_exch)
-                    .clip(max=0)
-                    .sum()
-                )
-
-                # 2d groundwater (2d_groundwater_in)
-                total_time[ts_idx, 23] = (
-                    ma.masked_array(in_sum, mask=mask_2d_groundwater).clip(min=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_2d_groundwater)
-                    .clip(min=0)
-                    .sum()
-                )
-                # 2d groundwater (2d_groundwater_out)
-                total_time[ts_idx, 24] = (
-                    ma.masked_array(in_sum, mask=mask_2d_groundwater).clip(max=0).sum()
-                    + ma.masked_array(out_sum, mask=mask_2d_groundwater)
-                    .clip(max=0)
-                    .sum()
-                )
-
-                # NOTE: positive vertical infiltration is from surface to
-                # groundwater node. We make this negative because it's
-                # 'sink-like', and to make it in line with the
-                # infiltration_rate_simple which also has a -1 multiplication
-                # factor.
-                # 2d_vertical_infiltration (2d_vertical_infiltration_pos)
-                total_time[ts_idx, 28] = (
-                    -1
-                    * ma.masked_array(in_sum, mask=mask_2d_vertical_infiltration)
-                    .clip(min=0)
-                    .sum()
-                    + ma.masked_array(out_sum, mask=mask_2d_vertical_infiltration)
-                    .clip(min=0)
-                    .sum()
+            # (1) inflow and outflow through 1d and 2d
+            # columns of the positive and negative flow per link type
+            link_columns = [
+                (TYPE_2D, 0, 1),
+                (TYPE_1D, 2, 3),
+                (TYPE_2D_BOUND_IN, 4, 5),
+                (TYPE_1D_BOUND_IN, 6, 7),
+                (TYPE_1D__1D_2D_FLOW, 8, 9),
+                (TYPE_2D__1D_2D_FLOW, 30, 31),
+                (TYPE_1D__1D_2D_EXCH, 10, 11),
+                (TYPE_2D__1D_2D_EXCH, 32, 33),
+                (TYPE_2D_GROUNDWATER, 23, 24),
+                (TYPE_2D_VERTICAL_INFILTRATION, 28, 29),
+            ]
+            membership = get_membership_matrix(
+                np_link["ntype"], [ntype for ntype, _, _ in link_columns]
+            )
+            # NOTE: positive vertical infiltration is from surface to
+            # groundwater node. We make this negative because it's
+            # 'sink-like', and to make it in line with the
+            # infiltration_rate_simple which also has a -1 multiplication
+            # factor.
+            in_membership = membership.copy()
+            in_membership[:, -1] *= -1
+
+            flow_pos = (
+                get_timeseries(
+                    threedi_result, "q_cum_positive", timestep_nrs, np_link["id"]
                 )
-                # 2d_vertical_infiltration (2d_vertical_infiltration_neg)
-                total_time[ts_idx, 29] = (
-                    -1
-                    * ma.masked_array(in_sum, mask=mask_2d_vertical_infiltration)
-                    .clip(max=0)
-                    .sum()
-                    + ma.masked_array(out_sum, mask=mask_2d_vertical_infiltration)
-                    .clip(max=0)
-                    .sum()
+                * np_link["dir"]
+            )
+            flow_neg = (
+                get_timeseries(
+                    threedi_result, "q_cum_negative", timestep_nrs, np_link["id"]
                 )
+                * np_link["dir"]
+                * -1
+            )
+            in_sum = np.diff(flow_pos, axis=0, prepend=0)
+            out_sum = np.diff(flow_neg, axis=0, prepend=0)
+
+            in_columns = [column for _, column, _ in link_columns]
+            out_columns = [column for _, _, column in link_columns]
+            total_time[:, in_columns] = sum_by_category(
+                in_sum.clip(min=0), in_membership
+            ) + sum_by_category(out_sum.clip(min=0), membership)
+            total_time[:, out_columns] = sum_by_category(
+                in_sum.clip(max=0), in_membership
+            ) + sum_by_category(out_sum.clip(max=0), membership)
 
         # PUMPS
         #######
@@ -726,25 +740,16 @@ class WaterBalanceCalculation(object):
         np_pump.sort(axis=0)
 
         if np_pump.size > 0:
-            # pumps
-            pump_pref = 0
-            for ts_idx, t in enumerate(ts):
-                # (2) inflow and outflow through pumps
-                pump_flow = (
-                    threedi_result.get_values_by_timestep_nr(
-                        "q_pump_cum", ts_idx, np_pump["id"]
-                    )
-                    * np_pump["dir"]
+            # (2) inflow and outflow through pumps
+            pump_flow = (
+                get_timeseries(
+                    threedi_result, "q_pump_cum", timestep_nrs, np_pump["id"]
                 )
-
-                flow_dt = pump_flow - pump_pref
-                pump_pref = pump_flow
-
-                in_sum = flow_dt.clip(min=0)
-                out_sum = flow_dt.clip(max=0)
-
-                total_time[ts_idx, 12] = in_sum.sum()
-                total_time[ts_idx, 13] = out_sum.sum()
+                * np_pump["dir"]
+            )
+            flow_dt = np.diff(pump_flow, axis=0, prepend=0)
+            total_time[:, 12] = flow_dt.clip(min=0).sum(axis=1)
+            total_time[:, 13] = flow_dt.clip(max=0).sum(axis=1)
 
         # NODES
         #######
@@ -756,19 +761,12 @@ class WaterBalanceCalculation(object):
             tnode.append((idx, TYPE_1D))
         for idx in node_ids["2d_groundwater"]:
             tnode.append((idx, TYPE_2D_GROUNDWATER))
-        NTYPE_DTYPE
         np_node = np.array(tnode, dtype=[("id", int), ("ntype", NTYPE_DTYPE)])
         np_node.sort(axis=0)
 
-        mask_2d_nodes = np_node["ntype"] != TYPE_2D
-        mask_1d_nodes = np_node["ntype"] != TYPE_1D
-        mask_2d_groundwater_nodes = np_node["ntype"] != TYPE_2D_GROUNDWATER
-
-        np_2d_node = ma.masked_array(np_node["id"], mask=mask_2d_nodes).compressed()
-        np_1d_node = ma.masked_array(np_node["id"], mask=mask_1d_nodes).compressed()
-        np_2d_groundwater_node = ma.masked_array(
-            np_node["id"], mask=mask_2d_groundwater_nodes
-        ).compressed()
+        np_2d_node = np_node["id"][np_node["ntype"] == TYPE_2D]
+        np_1d_node = np_node["id"][np_node["ntype"] == TYPE_1D]
+        np_2d_groundwater_node = np_node["id"][np_node["ntype"] == TYPE_2D_GROUNDWATER]
 
         for parameter, agg_method, node, pnr, factor in [
             ("rain", "_cum", np_2d_node, 14, 1),
@@ -787,73 +785,43 @@ class WaterBalanceCalculation(object):
 
             if node.size > 0:
                 if parameter + agg_method in threedi_result.available_vars:
-                    values_pref = 0
-                    for ts_idx, t in enumerate(ts):
-                        values = threedi_result.get_values_by_timestep_nr(
-                            parameter + agg_method, ts_idx, node
-                        ).sum()
-                        values_dt = values - values_pref
-                        values_pref = values
-                        total_time[ts_idx, pnr] = values_dt * factor
-        t_pref = 0
-
-        for ts_idx, t in enumerate(ts):
-            if ts_idx == 0:
-                # just to make sure machine precision distortion
-                # is reduced for the first timestamp (everything
-                # should be 0
-                total_time[ts_idx] = total_time[ts_idx] / (ts[1] - t)
-            else:
-                total_time[ts_idx] = total_time[ts_idx] / (t - t_pref)
-                t_pref = t
+                    values = get_timeseries(
+                        threedi_result, parameter + agg_method, timestep_nrs, node
+                    ).sum(axis=1)
+                    total_time[:, pnr] = np.diff(values, prepend=0) * factor
+
+        total_time /= get_flow_durations(ts)[:, None]
 
         if np_node.size > 0:
             # delta volume
-            t_pref = 0
-            for ts_idx, t in enumerate(ts):
-                # delta volume
-                if ts_idx == 0:
-                    # volume difference first timestep is always 0
-                    total_time[ts_idx, 18] = 0
-                    total_time[ts_idx, 19] = 0
-                    total_time[ts_idx, 25] = 0
-
-                    vol_current = threedi_result.get_values_by_timestep_nr(
-                        "vol_current", ts_idx, np_node["id"]
-                    )
-                    td_vol_pref = ma.masked_array(vol_current, mask=mask_2d_nodes).sum()
-                    od_vol_pref = ma.masked_array(vol_current, mask=mask_1d_nodes).sum()
-                    td_vol_pref_gw = ma.masked_array(
-                        vol_current, mask=mask_2d_groundwater_nodes
-                    ).sum()
-                    t_pref = t
-                else:
-                    vol_ts_idx = ts_idx
-
-                    ts_normal = threedi_result.get_timestamps(parameter="vol_current")
-                    vol_ts_idx = np.nonzero(ts_normal == t)[0]
-
-                    vol_current = threedi_result.get_values_by_timestep_nr(
-                        "vol_current", vol_ts_idx, np_node["id"]
-                    )
-
-                    td_vol = ma.masked_array(vol_current, mask=mask_2d_nodes).sum()
-                    od_vol = ma.masked_array(vol_current, mask=mask_1d_nodes).sum()
-                    td_vol_gw = ma.masked_array(
-                        vol_current, mask=mask_2d_groundwater_nodes
-                    ).sum()
-
-                    dt = t - t_pref
-                    total_time[ts_idx, 18] = (td_vol - td_vol_pref) / dt
-                    total_time[ts_idx, 19] = (od_vol - od_vol_pref) / dt
-                    total_time[ts_idx, 25] = (td_vol_gw - td_vol_pref_gw) / dt
-
-                    td_vol_pref = td_vol
-                    od_vol_pref = od_vol
-                    td_vol_pref_gw = td_vol_gw
-                    t_pref = t
+            # the volumes of the timestamps of the flows, a volume of 0 is
+            # used for timestamps without volume
+            ts_normal = threedi_result.get_timestamps(parameter="vol_current")
+            vol_ts_idx = np.searchsorted(ts_normal, ts).clip(max=len(ts_normal) - 1)
+            vol_ts_idx[0] = 0
+            found = ts_normal[vol_ts_idx] == ts
+            found[0] = True
+            vol_current = get_timeseries(
+                threedi_result, "vol_current", vol_ts_idx, np_node["id"]
+            )
+            vol_current[~found] = 0
+            volumes = sum_by_category(
+                vol_current,
+                get_membership_matrix(
+                    np_node["ntype"], [TYPE_2D, TYPE_1D, TYPE_2D_GROUNDWATER]
+                ),
+            )
+            # volume difference first timestep is always 0
+            total_time[0, [18, 19, 25]] = 0
+            total_time[1:, [18, 19, 25]] = (
+                np.diff(volumes, axis=0) / np.diff(ts)[:, None]
+            )
+        nan = np.isnan(total_time)
         total_time = np.nan_to_num(total_time)
+        set_closure_residuals(total_time, model_part)
 
+        if with_nan:
+            return ts, total_time, nan
         return ts, total_time
 
 
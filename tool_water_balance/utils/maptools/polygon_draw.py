@@ -1,9 +1,6 @@
-from cached_property import cached_property
-from qgis.core import QgsGeometry
 from qgis.core import QgsWkbTypes
 from qgis.gui import QgsMapTool
 from qgis.gui import QgsRubberBand
-from qgis.gui import QgsVertexMarker
 from qgis.PyQt.QtCore import Qt
 from qgis.PyQt.QtGui import QColor
 from qgis.PyQt.QtGui import QCursor
@@ -13,58 +10,74 @@ RGBA = 255, 0, 0
 
 
 class SelectionVisualisation(object):
-    """Visualize selected lines and points. """
+    """Visualize selected lines and points.
+
+    The lines and points of a selection can be prebuilt per category as
+    hidden rubber bands, see :py:meth:`set_categories`. Showing a category is
+    then only toggling the visibility of its rubber band.
+    """
 
     def __init__(self, canvas, color=QColor(*RGBA)):
         self.canvas = canvas
         self.color = color
-        self.vertex_markers = []
-        self.lines = []
-        self.points = []
-
-    @cached_property
-    def rb_line(self):
-        rb_line = QgsRubberBand(self.canvas, QgsWkbTypes.LineGeometry)
-        rb_line.setColor(self.color)
-        rb_line.setLineStyle(Qt.DotLine)
-        rb_line.setWidth(3)
-        return rb_line
-
-    def show(self):
-        # visualize lines
-        multiline = QgsGeometry().fromMultiPolylineXY(self.lines)
-        self.rb_line.setToGeometry(multiline, None)
-        # visualize points
-        for p in self.points:
-            marker = QgsVertexMarker(self.canvas)
-            marker.setCenter(p)
-            marker.setIconType(QgsVertexMarker.ICON_BOX)
-            marker.setColor(self.color)
-            marker.setVisible(True)
-            self.vertex_markers.append(marker)
+        self.line_bands = {}
+        self.point_bands = {}
 
     def reset(self):
-        self.rb_line.reset(QgsWkbTypes.LineGeometry)
-        for m in self.vertex_markers:
-            m.setVisible(False)
-            # rubber bands are owned by the canvas, so we must explictly
-            # delete them
-            self.canvas.scene().removeItem(m)
-        self.vertex_markers = []
-        self.lines = []
-        self.points = []
-
-    def update(self, lines, points):
-        """lines and points are lists of QgsPoints and QgsPolylines."""
-        self.reset()
-        self.lines = lines
-        self.points = points
-        self.show()
+        self.hide_categories()
+
+    def _create_category_band(self, geometry, geometry_type):
+        rb = QgsRubberBand(self.canvas, geometry_type)
+        rb.setColor(self.color)
+        if geometry_type == QgsWkbTypes.LineGeometry:
+            rb.setLineStyle(Qt.DotLine)
+            rb.setWidth(3)
+        else:
+            rb.setIcon(QgsRubberBand.ICON_BOX)
+            rb.setIconSize(10)
+        rb.setToGeometry(geometry, None)
+        rb.setVisible(False)
+        return rb
+
+    def set_categories(self, lines, points):
+        """Prebuild a hidden rubber band for every category of a selection
+
+        :param lines: dict with a multi line QgsGeometry per line category
+        :param points: dict with a multi point QgsGeometry per node category
+        """
+        self.clear_categories()
+        self.line_bands = {
+            category: self._create_category_band(geometry, QgsWkbTypes.LineGeometry)
+            for category, geometry in lines.items()
+        }
+        self.point_bands = {
+            category: self._create_category_band(geometry, QgsWkbTypes.PointGeometry)
+            for category, geometry in points.items()
+        }
+
+    def show_categories(self, line_categories, point_categories):
+        """Show only the rubber bands of these line and node categories"""
+        self.hide_categories()
+        for category in line_categories:
+            if category in self.line_bands:
+                self.line_bands[category].setVisible(True)
+        for category in point_categories:
+            if category in self.point_bands:
+                self.point_bands[category].setVisible(True)
+
+    def hide_categories(self):
+        for rb in list(self.line_bands.values()) + list(self.point_bands.values()):
+            rb.setVisible(False)
+
+    def clear_categories(self):
+        for rb in list(self.line_bands.values()) + list(self.point_bands.values()):
+            # rubber bands are owned by the canvas
+            self.canvas.scene().removeItem(rb)
+        self.line_bands = {}
+        self.point_bands = {}
 
     def close(self):
-        self.reset()
-        # delete the rubberband we've been re-using
-        self.canvas.scene().removeItem(self.rb_line)
+        self.clear_categories()
 
 
 class PolygonDrawMapVisualisation(object):
@@ -126,6 +139,7 @@ class PolygonDrawTool(QgsMapTool):
         self.isEmittingPoint = False
         self.map_visualisation.reset()
         self.selection_vis.reset()
+        self.selection_vis.clear_categories()
         # self.selection_vis_hover.reset()
 
     def canvasDoubleClickEvent(self, e):
@@ -158,12 +172,6 @@ class PolygonDrawTool(QgsMapTool):
     def points(self):
         return self.map_visualisation.points
 
-    def update_line_point_selection(self, lines, points):
-        """Update the SelectionVisualisation (i.e., the selected lines and
-        points).
-        """
-        self.selection_vis.update(lines, points)
-
     # def activate(self):
     #     self.canvas.setCursor(QCursor(Qt.CrossCursor))
     #
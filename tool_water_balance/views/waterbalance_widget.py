@@ -1,9 +1,11 @@
 from ..config.waterbalance.sum_configs import serie_settings
 from ..models.wb_item import WaterbalanceItemModel
 from ..utils.maptools.polygon_draw import PolygonDrawTool
+from qgis.core import Qgis
+from qgis.core import QgsCoordinateReferenceSystem
 from qgis.core import QgsCoordinateTransform
-from qgis.core import QgsFeatureRequest
 from qgis.core import QgsGeometry
+from qgis.core import QgsPointXY
 from qgis.core import QgsProject
 from qgis.PyQt.QtCore import pyqtSignal
 from qgis.PyQt.QtCore import QEvent
@@ -29,6 +31,7 @@ from ThreeDiToolbox import PLUGIN_DIR
 from ThreeDiToolbox.datasource.threedi_results import find_h5_file
 from ThreeDiToolbox.tool_water_balance.views.custom_pg_Items import RotateLabelAxisItem
 from ThreeDiToolbox.utils.patched_threedigrid import GridH5Admin
+from ThreeDiToolbox.utils.user_messages import messagebar_message
 
 import copy
 import functools
@@ -82,27 +85,85 @@ INPUT_SERIES = [
     ("q_sss", 35, "2d", "2d"),
 ]
 
+# The parts of the INPUT_SERIES per model part, like the water balance graph
+MODEL_PART_SERIES_PARTS = {
+    "1d and 2d": ["1d", "2d", "2d_vert", "1d2d"],
+    "2d": ["2d", "2d_vert", "1d2d"],
+    "1d": ["1d", "1d2d"],
+}
+
+
+def get_model_part_series(model_part):
+    """Return the (name, column) of the INPUT_SERIES of a model part"""
+    parts = MODEL_PART_SERIES_PARTS[model_part]
+    return [(name, column) for (name, column, _, part) in INPUT_SERIES if part in parts]
+
 
 # some helper functions
 #######################
 
 
-def _get_request_filter(ids):
-    ids_flat = list(set([i for j in list(ids.values()) for i in j]))
-    return QgsFeatureRequest().setFilterFids(ids_flat)
+def _get_multi_polyline(arrays, ids):
+    """Return the lines with these ids of the line or pump arrays as one
+    multi line geometry, see ``WaterBalanceCalculation.line_arrays``"""
+    mask = np.isin(arrays["id"], list(ids))
+    coordinates = zip(
+        arrays["x1"][mask], arrays["y1"][mask], arrays["x2"][mask], arrays["y2"][mask]
+    )
+    return QgsGeometry.fromMultiPolylineXY(
+        [[QgsPointXY(x1, y1), QgsPointXY(x2, y2)] for x1, y1, x2, y2 in coordinates]
+    )
 
 
-def _get_feature_iterator(layer, request_filter):
-    # mainly pumps are often not present
-    if layer:
-        return layer.getFeatures(request_filter)
-    else:
-        return []
+def _get_multi_point(arrays, ids):
+    """Return the nodes with these ids of the node arrays as one multi point
+    geometry, see ``WaterBalanceCalculation.node_arrays``"""
+    mask = np.isin(arrays["id"], list(ids))
+    return QgsGeometry.fromMultiPointXY(
+        [QgsPointXY(x, y) for x, y in zip(arrays["x"][mask], arrays["y"][mask])]
+    )
 
 
 #######################
 
 
+class CumulativeBalance(object):
+    """Cumulative in and out volumes of the water balance timeseries
+
+    The volumes of any time window follow from the difference of the
+    cumulative volumes at its end and start, so changing the window doesn't
+    need the timeseries again.
+
+    :param ts: array with the timestamps
+    :param ts_series: array with the flows of the series (len(ts), N_series)
+    """
+
+    def __init__(self, ts, ts_series):
+        self.ts = ts
+        ts_deltas = np.concatenate(([0], np.diff(ts)))
+        volumes = ts_deltas[:, np.newaxis] * ts_series
+        zeros = np.zeros((1, volumes.shape[1]))
+        # row i is the volume of the timesteps before index i
+        self.cumulative_in = np.concatenate(
+            (zeros, np.cumsum(volumes.clip(min=0), axis=0))
+        )
+        self.cumulative_out = np.concatenate(
+            (zeros, np.cumsum(volumes.clip(max=0), axis=0))
+        )
+
+    def get_volumes(self, t1=0, t2=None):
+        """Return the in and out volume per series in time range t1-t2"""
+        idx_x1 = np.searchsorted(self.ts, t1)
+        if not t2:
+            idx_x2 = len(self.ts)
+        else:
+            idx_x2 = max(idx_x1, np.searchsorted(self.ts, t2))
+        return (
+            self.cumulative_in[idx_x2] - self.cumulative_in[idx_x1],
+            self.cumulative_out[idx_x2] - self.cumulative_out[idx_x1],
+        )
+
+
 @functools.total_ordering
 class Bar(object):
     """Bar for waterbalance barchart with positive and negative components.
@@ -118,43 +179,24 @@ class Bar(object):
         self._balance_in = None
         self._balance_out = None
 
-    @staticmethod
-    def _get_time_indices(ts, t1, t2):
-        """Time series indices in range t1-t2."""
-        idx_x1 = np.searchsorted(ts, t1)
-        if not t2:
-            idx_x2 = len(ts)
-        else:
-            idx_x2 = np.searchsorted(ts, t2)
-        return np.arange(idx_x1, idx_x2)
-
     @property
     def end_balance_in(self):
         return self._balance_in
 
-    def set_end_balance_in(self, ts, ts_series, t1=0, t2=None):
-        idxs = [self.SERIES_NAME_TO_INDEX[name] for name in self.in_series]
-        ts_indices_sliced = self._get_time_indices(ts, t1, t2)
-        ts_deltas = np.concatenate(([0], np.diff(ts)))
-        # shape = (N_idxs, len(ts))
-        balance_tmp = (ts_deltas * ts_series[:, idxs].T).clip(min=0)
-        self._balance_in = balance_tmp[:, ts_indices_sliced].sum()
-
     @property
     def end_balance_out(self):
         return self._balance_out
 
-    def set_end_balance_out(self, ts, ts_series, t1=0, t2=None):
-        idxs = [self.SERIES_NAME_TO_INDEX[name] for name in self.out_series]
-        ts_indices_sliced = self._get_time_indices(ts, t1, t2)
-        ts_deltas = np.concatenate(([0], np.diff(ts)))
-        balance_tmp = (ts_deltas * ts_series[:, idxs].T).clip(max=0)
-        self._balance_out = balance_tmp[:, ts_indices_sliced].sum()
+    def calc_balance(self, cumulative, t1=0, t2=None):
+        """Calculate balance values.
 
-    def calc_balance(self, ts, ts_series, t1=0, t2=None):
-        """Calculate balance values."""
-        self.set_end_balance_in(ts, ts_series, t1, t2)
-        self.set_end_balance_out(ts, ts_series, t1, t2)
+        :param cumulative: CumulativeBalance of the timeseries
+        """
+        volumes_in, volumes_out = cumulative.get_volumes(t1, t2)
+        in_idxs = [self.SERIES_NAME_TO_INDEX[name] for name in self.in_series]
+        out_idxs = [self.SERIES_NAME_TO_INDEX[name] for name in self.out_series]
+        self._balance_in = volumes_in[in_idxs].sum()
+        self._balance_out = volumes_out[out_idxs].sum()
         if self.is_storage_like:
             self.convert_to_net()
 
@@ -208,8 +250,14 @@ class BarManager(object):
         )
 
     def calc_balance(self, ts, ts_series, t1, t2, net=False, invert=[]):
+        self.calc_window_balance(
+            CumulativeBalance(ts, ts_series), t1, t2, net=net, invert=invert
+        )
+
+    def calc_window_balance(self, cumulative, t1, t2, net=False, invert=[]):
+        """Calculate the bars in time range t1-t2 from a CumulativeBalance"""
         for b in self.bars:
-            b.calc_balance(ts, ts_series, t1=t1, t2=t2)
+            b.calc_balance(cumulative, t1=t1, t2=t2)
             if net:
                 b.convert_to_net()
             if b.label_name in invert:
@@ -701,6 +749,9 @@ class WaterBalanceWidget(QDockWidget):
         # initially turn on tool
         self.select_polygon_button.toggle()
         self.__current_calc = None  # cache the results of calculation
+        self.time_range_brush = None
+        # (result, polygon, model part) of the balances warned about
+        self._closure_warnings = set()
 
     def _get_io_series_net(self):
         io_series_net = [
@@ -760,22 +811,29 @@ class WaterBalanceWidget(QDockWidget):
         io_series_2d_groundwater = self._get_io_series_2d_groundwater()
         io_series_1d = self._get_io_series_1d()
 
-        # get timeseries x range in plot widget
-        viewbox_state = self.plot_widget.getPlotItem().getViewBox().getState()
-        view_range = viewbox_state["viewRange"]
-        t1, t2 = view_range[0]
+        # the bars of any time range follow from these cumulative volumes
+        cumulative = CumulativeBalance(ts, ts_series)
+
+        # get the time range of the brush, or else the x range in plot widget
+        if self.time_range_brush in self.plot_widget.getPlotItem().items:
+            t1, t2 = self.time_range_brush.getRegion()
+        else:
+            viewbox_state = self.plot_widget.getPlotItem().getViewBox().getState()
+            view_range = viewbox_state["viewRange"]
+            t1, t2 = view_range[0]
 
         bm_net = BarManager(io_series_net)
         bm_2d = BarManager(io_series_2d)
         bm_2d_groundwater = BarManager(io_series_2d_groundwater)
         bm_1d = BarManager(io_series_1d)
-
-        bm_net.calc_balance(ts, ts_series, t1, t2, net=True)
-        bm_2d.calc_balance(ts, ts_series, t1, t2)
-        bm_2d_groundwater.calc_balance(
-            ts, ts_series, t1, t2, invert=["in/exfiltration (domain exchange)"]
-        )
-        bm_1d.calc_balance(ts, ts_series, t1, t2)
+        bar_managers = [
+            (bm_net, {"net": True}),
+            (bm_2d, {}),
+            (bm_2d_groundwater, {"invert": ["in/exfiltration (domain exchange)"]}),
+            (bm_1d, {}),
+        ]
+        for bar_manager, kwargs in bar_managers:
+            bar_manager.calc_window_balance(cumulative, t1, t2, **kwargs)
 
         nc_path = self.ts_datasources.rows[0].threedi_result().file_path
         h5 = find_h5_file(nc_path)
@@ -794,12 +852,10 @@ class WaterBalanceWidget(QDockWidget):
         self.wb_barchart_widget = pg.GraphicsView()
         layout = pg.GraphicsLayout()
         self.wb_barchart_widget.setCentralItem(layout)
-        text = "Water balance from t=%.2f to t=%.2f \n Model name: %s" % (
-            t_start,
-            t2,
-            short_model_slug,
+        text = "Water balance from t=%.2f to t=%.2f \n Model name: %s"
+        title = layout.addLabel(
+            text % (t_start, t2, short_model_slug), row=0, col=0, colspan=3
         )
-        layout.addLabel(text, row=0, col=0, colspan=3)
 
         self.wb_barchart_widget.setWindowTitle("Waterbalance")
         self.wb_barchart_widget.resize(1000, 600)
@@ -1044,10 +1100,40 @@ class WaterBalanceWidget(QDockWidget):
         )
         network1d_plot.setYRange(min=y_min, max=y_max)
 
+        # the brush on the timeseries plot sets the time range of the bars
+        bar_graphs = [
+            (bg_net_in, bg_net_out),
+            (surface_in, surface_out),
+            (groundwater_in, groundwater_out),
+            (network1d_in, network1d_out),
+        ]
+
+        def update_bars(brush):
+            t1, t2 = brush.getRegion()
+            for (bar_manager, kwargs), (bars_in, bars_out) in zip(
+                bar_managers, bar_graphs
+            ):
+                bar_manager.calc_window_balance(cumulative, t1, t2, **kwargs)
+                bars_in.setOpts(height=bar_manager.end_balance_in)
+                bars_out.setOpts(height=bar_manager.end_balance_out)
+            title.setText(text % (max(0, t1), t2, short_model_slug))
+
+        self.remove_time_range_brush()
+        self.time_range_brush = pg.LinearRegionItem(values=(t1, t2))
+        self.time_range_brush.sigRegionChanged.connect(update_bars)
+        self.plot_widget.addItem(self.time_range_brush, ignoreBounds=True)
+
+    def remove_time_range_brush(self):
+        """Remove the time range brush of the barchart from the plot"""
+        if self.time_range_brush is not None:
+            self.plot_widget.removeItem(self.time_range_brush)
+            self.time_range_brush = None
+
     def hover_enter_map_visualization(self, name):
         """On hover rubberband visualisation using the table item name.
 
-        Uses the cached self.qgs_lines/self.qgs_points.
+        Only shows the rubberbands prebuilt per category in
+        prepare_and_visualize_selection.
         """
         if self.select_polygon_button.isChecked():
             # highlighting when drawing the polygon doesn't look right.
@@ -1112,23 +1198,9 @@ class WaterBalanceWidget(QDockWidget):
         else:
             raise ValueError("Unknown type %s" % sum_type)
 
-        line_geoms = []
-        if name in name_to_line_type:
-            types_line = name_to_line_type[name]
-            for t in types_line:
-                if t in self.qgs_lines:
-                    geoms = self.qgs_lines[t]
-                    line_geoms.extend(geoms)
-
-        point_geoms = []
-        if name in NAME_TO_NODE_TYPES:
-            types_node = NAME_TO_NODE_TYPES[name]
-            for t in types_node:
-                if t in self.qgs_points:
-                    geoms = self.qgs_points[t]
-                    point_geoms.extend(geoms)
-
-        self.polygon_tool.selection_vis.update(line_geoms, point_geoms)
+        self.polygon_tool.selection_vis.show_categories(
+            name_to_line_type.get(name, []), NAME_TO_NODE_TYPES.get(name, [])
+        )
 
     def hover_exit_map_visualization(self, *args):
         self.polygon_tool.selection_vis.reset()
@@ -1138,6 +1210,7 @@ class WaterBalanceWidget(QDockWidget):
 
     def reset_waterbalans(self):
         self.polygon_tool.reset()
+        self.remove_time_range_brush()
 
     def toggle_polygon_button(self):
 
@@ -1211,133 +1284,111 @@ class WaterBalanceWidget(QDockWidget):
         self.wb_polygon.transform(tr)
 
     def calc_wb_graph(self, model_part, aggregation_type, settings):
-        lines, points, pumps = self.get_wb_result_layers()
         self.get_wb_polygon()
-        link_ids, pump_ids = self.calc.get_incoming_and_outcoming_link_ids(
+        link_ids, pump_ids, node_ids, ts, total_time = self.calc.get_balance(
             self.wb_polygon, model_part
         )
-        node_ids = self.calc.get_nodes(self.wb_polygon, model_part)
-        ts, total_time = self.calc.get_aggregated_flows(
-            link_ids, pump_ids, node_ids, model_part
-        )
+        self.warn_closure_errors(ts, total_time, model_part)
         graph_series = self.make_graph_series(
             ts, total_time, model_part, aggregation_type, settings
         )
-        self.prepare_and_visualize_selection(
-            link_ids, pump_ids, node_ids, lines, pumps, points
-        )
+        self.prepare_and_visualize_selection(link_ids, pump_ids, node_ids)
         return ts, graph_series
 
+    def warn_closure_errors(self, ts, total_time, model_part):
+        """Show a warning for the balances of the polygon that don't close,
+        e.g. because of flows that are missing in the selection.
+
+        The warning is shown once per polygon and model part, not again when
+        only the aggregation or the sum type changes.
+        """
+        key = (self.calc.threedi_result.file_path, self.wb_polygon.asWkt(), model_part)
+        if key in self._closure_warnings:
+            return
+        self._closure_warnings.add(key)
+        # waterbalance imports this module
+        from ..tools.waterbalance import get_closure_errors
+
+        closure_errors = get_closure_errors(ts, total_time, model_part)
+        for name, closure_error in closure_errors.items():
+            logger.info(
+                "Closure error %s: %.2f m3 (%.1f%%)",
+                name,
+                closure_error["volume"],
+                100 * closure_error["relative_volume"],
+            )
+        flagged = [
+            "%s %.1f%%" % (name, 100 * closure_error["relative_volume"])
+            for name, closure_error in closure_errors.items()
+            if closure_error["flagged"]
+        ]
+        if flagged:
+            messagebar_message(
+                "Water balance",
+                "The water balance doesn't close, the change in storage differs "
+                "from the sum of the flows (%s)" % ", ".join(flagged),
+                level=Qgis.Warning,
+                duration=10,
+            )
+
     def calc_wb_barchart(self, bc_model_part):
-        bc_link_ids, bc_pump_ids = self.calc.get_incoming_and_outcoming_link_ids(
+        _, _, _, bc_ts, bc_total_time = self.calc.get_balance(
             self.wb_polygon, bc_model_part
         )
-        bc_node_ids = self.calc.get_nodes(self.wb_polygon, bc_model_part)
-        bc_ts, bc_total_time = self.calc.get_aggregated_flows(
-            bc_link_ids, bc_pump_ids, bc_node_ids, bc_model_part
-        )
         return bc_ts, bc_total_time
 
     def prepare_and_visualize_selection(
-        self, link_ids, pump_ids, node_ids, lines, pumps, points, draw_it=False
+        self, link_ids, pump_ids, node_ids, draw_it=False
     ):
-        """Prepare dictionaries with geometries categorized by type and
-        save it on self.qgs_lines and self.qgs_points.
-        """
-        req_filter_links = _get_request_filter(link_ids)
-        req_filter_pumps = _get_request_filter(pump_ids)
-        req_filter_nodes = _get_request_filter(node_ids)
+        """Prepare a multi geometry per type of the selected lines, pumps and
+        nodes and prebuild their rubberbands on self.polygon_tool.selection_vis.
 
-        line_id_to_type = {}
+        The geometries are made from the coordinates of the WaterBalanceCalculation,
+        so no features of the result layers are requested.
+        """
+        line_type_to_ids = {}
         for _type, id_list in list(link_ids.items()):
-            for i in id_list:
-                t = _type.rsplit("_out")[0].rsplit("_in")[0]
-                if i not in line_id_to_type:
-                    # business as usual
-                    line_id_to_type[i] = t
-                else:
-                    # NOTE: awful hack for links that have multiple types
-                    val = line_id_to_type[i]
-                    if isinstance(val, list):
-                        val.append(t)
-                    else:
-                        line_id_to_type[i] = [val, t]
+            # NOTE: links can have multiple types
+            t = _type.rsplit("_out")[0].rsplit("_in")[0]
+            line_type_to_ids.setdefault(t, set()).update(id_list)
+        pump_ids_all = set([i for j in list(pump_ids.values()) for i in j])
 
-        node_id_to_type = {}
-        for _type, id_list in list(node_ids.items()):
-            for i in id_list:
-                node_id_to_type[i] = _type
-
-        qgs_lines = {}
-        qgs_points = {}
+        # the coordinate arrays of the WaterBalanceCalculation are WGS84
         tr_reverse = QgsCoordinateTransform(
-            lines.crs(),
+            QgsCoordinateReferenceSystem("EPSG:4326"),
             self.iface.mapCanvas().mapSettings().destinationCrs(),
             QgsProject.instance(),
         )
 
-        # NOTE: getting all features again isn't efficient because they're
-        # already calculated in WaterBalanceCalculation, but w/e
-        for feat in _get_feature_iterator(lines, req_filter_links):
-            geom = feat.geometry()
-            geom.transform(tr_reverse)
-            _type = line_id_to_type[feat["id"]]
-
-            if isinstance(_type, list):
-                # NOTE: this means there are multiple types for one link
-                for t in _type:
-                    qgs_lines.setdefault(t, []).append(geom.asPolyline())
-            else:
-                # one type only, business as usual
-                qgs_lines.setdefault(_type, []).append(geom.asPolyline())
-        for feat in _get_feature_iterator(pumps, req_filter_pumps):
-            geom = feat.geometry()
-            geom.transform(tr_reverse)
-            qgs_lines.setdefault("pumps_hoover", []).append(geom.asPolyline())
-        for feat in _get_feature_iterator(points, req_filter_nodes):
-            geom = feat.geometry()
-            geom.transform(tr_reverse)
-            _type = node_id_to_type[feat["id"]]
-            qgs_points.setdefault(_type, []).append(geom.asPoint())
-
-        self.qgs_lines = qgs_lines
-        self.qgs_points = qgs_points
+        qgs_lines = {}
+        for _type, ids in line_type_to_ids.items():
+            if ids:
+                qgs_lines[_type] = _get_multi_polyline(self.calc.line_arrays, ids)
+        # mainly pumps are often not present
+        if pump_ids_all and self.calc.pump_arrays is not None:
+            qgs_lines["pumps_hoover"] = _get_multi_polyline(
+                self.calc.pump_arrays, pump_ids_all
+            )
+        qgs_points = {}
+        for _type, ids in list(node_ids.items()):
+            if ids:
+                qgs_points[_type] = _get_multi_point(self.calc.node_arrays, ids)
+        for geometry in list(qgs_lines.values()) + list(qgs_points.values()):
+            geometry.transform(tr_reverse)
+
+        self.polygon_tool.selection_vis.set_categories(qgs_lines, qgs_points)
 
         # draw the lines/points immediately
         # TODO: probably need to throw this code away since we won't use it
         if draw_it:
-            qgs_lines_all = [j for i in list(qgs_lines.values()) for j in i]
-            qgs_points_all = [j for i in list(qgs_points.values()) for j in i]
-
-            self.polygon_tool.update_line_point_selection(qgs_lines_all, qgs_points_all)
+            self.polygon_tool.selection_vis.show_categories(
+                list(qgs_lines.keys()), list(qgs_points.keys())
+            )
 
     def make_graph_series(self, ts, total_time, model_part, aggregation_type, settings):
         settings = copy.deepcopy(settings)
 
-        if model_part == "1d and 2d":
-            input_series = dict(
-                [
-                    (x, y)
-                    for (x, y, z, part) in self.INPUT_SERIES
-                    if part in ["1d", "2d", "2d_vert", "1d2d"]
-                ]
-            )
-        elif model_part == "2d":
-            input_series = dict(
-                [
-                    (x, y)
-                    for (x, y, z, part) in self.INPUT_SERIES
-                    if part in ["2d", "2d_vert", "1d2d"]
-                ]
-            )
-        elif model_part == "1d":
-            input_series = dict(
-                [
-                    (x, y)
-                    for (x, y, z, part) in self.INPUT_SERIES
-                    if part in ["1d", "1d2d"]
-                ]
-            )
+        input_series = dict(get_model_part_series(model_part))
 
         # set layers to True (layer is tickled in wb_item_table (right box
         # where one can tickle layer(s), but more important: based on this we
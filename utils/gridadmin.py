@@ -3,7 +3,6 @@ from collections import OrderedDict
 from osgeo import ogr
 from osgeo import osr
 from qgis.core import QgsWkbTypes
-from threedigrid.admin.constants import TYPE_FUNC_MAP
 from threedigrid.admin.utils import KCUDescriptor
 from threedigrid.orm.base.exporters import BaseOgrExporter
 
@@ -17,6 +16,13 @@ ogr.UseExceptions()  # fail fast
 
 SPATIALITE_DRIVER_NAME = "SQLite"
 
+# Number of features written per transaction by the exporters
+CHUNK_SIZE = 50000
+
+
+class ExportCancelledError(Exception):
+    """Raised when an export is cancelled through its feedback"""
+
 
 def get_spatial_reference(epsg_code):
     """Get spatial reference from EPSG code."""
@@ -25,9 +31,82 @@ def get_spatial_reference(epsg_code):
     return spatial_ref
 
 
-def _fix_fid_for_SetFID(fid):
-    """SetFID can't handle numpy.int32, which the h5 data sometimes returns"""
-    return int(fid)
+def _create_features_in_chunks(
+    layer, arrays, create_feature, feedback=None, chunk_size=CHUNK_SIZE
+):
+    """Create features in transactions of at most ``chunk_size`` features
+
+    Committing per chunk keeps the size of the transaction (and with it the
+    memory usage) bounded, regardless of the model size. Only the slice of
+    ``arrays`` belonging to a chunk is converted to python values. After every
+    chunk the progress is reported to the optional ``feedback`` (a QgsFeedback)
+    and the export is stopped if it has been cancelled.
+
+    :param arrays: sequence of equally sized 1d (numpy) arrays, e.g. the
+        coordinates followed by the attribute columns
+    :param create_feature: function returning the ogr.Feature for the python
+        values of one element of every array, in the order of ``arrays``
+        (SetFID can't handle numpy.int32, hence the conversion)
+    :raises ExportCancelledError: if the feedback has been cancelled
+    """
+    nr_features = len(arrays[0]) if arrays else 0
+    for start in range(0, nr_features, chunk_size):
+        if feedback is not None and feedback.isCanceled():
+            raise ExportCancelledError(
+                "Export of %s cancelled" % layer.GetName()
+            )
+        stop = min(start + chunk_size, nr_features)
+        chunk = [np.asarray(values[start:stop]).tolist() for values in arrays]
+        layer.StartTransaction()
+        for values in zip(*chunk):
+            feature = create_feature(*values)
+            layer.CreateFeature(feature)
+            feature.Destroy()
+        layer.CommitTransaction()
+        del chunk
+        if feedback is not None:
+            feedback.setProgress(100.0 * stop / nr_features)
+
+
+def _set_fields(feature, field_names, values):
+    """Set the non-NULL ``values`` of ``field_names`` on an ogr.Feature"""
+    for field_name, value in zip(field_names, values):
+        if value is not None:
+            feature.SetField(field_name, value)
+
+
+def _get_field_array(data, field_name, size):
+    """Return the 1d array of ``field_name`` or None if it is unavailable.
+
+    threedigrid weirdness: if a field is unavailable, it just returns a
+    ``np.array(None, dtype=object)``. In that case every value is NULL.
+    """
+    values = np.asarray(data[field_name])
+    if values.ndim != 1 or values.size != size:
+        return None
+    return values
+
+
+def _as_int_array(values, size):
+    if values is None:
+        return np.full(size, None, dtype=object)
+    return values.astype(int)
+
+
+def _as_str_array(values, size):
+    if values is None:
+        return np.full(size, None, dtype=object)
+    if values.dtype.kind == "S":
+        return np.char.decode(values, "utf-8")
+    return values.astype(str)
+
+
+def _map_unique(values, mapping_func):
+    """Apply ``mapping_func`` once per unique value instead of per element."""
+    result = np.empty(values.size, dtype=object)
+    for value in np.unique(values):
+        result[values == value] = mapping_func(value)
+    return result
 
 
 class QgisNodesOgrExporter(BaseOgrExporter):
@@ -81,12 +160,55 @@ class QgisNodesOgrExporter(BaseOgrExporter):
         self._nodes = nodes
         self.supported_drivers = {SPATIALITE_DRIVER_NAME}
 
+    @classmethod
+    def get_attribute_columns(cls, node_data):
+        """Return the attribute values of all nodes, ordered as TABLE_FIELDS
+
+        The values are computed column-wise on the gridadmin arrays, so they
+        can be fed in bulk to a layer.
+
+        :param node_data: dict of node data
+        :return: OrderedDict with a numpy array per table field
+        """
+        size = node_data["id"].size
+        node_type = _get_field_array(node_data, "node_type", size)
+        if node_type is None:
+            feature_type = type_ = np.full(size, None, dtype=object)
+        else:
+            feature_type = _map_unique(node_type, str)
+            type_ = _map_unique(
+                node_type, lambda v: cls.INT_TO_TYPE_STR.get(str(v), str(v))
+            )
+        return OrderedDict(
+            [
+                ("id", node_data["id"].astype(int)),
+                (
+                    "inp_id",
+                    _as_int_array(_get_field_array(node_data, "seq_id", size), size),
+                ),
+                (
+                    "spatialite_id",
+                    _as_int_array(
+                        _get_field_array(node_data, "content_pk", size), size
+                    ),
+                ),
+                ("feature_type", feature_type),
+                ("type", type_),
+            ]
+        )
+
+    @staticmethod
+    def get_coordinates(node_data):
+        """Return the x and y arrays of the node points"""
+        return node_data["coordinates"][0], node_data["coordinates"][1]
+
     def save(
         self,
         file_name,
         layer_name,
         node_data,
         target_epsg_code,
+        feedback=None,
         **kwargs
     ):
         """
@@ -94,6 +216,8 @@ class QgisNodesOgrExporter(BaseOgrExporter):
 
         :param file_name: name of the outputfile
         :param node_data: dict of node data
+        :param feedback: optional QgsFeedback for progress and cancellation
+        :raises ExportCancelledError: if the feedback has been cancelled
         """
         assert self.driver is not None
 
@@ -117,42 +241,29 @@ class QgisNodesOgrExporter(BaseOgrExporter):
 
         _definition = layer.GetLayerDefn()
 
-        layer.StartTransaction()
-        for i in range(node_data["id"].size):
+        columns = self.get_attribute_columns(node_data)
+        field_names = list(columns)[1:]  # the id is set as feature id
+
+        def create_feature(x, y, fid, *attributes):
             point = ogr.Geometry(ogr.wkbPoint)
-            point.AddPoint_2D(
-                node_data["coordinates"][0][i], node_data["coordinates"][1][i]
-            )
+            point.AddPoint_2D(x, y)
             feature = ogr.Feature(_definition)
             feature.SetGeometry(point)
-            for field_name, field_type in self.QGIS_NODE_FIELDS.items():
-                fname = self.QGIS_NODE_FIELD_NAME_MAP[field_name]
-                if field_name == "type":
-                    raw_value = node_data[fname][i]
-                    value = TYPE_FUNC_MAP[field_type](raw_value)
-                    if value in self.INT_TO_TYPE_STR:
-                        value = self.INT_TO_TYPE_STR[value]
-                    # OGR dislikes unicode for some reason...
-                    value = str(value)
-                else:
-                    try:
-                        raw_value = node_data[fname][i]
-                        value = TYPE_FUNC_MAP[field_type](raw_value)
-                    except IndexError:
-                        logger.exception(
-                            "Error getting index %s from %s array", i, fname
-                        )
-                        value = None
-                if value is not None:
-                    feature.SetField(str(field_name), value)
-                # explicitly set feature id to the 'id' field of the gridadmin
-                # data, because graph tool uses the feature id.
-                fid = _fix_fid_for_SetFID(node_data["id"][i])
-                feature.SetFID(fid)
-            layer.CreateFeature(feature)
-            feature.Destroy()
-        layer.CommitTransaction()
-        data_source = None
+            _set_fields(feature, field_names, attributes)
+            # explicitly set feature id to the 'id' field of the gridadmin
+            # data, because graph tool uses the feature id.
+            feature.SetFID(fid)
+            return feature
+
+        try:
+            _create_features_in_chunks(
+                layer,
+                self.get_coordinates(node_data) + tuple(columns.values()),
+                create_feature,
+                feedback,
+            )
+        finally:
+            data_source = None
 
 
 class QgisKCUDescriptor(KCUDescriptor):
@@ -262,12 +373,87 @@ class QgisLinesOgrExporter(BaseOgrExporter):
         self.supported_drivers = {SPATIALITE_DRIVER_NAME}
         self.driver = None
 
+    @classmethod
+    def get_line_types(cls, line_data):
+        """Return an object array with the 'type' of every line
+
+        The content_type is used if available (e.g. 'v2_pipe'), otherwise
+        the type is derived from the kcu (e.g. '2d', '1d_2d').
+        """
+        kcu_dict = QgisKCUDescriptor()
+
+        def kcu_to_type(kcu):
+            try:
+                return str(kcu_dict[int(kcu)])
+            except KeyError:
+                logger.exception("TODO: can we handle this keyerror more elegantly?")
+                return None
+
+        kcu = np.asarray(line_data["kcu"])
+        types = _map_unique(kcu, kcu_to_type)
+        content_type = _get_field_array(line_data, "content_type", kcu.size)
+        if content_type is not None:
+            if content_type.dtype.kind in "SU":
+                has_content_type = np.char.str_len(content_type) > 0
+            else:
+                has_content_type = np.array([bool(v) for v in content_type])
+            types[has_content_type] = _as_str_array(
+                content_type[has_content_type], int(has_content_type.sum())
+            ).tolist()
+        return types
+
+    @classmethod
+    def get_attribute_columns(cls, line_data):
+        """Return the attribute values of all lines, ordered as TABLE_FIELDS
+
+        :param line_data: dict of line data
+        :return: OrderedDict with a numpy array per table field
+        """
+        size = line_data["id"].size
+        return OrderedDict(
+            [
+                ("id", line_data["id"].astype(int)),
+                ("kcu", _as_int_array(_get_field_array(line_data, "kcu", size), size)),
+                ("type", cls.get_line_types(line_data)),
+                ("start_node_idx", line_data["line"][0].astype(int)),
+                ("end_node_idx", line_data["line"][1].astype(int)),
+                (
+                    "content_type",
+                    _as_str_array(
+                        _get_field_array(line_data, "content_type", size), size
+                    ),
+                ),
+                (
+                    "spatialite_id",
+                    _as_int_array(
+                        _get_field_array(line_data, "content_pk", size), size
+                    ),
+                ),
+                (
+                    "inp_id",
+                    _as_int_array(_get_field_array(line_data, "lik", size), size),
+                ),
+            ]
+        )
+
+    @staticmethod
+    def get_coordinates(line_data):
+        """Return the x1, y1, x2, y2 arrays of the start and end vertices
+
+        kcu 150=2d_vertical_infiltration (their start and end vertex are
+        equal. To be able to display line we shift the end vertex
+        """
+        x1, y1, x2, y2 = line_data["line_coords"][0:4]
+        shift = np.where(np.asarray(line_data["kcu"]) == 150, 0.00002, 0.0)
+        return x1, y1, x2 - shift, y2 - shift
+
     def save(
         self,
         file_name,
         layer_name,
         line_data,
         target_epsg_code,
+        feedback=None,
         **kwargs
     ):
         """
@@ -275,11 +461,11 @@ class QgisLinesOgrExporter(BaseOgrExporter):
 
         :param file_name: name of the outputfile
         :param line_data: dict of line data
+        :param feedback: optional QgsFeedback for progress and cancellation
+        :raises ExportCancelledError: if the feedback has been cancelled
         """
         assert self.driver is not None
 
-        kcu_dict = QgisKCUDescriptor()
-
         # this will also create a new sqlite if it doesn't exist
         spl = Spatialite(file_name)
         # create a new spatially enabled layer. The Spatialite connector is
@@ -300,85 +486,30 @@ class QgisLinesOgrExporter(BaseOgrExporter):
 
         _definition = layer.GetLayerDefn()
 
-        node_a = line_data["line"][0]
-        node_b = line_data["line"][1]
-        layer.StartTransaction()
-        for i in range(node_a.size):
-            line = ogr.Geometry(ogr.wkbLineString)
-            line.AddPoint_2D(
-                line_data["line_coords"][0][i], line_data["line_coords"][1][i]
-            )
-            # kcu 150=2d_vertical_infiltration (their start and end vertex
-            # are equal. To be able to display line we shift the end vertex
-            if line_data["kcu"][i] == 150:
-                line.AddPoint_2D(
-                    line_data["line_coords"][2][i] - 0.00002,
-                    line_data["line_coords"][3][i] - 0.00002
-                )
-            else:
-                line.AddPoint_2D(
-                    line_data["line_coords"][2][i], line_data["line_coords"][3][i]
-                )
+        columns = self.get_attribute_columns(line_data)
+        field_names = list(columns)[1:]  # the id is set as feature id
 
+        def create_feature(x1, y1, x2, y2, fid, *attributes):
+            line = ogr.Geometry(ogr.wkbLineString)
+            line.AddPoint_2D(x1, y1)
+            line.AddPoint_2D(x2, y2)
             feature = ogr.Feature(_definition)
             feature.SetGeometry(line)
-            for field_name, field_type in self.LINE_FIELDS.items():
-                fname = self.LINE_FIELD_NAME_MAP[field_name]
-                if field_name == "type":
-                    value = None  # if all fails
-
-                    # TODO: first try to find a mapping with kcu, then find
-                    # a mapping using cont_type. If cont_type is not None,
-                    # then use the cont_type, else use kcu
-                    try:
-                        cont_type_raw_value = line_data["content_type"][i]
-                    except IndexError:
-                        # threedigrid weirdness, if a field is unavailable,
-                        # it just returns a ``np.array(None, dtype=object)``
-                        logger.exception("Failed to get index %s from content_type", i)
-                        cont_type_raw_value = None
-
-                    if cont_type_raw_value:
-                        if type(cont_type_raw_value) is np.bytes_:
-                            value = TYPE_FUNC_MAP[field_type](
-                                cont_type_raw_value, encoding="utf-8"
-                            )
-                        else:
-                            value = TYPE_FUNC_MAP[field_type](cont_type_raw_value)
-                    else:
-                        try:
-                            value = str(kcu_dict[int(line_data["kcu"][i])])
-                        except KeyError:
-                            logger.exception(
-                                "TODO: can we handle this keyerror more elegantly?"
-                            )
-                elif field_name == "start_node_idx":
-                    value = TYPE_FUNC_MAP[field_type](node_a[i])
-                elif field_name == "end_node_idx":
-                    value = TYPE_FUNC_MAP[field_type](node_b[i])
-                else:
-                    try:
-                        raw_value = line_data[fname][i]
-                        if type(raw_value) is np.bytes_:
-                            value = TYPE_FUNC_MAP[field_type](
-                                raw_value, encoding="utf-8"
-                            )
-                        else:
-                            value = TYPE_FUNC_MAP[field_type](raw_value)
-                    except IndexError:
-                        logger.debug("Error getting index %s from %s array", i, fname)
-                        value = None
-                if value is not None:
-                    feature.SetField(str(field_name), value)
-                # explicitly set feature id to the 'id' field of the gridadmin
-                # data, because graph tool uses the feature id.
-                fid = _fix_fid_for_SetFID(line_data["id"][i])
-                feature.SetFID(fid)
-
-            layer.CreateFeature(feature)
-            feature.Destroy()
-        layer.CommitTransaction()
-        data_source = None
+            _set_fields(feature, field_names, attributes)
+            # explicitly set feature id to the 'id' field of the gridadmin
+            # data, because graph tool uses the feature id.
+            feature.SetFID(fid)
+            return feature
+
+        try:
+            _create_features_in_chunks(
+                layer,
+                self.get_coordinates(line_data) + tuple(columns.values()),
+                create_feature,
+                feedback,
+            )
+        finally:
+            data_source = None
 
 
 class QgisPumpsOgrExporter(BaseOgrExporter):
@@ -398,12 +529,40 @@ class QgisPumpsOgrExporter(BaseOgrExporter):
         self.node_data = node_data
         self.driver = None
 
+    @classmethod
+    def get_attribute_columns(cls, pump_data):
+        """Return the attribute values of all pumps, ordered as TABLE_FIELDS
+
+        :param pump_data: dict of pump data
+        :return: OrderedDict with a numpy array per table field
+        """
+        columns = OrderedDict([("id", pump_data["id"].astype(int))])
+        for field_name, fname in cls.FIELD_NAME_MAP.items():
+            columns[field_name] = np.asarray(pump_data[fname]).astype(int)
+        return columns
+
+    @staticmethod
+    def get_coordinates(pump_data):
+        """Return the x1, y1, x2, y2 arrays of the start and end vertices
+
+        Pumps without an end node get an end vertex that is slightly shifted
+        from the start node.
+        """
+        if np.any(pump_data["node1_id"] == -9999):
+            raise AssertionError("start_node has not-null constraint")
+        x1, y1, x2, y2 = pump_data["node_coordinates"][0:4]
+        no_end_node = pump_data["node2_id"] == -9999
+        x2 = np.where(no_end_node, x1 + 0.00002, x2)
+        y2 = np.where(no_end_node, y1 + 0.00002, y2)
+        return x1, y1, x2, y2
+
     def save(
         self,
         file_name,
         layer_name,
         pump_data,
         target_epsg_code,
+        feedback=None,
         **kwargs
     ):
         """
@@ -411,6 +570,8 @@ class QgisPumpsOgrExporter(BaseOgrExporter):
 
         :param file_name: name of the outputfile
         :param line_data: dict of line data
+        :param feedback: optional QgsFeedback for progress and cancellation
+        :raises ExportCancelledError: if the feedback has been cancelled
         """
         assert self.driver is not None
 
@@ -434,39 +595,176 @@ class QgisPumpsOgrExporter(BaseOgrExporter):
 
         _definition = layer.GetLayerDefn()
 
-        layer.StartTransaction()
-        for i in range(pump_data["id"].size):
+        columns = self.get_attribute_columns(pump_data)
+        field_names = list(columns)[1:]  # the id is set as feature id
+
+        def create_feature(x1, y1, x2, y2, fid, *attributes):
             line = ogr.Geometry(ogr.wkbLineString)
-            node1_id = pump_data["node1_id"][i]
-            node2_id = pump_data["node2_id"][i]
+            line.AddPoint_2D(x1, y1)
+            line.AddPoint_2D(x2, y2)
+            feature = ogr.Feature(_definition)
+            feature.SetGeometry(line)
+            _set_fields(feature, field_names, attributes)
+            # explicitly set feature id to the 'id' field of the gridadmin
+            # data, because graph tool uses the feature id.
+            feature.SetFID(fid)
+            return feature
+
+        try:
+            _create_features_in_chunks(
+                layer,
+                self.get_coordinates(pump_data) + tuple(columns.values()),
+                create_feature,
+                feedback,
+            )
+        finally:
+            data_source = None
 
-            if node1_id == -9999:
-                raise AssertionError("start_node has not-null constraint")
 
-            node1_coords = pump_data['node_coordinates'][0:2, i]
-            if node2_id == -9999:
-                node2_coords = node1_coords + 0.00002
-            else:
-                node2_coords = pump_data['node_coordinates'][2:4, i]
-            try:
-                line.AddPoint_2D(node1_coords[0], node1_coords[1])
-                line.AddPoint_2D(node2_coords[0], node2_coords[1])
-            except IndexError:
-                logger.exception("Invalid node id: %s", node1_id)
+class QgisCellsOgrExporter(BaseOgrExporter):
+    """
+    Exports the 2D computational cells as polygons to ogr formats. You need
+    to set the driver explicitly before calling save()
 
-            feature = ogr.Feature(_definition)
-            feature.SetGeometry(line)
-            for field_name, field_type in self.FIELDS.items():
-                fname = self.FIELD_NAME_MAP[field_name]
-                raw_value = pump_data[fname][i]
-                value = TYPE_FUNC_MAP[field_type](raw_value)
-                feature.SetField(str(field_name), value)
-                # explicitly set feature id to the 'id' field of the gridadmin
-                # data, because graph tool uses the feature id.
-                fid = _fix_fid_for_SetFID(pump_data["id"][i])
-                feature.SetFID(fid)
+    The feature ids equal the node ids, so results of the 2D nodes can be
+    shown on the cells.
+    """
 
-            layer.CreateFeature(feature)
-            feature.Destroy()
-        layer.CommitTransaction()
-        data_source = None
+    # node_type of the nodes that have a cell
+    CELL_NODE_TYPES = OrderedDict([(1, "2d"), (2, "2d_groundwater")])
+
+    TABLE_FIELDS = ["id INTEGER", "type VARCHAR", "level INTEGER"]
+
+    def __init__(self, cells):
+        """
+        :param cells: nodes.models.Cells instance
+        """
+        self._cells = cells
+        self.supported_drivers = {SPATIALITE_DRIVER_NAME}
+        self.driver = None
+
+    @classmethod
+    def filter_cells(cls, cell_data):
+        """Return the cell data of the 2D (groundwater) nodes only
+
+        1D nodes and boundary nodes have no (valid) cell bounds.
+        """
+        mask = np.isin(cell_data["node_type"], list(cls.CELL_NODE_TYPES))
+        mask &= np.all(np.isfinite(cell_data["cell_coords"]), axis=0)
+        filtered = {
+            "id": cell_data["id"][mask],
+            "node_type": cell_data["node_type"][mask],
+            "cell_coords": cell_data["cell_coords"][:, mask],
+        }
+        pixel_width = _get_field_array(cell_data, "pixel_width", mask.size)
+        if pixel_width is not None:
+            filtered["pixel_width"] = pixel_width[mask]
+        return filtered
+
+    @staticmethod
+    def get_levels(cell_data):
+        """Return the quadtree level of every cell, 1 being the smallest
+
+        The level follows from the cell size relative to the smallest cell,
+        every level doubles the size. The pixel width is used if available,
+        otherwise the width of the cell bounds.
+        """
+        if cell_data["id"].size == 0:
+            return np.empty(0, dtype=int)
+        width = cell_data.get("pixel_width")
+        if width is None:
+            width = cell_data["cell_coords"][2] - cell_data["cell_coords"][0]
+        width = np.asarray(width, dtype=float)
+        return np.rint(np.log2(width / width.min())).astype(int) + 1
+
+    @classmethod
+    def get_attribute_columns(cls, cell_data):
+        """Return the attribute values of all cells, ordered as TABLE_FIELDS
+
+        :param cell_data: dict of (filtered) cell data
+        :return: OrderedDict with a numpy array per table field
+        """
+        return OrderedDict(
+            [
+                ("id", cell_data["id"].astype(int)),
+                (
+                    "type",
+                    _map_unique(
+                        cell_data["node_type"], lambda v: cls.CELL_NODE_TYPES[int(v)]
+                    ),
+                ),
+                ("level", cls.get_levels(cell_data)),
+            ]
+        )
+
+    @staticmethod
+    def get_coordinates(cell_data):
+        """Return the xmin, ymin, xmax, ymax arrays of the cell bounds"""
+        return tuple(cell_data["cell_coords"][0:4])
+
+    def save(
+        self,
+        file_name,
+        layer_name,
+        cell_data,
+        target_epsg_code,
+        feedback=None,
+        **kwargs
+    ):
+        """
+        save to file format specified by the driver, e.g. shapefile
+
+        :param file_name: name of the outputfile
+        :param cell_data: dict of (filtered) cell data
+        :param feedback: optional QgsFeedback for progress and cancellation
+        :raises ExportCancelledError: if the feedback has been cancelled
+        """
+        assert self.driver is not None
+
+        # this will also create a new sqlite if it doesn't exist
+        spl = Spatialite(file_name)
+        # create a new spatially enabled layer. The Spatialite connector is
+        # used to create a custom geometry column name
+        spl.create_empty_layer_only(
+            layer_name,
+            wkb_type=QgsWkbTypes.Polygon,
+            fields=self.TABLE_FIELDS,
+            id_field="id",
+            geom_field="the_geom",
+            srid=target_epsg_code,
+        )
+        del spl  # closes the connection
+        # reopen the file as writeable
+        data_source = self.driver.Open(file_name, update=1)
+        # get layer for writing
+        layer = data_source.GetLayerByName(layer_name)
+
+        _definition = layer.GetLayerDefn()
+
+        columns = self.get_attribute_columns(cell_data)
+        field_names = list(columns)[1:]  # the id is set as feature id
+
+        def create_feature(x0, y0, x1, y1, fid, *attributes):
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            ring.AddPoint_2D(x0, y0)
+            ring.AddPoint_2D(x1, y0)
+            ring.AddPoint_2D(x1, y1)
+            ring.AddPoint_2D(x0, y1)
+            ring.AddPoint_2D(x0, y0)
+            polygon = ogr.Geometry(ogr.wkbPolygon)
+            polygon.AddGeometry(ring)
+            feature = ogr.Feature(_definition)
+            feature.SetGeometry(polygon)
+            _set_fields(feature, field_names, attributes)
+            feature.SetFID(fid)
+            return feature
+
+        try:
+            _create_features_in_chunks(
+                layer,
+                self.get_coordinates(cell_data) + tuple(columns.values()),
+                create_feature,
+                feedback,
+            )
+        finally:
+            data_source = None
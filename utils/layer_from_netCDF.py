@@ -1,11 +1,21 @@
 """Functions for creation of QgsVectorLayers from 3Di netCDF files"""
+from collections import OrderedDict
 from osgeo import ogr
+from pathlib import Path
 from qgis.core import QgsDataSourceUri
+from qgis.core import QgsFeature
+from qgis.core import QgsGeometry
+from qgis.core import QgsPointXY
+from qgis.core import QgsRectangle
 from qgis.core import QgsVectorLayer
 from ThreeDiToolbox.datasource.spatialite import disable_sqlite_synchronous
+from ThreeDiToolbox.datasource.spatialite import Spatialite
+from urllib.parse import quote
 
 import logging
+import numpy as np
 import os
+import sqlite3
 
 
 logger = logging.getLogger(__name__)
@@ -15,22 +25,110 @@ logger = logging.getLogger(__name__)
 FLOWLINES_LAYER_NAME = "flowlines"
 NODES_LAYER_NAME = "nodes"
 PUMPLINES_LAYER_NAME = "pumplines"
+CELLS_LAYER_NAME = "cells"
 WGS84_EPSG = 4326
 
 IGNORE_FIRST = slice(1, None, None)
 
+# Maps the spatialite column types of the exporters' TABLE_FIELDS to the
+# field types of the memory provider
+MEMORY_FIELD_TYPES = {"INTEGER": "integer", "VARCHAR": "string", "DOUBLE": "double"}
+
+
+# Number of files of which the layer names are cached
+LAYER_NAMES_CACHE_SIZE = 16
+
+# Layer names per sqlite path, see get_layer_names()
+_layer_names_cache = OrderedDict()
+
+
+def get_sqlite_uri(sqlite_path):
+    """Return a read-only SQLite URI of ``sqlite_path`` with an empty authority.
+
+    ``Path.as_uri()`` would turn a UNC path into ``file://server/share/...``,
+    whose authority SQLite rejects. Mapped network drives are not resolved
+    into UNC paths.
+    """
+    path = Path(os.path.abspath(sqlite_path)).as_posix()
+    if not path.startswith("/"):
+        # windows drive letter: file:///C:/...
+        path = "/" + path
+    return "file://%s?mode=ro" % quote(path, safe="/:")
+
+
+def _read_ogr_layer_names(sqlite_path):
+    """Return the names of the layers in ``sqlite_path``, opened with OGR."""
+    data_source = ogr.GetDriverByName("SQLite").Open(sqlite_path)
+    if data_source is None:
+        return frozenset()
+    return frozenset(
+        data_source.GetLayer(i).GetName().lower()
+        for i in range(data_source.GetLayerCount())
+    )
+
+
+def _read_layer_names(sqlite_path):
+    """Return the names of the spatial tables in ``sqlite_path``.
+
+    One query on the ``geometry_columns`` table is a lot cheaper than opening
+    the file with OGR, especially on network drives. OGR is used if SQLite
+    can't open the URI of the path.
+    """
+    try:
+        connection = sqlite3.connect(get_sqlite_uri(sqlite_path), uri=True)
+    except sqlite3.OperationalError:
+        logger.exception("Can't open %s with sqlite3, using OGR", sqlite_path)
+        return _read_ogr_layer_names(sqlite_path)
+    try:
+        rows = connection.execute("SELECT f_table_name FROM geometry_columns")
+        return frozenset(name.lower() for (name,) in rows)
+    except sqlite3.OperationalError:
+        # No geometry_columns (yet), e.g. a freshly created file
+        return frozenset()
+    finally:
+        connection.close()
+
+
+def get_layer_names(sqlite_path):
+    """Return the (lowercase) layer names of ``sqlite_path``.
+
+    The names are cached per file and re-read when its modification time or
+    size changes.
+    """
+    stat = os.stat(sqlite_path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _layer_names_cache.get(sqlite_path)
+    if cached is not None and cached[0] == key:
+        _layer_names_cache.move_to_end(sqlite_path)
+        return cached[1]
+    layer_names = _read_layer_names(sqlite_path)
+    _layer_names_cache[sqlite_path] = (key, layer_names)
+    _layer_names_cache.move_to_end(sqlite_path)
+    while len(_layer_names_cache) > LAYER_NAMES_CACHE_SIZE:
+        _layer_names_cache.popitem(last=False)
+    return layer_names
+
 
 def contains_layer(sqlite_path, layer_name):
-    driver = ogr.GetDriverByName("SQLite")
-    data_source = driver.Open(sqlite_path)
-    has_layer = False
-    for i in range(data_source.GetLayerCount()):
-        lyr = data_source.GetLayer(i)
-        if lyr.GetName() == layer_name:
-            has_layer = True
-            break
-    data_source = None  # close data source
-    return has_layer
+    return layer_name.lower() in get_layer_names(sqlite_path)
+
+
+def _save_or_discard(exporter, output_path, layer_name, data, feedback):
+    """Save with ``exporter``, removing the partial layer when cancelled.
+
+    Otherwise a cancelled export would leave an incomplete layer behind that
+    ``contains_layer`` happily reports as present.
+    """
+    from .gridadmin import ExportCancelledError
+
+    try:
+        exporter.save(output_path, layer_name, data, WGS84_EPSG, feedback=feedback)
+    except ExportCancelledError:
+        logger.info("Export of %s cancelled, removing partial layer", layer_name)
+        spl = Spatialite(output_path)
+        spl.deleteTable(layer_name)
+        del spl  # closes the connection
+        raise
 
 
 def _get_vector_layer(sqlite_path, layer_name, geom_column="the_geom"):
@@ -41,8 +139,185 @@ def _get_vector_layer(sqlite_path, layer_name, geom_column="the_geom"):
     return QgsVectorLayer(uri.uri(), layer_name, "spatialite")
 
 
+def _get_memory_layer(layer_name, geometry_type, table_fields):
+    """Helper function to construct an empty memory QgsVectorLayer.
+
+    The fields are derived from the (spatialite) ``table_fields`` of the
+    exporters. The memory provider builds a spatial index on the fly.
+    """
+    fields = []
+    for table_field in table_fields:
+        name, field_type = table_field.split()
+        fields.append("field={}:{}".format(name, MEMORY_FIELD_TYPES[field_type]))
+    uri = "{}?crs=EPSG:{}&{}&index=yes".format(
+        geometry_type, WGS84_EPSG, "&".join(fields)
+    )
+    return QgsVectorLayer(uri, layer_name, "memory")
+
+
+def _add_features_to_memory_layer(layer, geometries, attribute_columns):
+    """Add all features to ``layer`` in one ``addFeatures`` batch.
+
+    Fields of the layer after the ``attribute_columns`` are left empty.
+    """
+    fields = layer.fields()
+    padding = [None] * (fields.count() - len(attribute_columns))
+    columns = [np.asarray(values).tolist() for values in attribute_columns.values()]
+    features = []
+    for geometry, attributes in zip(geometries, zip(*columns)):
+        feature = QgsFeature(fields)
+        feature.setGeometry(geometry)
+        feature.setAttributes(list(attributes) + padding)
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    layer.updateExtents()
+    return layer
+
+
+def _select(coordinates, attribute_columns, type_filter):
+    """Return the coordinates and attribute columns of the selected features
+
+    :param type_filter: None (select all) or a function returning a boolean
+        mask for the numpy array of the ``type`` attribute values
+    """
+    if type_filter is None:
+        return coordinates, attribute_columns
+    mask = type_filter(np.asarray(attribute_columns["type"], dtype=object))
+    coordinates = tuple(np.asarray(c)[mask] for c in coordinates)
+    attribute_columns = OrderedDict(
+        (name, np.asarray(values)[mask]) for name, values in attribute_columns.items()
+    )
+    return coordinates, attribute_columns
+
+
+def _line_geometries(x1, y1, x2, y2):
+    for coords in zip(x1.tolist(), y1.tolist(), x2.tolist(), y2.tolist()):
+        yield QgsGeometry.fromPolylineXY(
+            [QgsPointXY(coords[0], coords[1]), QgsPointXY(coords[2], coords[3])]
+        )
+
+
+def _point_geometries(x, y):
+    for coords in zip(x.tolist(), y.tolist()):
+        yield QgsGeometry.fromPointXY(QgsPointXY(*coords))
+
+
+def _polygon_geometries(x0, y0, x1, y1):
+    for coords in zip(x0.tolist(), y0.tolist(), x1.tolist(), y1.tolist()):
+        yield QgsGeometry.fromRect(QgsRectangle(*coords))
+
+
+def _get_cell_data(ga):
+    from .gridadmin import QgisCellsOgrExporter
+
+    sliced = ga.cells.slice(IGNORE_FIRST).reproject_to(str(WGS84_EPSG))
+    return QgisCellsOgrExporter.filter_cells(sliced.data)
+
+
+def create_memory_flowline_layer(
+    ds, layer_name=FLOWLINES_LAYER_NAME, type_filter=None, extra_fields=()
+):
+    """Return a memory flowline layer built directly from the gridadmin
+
+    Unlike ``get_or_create_flowline_layer`` nothing is written to disk, which
+    saves the round trip through the gridadmin.sqlite. The memory provider
+    assigns its own feature ids (1..N), so the line ids are only available
+    as the ``id`` attribute.
+
+    :param type_filter: optional function returning a boolean mask for the
+        numpy array of line types, only the selected lines are added
+    :param extra_fields: additional (empty) fields, e.g. ``["result DOUBLE"]``
+    """
+    from .gridadmin import QgisLinesOgrExporter
+
+    ga = ds.gridadmin
+    line_data = ga.lines.slice(IGNORE_FIRST).reproject_to(str(WGS84_EPSG)).data
+    coordinates, attribute_columns = _select(
+        QgisLinesOgrExporter.get_coordinates(line_data),
+        QgisLinesOgrExporter.get_attribute_columns(line_data),
+        type_filter,
+    )
+    layer = _get_memory_layer(
+        layer_name,
+        "LineString",
+        QgisLinesOgrExporter.TABLE_FIELDS + list(extra_fields),
+    )
+    return _add_features_to_memory_layer(
+        layer, _line_geometries(*coordinates), attribute_columns
+    )
+
+
+def create_memory_node_layer(
+    ds, layer_name=NODES_LAYER_NAME, type_filter=None, extra_fields=()
+):
+    """Return a memory node layer built directly from the gridadmin
+
+    See ``create_memory_flowline_layer`` for ``type_filter`` and
+    ``extra_fields``.
+    """
+    from .gridadmin import QgisNodesOgrExporter
+
+    ga = ds.gridadmin
+    node_data = ga.nodes.slice(IGNORE_FIRST).reproject_to(str(WGS84_EPSG)).data
+    coordinates, attribute_columns = _select(
+        QgisNodesOgrExporter.get_coordinates(node_data),
+        QgisNodesOgrExporter.get_attribute_columns(node_data),
+        type_filter,
+    )
+    layer = _get_memory_layer(
+        layer_name, "Point", QgisNodesOgrExporter.TABLE_FIELDS + list(extra_fields)
+    )
+    return _add_features_to_memory_layer(
+        layer, _point_geometries(*coordinates), attribute_columns
+    )
+
+
+def create_memory_pumpline_layer(ds):
+    """Return a memory pumpline layer built directly from the gridadmin
+
+    Returns None if the model has no pumpstations.
+    """
+    from .gridadmin import QgisPumpsOgrExporter
+
+    ga = ds.gridadmin
+    if not ga.has_pumpstations:
+        return None
+    pump_data = ga.pumps.slice(IGNORE_FIRST).reproject_to(str(WGS84_EPSG)).data
+    layer = _get_memory_layer(
+        PUMPLINES_LAYER_NAME, "LineString", QgisPumpsOgrExporter.TABLE_FIELDS
+    )
+    return _add_features_to_memory_layer(
+        layer,
+        _line_geometries(*QgisPumpsOgrExporter.get_coordinates(pump_data)),
+        QgisPumpsOgrExporter.get_attribute_columns(pump_data),
+    )
+
+
+def create_memory_cell_layer(ds):
+    """Return a memory layer with the 2D cells built directly from the gridadmin
+
+    The node id of a cell is its ``id`` attribute, not its feature id (see
+    ``create_memory_flowline_layer``). Returns None if the model has no 2D
+    domain.
+    """
+    from .gridadmin import QgisCellsOgrExporter
+
+    ga = ds.gridadmin
+    if not ga.has_2d:
+        return None
+    cell_data = _get_cell_data(ga)
+    layer = _get_memory_layer(
+        CELLS_LAYER_NAME, "Polygon", QgisCellsOgrExporter.TABLE_FIELDS
+    )
+    return _add_features_to_memory_layer(
+        layer,
+        _polygon_geometries(*QgisCellsOgrExporter.get_coordinates(cell_data)),
+        QgisCellsOgrExporter.get_attribute_columns(cell_data),
+    )
+
+
 @disable_sqlite_synchronous
-def get_or_create_flowline_layer(ds, output_path):
+def get_or_create_flowline_layer(ds, output_path, feedback=None):
     if not os.path.exists(output_path) or not contains_layer(
         output_path, FLOWLINES_LAYER_NAME
     ):
@@ -52,14 +327,14 @@ def get_or_create_flowline_layer(ds, output_path):
         exporter = QgisLinesOgrExporter("dont matter")
         exporter.driver = ogr.GetDriverByName("SQLite")
         sliced = ga.lines.slice(IGNORE_FIRST).reproject_to(str(WGS84_EPSG))
-        exporter.save(
-            output_path, FLOWLINES_LAYER_NAME, sliced.data, 4326
+        _save_or_discard(
+            exporter, output_path, FLOWLINES_LAYER_NAME, sliced.data, feedback
         )
     return _get_vector_layer(output_path, FLOWLINES_LAYER_NAME)
 
 
 @disable_sqlite_synchronous
-def get_or_create_node_layer(ds, output_path):
+def get_or_create_node_layer(ds, output_path, feedback=None):
     if not os.path.exists(output_path) or not contains_layer(
         output_path, NODES_LAYER_NAME
     ):
@@ -69,14 +344,14 @@ def get_or_create_node_layer(ds, output_path):
         exporter = QgisNodesOgrExporter("dont matter")
         exporter.driver = ogr.GetDriverByName("SQLite")
         sliced = ga.nodes.slice(IGNORE_FIRST).reproject_to(str(WGS84_EPSG))
-        exporter.save(
-            output_path, NODES_LAYER_NAME, sliced.data, WGS84_EPSG
+        _save_or_discard(
+            exporter, output_path, NODES_LAYER_NAME, sliced.data, feedback
         )
     return _get_vector_layer(output_path, NODES_LAYER_NAME)
 
 
 @disable_sqlite_synchronous
-def get_or_create_pumpline_layer(ds, output_path):
+def get_or_create_pumpline_layer(ds, output_path, feedback=None):
     ga = ds.gridadmin
     if not os.path.exists(output_path) or not contains_layer(
         output_path, PUMPLINES_LAYER_NAME
@@ -87,8 +362,31 @@ def get_or_create_pumpline_layer(ds, output_path):
             exporter = QgisPumpsOgrExporter(node_data=ga.nodes.data)
             exporter.driver = ogr.GetDriverByName("SQLite")
             sliced = ga.pumps.slice(IGNORE_FIRST).reproject_to(str(WGS84_EPSG))
-            exporter.save(
-                output_path, PUMPLINES_LAYER_NAME, sliced.data, WGS84_EPSG
+            _save_or_discard(
+                exporter, output_path, PUMPLINES_LAYER_NAME, sliced.data, feedback
             )
     if ga.has_pumpstations:
         return _get_vector_layer(output_path, PUMPLINES_LAYER_NAME)
+
+
+@disable_sqlite_synchronous
+def get_or_create_cell_layer(ds, output_path, feedback=None):
+    """Return the layer with the 2D cells (polygons) of the gridadmin.sqlite
+
+    The cells have the id of their node and their quadtree level. Returns None
+    if the model has no 2D domain.
+    """
+    ga = ds.gridadmin
+    if not ga.has_2d:
+        return None
+    if not os.path.exists(output_path) or not contains_layer(
+        output_path, CELLS_LAYER_NAME
+    ):
+        from .gridadmin import QgisCellsOgrExporter
+
+        exporter = QgisCellsOgrExporter("dont matter")
+        exporter.driver = ogr.GetDriverByName("SQLite")
+        _save_or_discard(
+            exporter, output_path, CELLS_LAYER_NAME, _get_cell_data(ga), feedback
+        )
+    return _get_vector_layer(output_path, CELLS_LAYER_NAME)
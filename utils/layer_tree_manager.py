@@ -1,7 +1,10 @@
 from . import styler
+from .gridadmin import ExportCancelledError
 from .threedi_database import ThreediDatabase
+from .user_messages import messagebar_message
 from qgis.core import QgsCoordinateTransform
 from qgis.core import QgsDataSourceUri
+from qgis.core import QgsFillSymbol
 from qgis.core import QgsLayerTreeNode
 from qgis.core import QgsProject
 from qgis.core import QgsRectangle
@@ -411,7 +414,14 @@ class LayerTreeManager(object):
                     group = self.model_layergroup.insertGroup(2, name)
                     self._mark(group, "result_" + result.file_path.value)
 
-                line, node, pumpline = result.get_result_layers()
+                try:
+                    line, node, pumpline = result.get_result_layers()
+                except ExportCancelledError:
+                    messagebar_message(
+                        "Results", "Loading of %s cancelled" % result.name.value
+                    )
+                    group.parent().removeChildNode(group)
+                    continue
 
                 if self._find_marked_child(group, "flowlines") is None:
                     # apply default styling on memory layers
@@ -447,6 +457,19 @@ class LayerTreeManager(object):
                     tree_layer3 = group.insertLayer(2, node)
                     self._mark(tree_layer3, "nodes")
 
+                    # the 2D cells, hidden by default as they cover the model
+                    cells = result.get_cell_layer()
+                    if cells is not None:
+                        cells.renderer().setSymbol(
+                            QgsFillSymbol.createSimple(
+                                {"color": "0,0,0,0", "outline_color": "128,128,128"}
+                            )
+                        )
+                        QgsProject.instance().addMapLayer(cells, False)
+                        tree_layer4 = group.insertLayer(3, cells)
+                        self._mark(tree_layer4, "cells")
+                        tree_layer4.setItemVisibilityChecked(False)
+
     # TODO: make static or just function
     def _create_layers(self, db_path, group, layernames, geometry_column=""):
         layers = []
@@ -0,0 +1,89 @@
+"""Index of the flowlines connected to each node of a 3Di model
+
+Looking up the lines of a node through the flowline layer (an expression on
+``start_node_idx`` and ``end_node_idx``) scans the whole table. The
+:py:class:`LineAdjacency` is built once from the gridadmin line nodes in
+compressed sparse row (CSR) form: the lines of node ``n`` are stored at
+``indptr[n]:indptr[n + 1]``.
+
+"""
+from ThreeDiToolbox.utils.layer_from_netCDF import IGNORE_FIRST
+
+import numpy as np
+
+
+# Direction of a line with respect to a node
+STARTS_AT_NODE = 1
+ENDS_AT_NODE = -1
+
+
+class LineAdjacency(object):
+    """The incident lines of every node, with their direction
+
+    The direction is :py:data:`STARTS_AT_NODE` if the line is drawn from the
+    node (positive discharge flows away from the node) and
+    :py:data:`ENDS_AT_NODE` if it is drawn towards the node.
+
+    :param line_ids: array with the ids of the lines
+    :param start_node_ids: array with the start node id of every line
+    :param end_node_ids: array with the end node id of every line
+    """
+
+    def __init__(self, line_ids, start_node_ids, end_node_ids):
+        line_ids = np.asarray(line_ids, dtype=int)
+        node_ids = np.concatenate(
+            [np.asarray(start_node_ids, dtype=int), np.asarray(end_node_ids, dtype=int)]
+        )
+        line_ids = np.concatenate([line_ids, line_ids])
+        directions = np.repeat(
+            np.array([STARTS_AT_NODE, ENDS_AT_NODE], dtype=np.int8), line_ids.size // 2
+        )
+        # lines without a start or end node (-9999) are not indexed
+        valid = node_ids >= 0
+        node_ids = node_ids[valid]
+        order = np.argsort(node_ids, kind="stable")
+        self.line_ids = line_ids[valid][order]
+        self.directions = directions[valid][order]
+        counts = np.bincount(node_ids, minlength=1)
+        self.indptr = np.concatenate([[0], np.cumsum(counts)])
+
+    @classmethod
+    def from_gridadmin(cls, ga):
+        """Return the adjacency of the lines of a GridH5Admin"""
+        line_data = ga.lines.slice(IGNORE_FIRST).only("id", "line").data
+        return cls(line_data["id"], line_data["line"][0], line_data["line"][1])
+
+    @property
+    def nr_nodes(self):
+        """The highest indexed node id + 1"""
+        return self.indptr.size - 1
+
+    def get_lines(self, node_id):
+        """Return the line ids and directions of the lines of a node
+
+        :return: tuple (line_ids, directions) of arrays
+        """
+        if not 0 <= node_id < self.nr_nodes:
+            return self.line_ids[:0], self.directions[:0]
+        start, end = self.indptr[node_id], self.indptr[node_id + 1]
+        return self.line_ids[start:end], self.directions[start:end]
+
+    def get_incident_lines(self, node_ids):
+        """Return the lines of several nodes at once
+
+        :param node_ids: array of node ids
+        :return: tuple (node_ids, line_ids, directions) of arrays with one
+            element per (node, line) pair, ordered like ``node_ids``
+        """
+        node_ids = np.asarray(node_ids, dtype=int)
+        node_ids = node_ids[(node_ids >= 0) & (node_ids < self.nr_nodes)]
+        starts = self.indptr[node_ids]
+        counts = self.indptr[node_ids + 1] - starts
+        # the position of every pair: the start of its node + its rank
+        offsets = np.cumsum(counts) - counts
+        positions = np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+        return (
+            np.repeat(node_ids, counts),
+            self.line_ids[positions],
+            self.directions[positions],
+        )
@@ -2,9 +2,11 @@
 # test_project will fail! WTF?
 from contextlib import contextmanager
 from qgis.core import Qgis
+from qgis.PyQt.QtCore import QCoreApplication
 from qgis.PyQt.QtCore import Qt
 from qgis.PyQt.QtWidgets import QMessageBox
 from qgis.PyQt.QtWidgets import QProgressBar
+from qgis.PyQt.QtWidgets import QPushButton
 from qgis.utils import iface
 
 
@@ -56,9 +58,15 @@ def pop_up_question(msg="", title="", parent=None):
 
 
 class StatusProgressBar(object):
-    def __init__(self, maximum=100, message_title=""):
+    def __init__(self, maximum=100, message_title="", feedback=None):
+        """Progress bar in the message bar.
 
+        If a ``feedback`` (``QgsFeedback``) is given, a cancel button is added
+        that cancels it. As the work typically runs in the main thread, the
+        button only responds when progress is reported via ``set_progress``.
+        """
         self.maximum = maximum
+        self.feedback = feedback
         self.message_bar = iface.messageBar().createMessage(message_title, "")
 
         self.progress_bar = QProgressBar()
@@ -66,6 +74,10 @@ class StatusProgressBar(object):
         self.progress_bar.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
 
         self.message_bar.layout().addWidget(self.progress_bar)
+        if feedback is not None:
+            self.cancel_button = QPushButton("Cancel")
+            self.cancel_button.clicked.connect(feedback.cancel)
+            self.message_bar.layout().addWidget(self.cancel_button)
         if iface is not None:
             iface.messageBar().pushWidget(self.message_bar, Qgis.MessageLevel())
 
@@ -83,6 +95,16 @@ class StatusProgressBar(object):
         if message:
             self.message_bar.setText(message)
 
+    def set_progress(self, progress, message=None):
+        """Set the absolute progress, e.g. from ``QgsFeedback.progressChanged``"""
+        self.progress = progress
+        self.progress_bar.setValue(int(progress))
+        if message:
+            self.message_bar.setText(message)
+        if self.feedback is not None:
+            # let the cancel button receive its click
+            QCoreApplication.processEvents()
+
     def __del__(self):
         if iface is not None:
             iface.messageBar().clearWidgets()